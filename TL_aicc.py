@@ -0,0 +1,150 @@
+"""Module comparing the two error structures of Taylor's law with AICc, following power_analysis() in Sup_2_Guidelines.r.
+
+LR is the linear regression of log variance on log mean, which assumes multiplicative log-normal error;
+NLR is the nonlinear least-squares fit of variance = a * mean ** b, which assumes additive normal error.
+The comparison is carried out for the empirical data and all simulated samples of a study at once.
+
+"""
+from __future__ import division
+import numpy as np
+import TL_functions as tl
+
+K_PAR = 3 # Number of parameters of either model (a, b, and the standard deviation of the error)
+
+def fit_power_nlr(x, y, mask = None, b0 = None, inter0 = None, max_iter = 2000, tol = 1e-10):
+    """Nonlinear least-squares fits of y = a * x ** b to each column of y, equivalent to nls() in R.
+
+    The fits are carried out simultaneously with Levenberg-Marquardt, on the parameters log(a) and b
+    (which leaves the least-squares solution unchanged), starting from the log-log fits of each column
+    (log(a) = inter0, b = b0) if given, or from linregress_batch() otherwise.
+    Input:
+    x - independent variable, a vector shared by all columns
+    y - matrix of dependent variables, one fit per column
+    mask - optional boolean matrix of the same shape as y, points with False are left out of the fit
+    max_iter, tol - the iterations stop once the relative decrease in the sum of squares is below tol
+                    in all columns, or after max_iter iterations
+    Output: arrays of a, b, and whether the fit has converged, one value per column.
+
+    """
+    y = np.asarray(y, dtype = float)
+    log_x = np.log(np.asarray(x, dtype = float))[:, None] * np.ones(y.shape)
+    if mask is None:
+        mask = np.ones(y.shape, dtype = bool)
+    w = mask.astype(float)
+    y = np.where(mask, y, 0)
+    if b0 is None or inter0 is None:
+        b0, inter0, r, p = tl.linregress_batch(log_x, np.log(np.where(mask, y, 1)), mask = mask)
+    log_a, b = np.array(inter0, dtype = float), np.array(b0, dtype = float)
+
+    def get_sse(log_a, b):
+        with np.errstate(over = 'ignore', invalid = 'ignore'):
+            fit = np.exp(log_a + b * log_x)
+            return fit, (w * (y - fit) ** 2).sum(axis = 0)
+
+    fit, sse = get_sse(log_a, b)
+    lam = np.empty(y.shape[1])
+    lam.fill(1e-3)
+    converged = np.zeros(y.shape[1], dtype = bool)
+    for i in xrange(max_iter):
+        # Normal equations of the two parameters, with the Marquardt scaling of the diagonal
+        res = w * (y - fit)
+        j_a, j_b = w * fit, w * fit * log_x
+        g_a, g_b = (j_a * res).sum(axis = 0), (j_b * res).sum(axis = 0)
+        h_aa, h_ab, h_bb = (j_a ** 2).sum(axis = 0), (j_a * j_b).sum(axis = 0), (j_b ** 2).sum(axis = 0)
+        h_aa, h_bb = h_aa * (1 + lam), h_bb * (1 + lam)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            det = h_aa * h_bb - h_ab ** 2
+            step_a = (h_bb * g_a - h_ab * g_b) / det
+            step_b = (h_aa * g_b - h_ab * g_a) / det
+        step_a = np.where(converged | ~np.isfinite(step_a), 0, step_a)
+        step_b = np.where(converged | ~np.isfinite(step_b), 0, step_b)
+        new_fit, new_sse = get_sse(log_a + step_a, b + step_b)
+        better = new_sse <= sse
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            small = np.where(sse > 0, (sse - np.where(better, new_sse, sse)) / sse, 0) < tol
+        converged |= better & small | (lam > 1e16)
+        log_a, b = np.where(better, log_a + step_a, log_a), np.where(better, b + step_b, b)
+        fit = np.where(better, new_fit, fit)
+        sse = np.where(better, new_sse, sse)
+        lam = np.where(better, lam / 10, lam * 10)
+        if converged.all(): break
+    return np.exp(log_a), b, converged
+
+def lr_nlr_aicc(x, y, mask = None):
+    """AICc of LR (log-normal error) and NLR (normal error) fitted to each column of y, as in power_analysis().
+
+    The likelihoods are computed on the original scale of y, with the standard deviation of the
+    residuals of each fit (n - 1 in the denominator) as that of the error, and k = 3 parameters.
+    Input is as in fit_power_nlr(); zero values of y are best left out with mask, as log(0) is undefined.
+    Output: arrays of AICc of LR and of NLR, one value per column.
+
+    """
+    y = np.asarray(y, dtype = float)
+    x = np.asarray(x, dtype = float)
+    if mask is None:
+        mask = np.ones(y.shape, dtype = bool)
+    w = mask.astype(float)
+    n = w.sum(axis = 0)
+    log_x = np.log(x)[:, None] * np.ones(y.shape)
+    log_y = np.log(np.where(mask, y, 1))
+    y = np.where(mask, y, 1)
+    b_lr, inter_lr, r, p = tl.linregress_batch(log_x, log_y, mask = mask)
+    a_nlr, b_nlr, converged = fit_power_nlr(x, y, mask = mask, b0 = b_lr, inter0 = inter_lr)
+
+    def log_lik_norm(res, extra = 0):
+        """Sum of normal log-densities of the residuals, with the sample sd of the residuals."""
+        res_mean = (w * res).sum(axis = 0) / n
+        sd = np.sqrt((w * (res - res_mean) ** 2).sum(axis = 0) / (n - 1))
+        return (w * (-np.log(sd) - 0.5 * np.log(2 * np.pi) - res ** 2 / (2 * sd ** 2) - extra)).sum(axis = 0)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore', over = 'ignore'):
+        l_logn = log_lik_norm(log_y - (inter_lr + b_lr * log_x), extra = log_y) # Jacobian of the log transformation
+        l_norm = log_lik_norm(y - a_nlr * np.exp(b_nlr * log_x))
+        penalty = 2 * K_PAR + 2 * K_PAR * (K_PAR + 1) / (n - K_PAR - 1)
+    return penalty - 2 * l_logn, penalty - 2 * l_norm
+
+def akaike_weights(aicc_logn, aicc_norm):
+    """Akaike weights of LR and NLR given their AICc."""
+    aicc_min = np.minimum(aicc_logn, aicc_norm)
+    w_logn, w_norm = np.exp(-(aicc_logn - aicc_min) / 2), np.exp(-(aicc_norm - aicc_min) / 2)
+    return w_logn / (w_logn + w_norm), w_norm / (w_logn + w_norm)
+
+def aicc_method(delta_aicc):
+    """Method recommended in power_analysis() given delta AICc (AICc of NLR minus AICc of LR)."""
+    if delta_aicc < -2: return 'NLR'
+    elif delta_aicc > 2: return 'LR'
+    else: return 'Model Averaging'
+
+def get_delta_aicc_samples(dat_study):
+    """Delta AICc (AICc of NLR minus AICc of LR) of the empirical data and of each simulated sample of a study.
+
+    The input dat_study is the records of one study in the format defined by tl.get_var_sample_file().
+    Zero variances are left out of the fits of their sample.
+    Output: a tuple of the empirical value and an array with one value per sample.
+
+    """
+    var_matrix = np.column_stack((dat_study['var'], tl.get_sample_matrix(dat_study)))
+    aicc_logn, aicc_norm = lr_nlr_aicc(dat_study['mean'], var_matrix, mask = var_matrix > 0)
+    delta = aicc_norm - aicc_logn
+    return delta[0], delta[1:]
+
+def get_aicc_data(dat_sample, analysis = 'partition', out_folder = './out_files/'):
+    """Compute delta AICc for each dataset as well as all of its partitions/compositions and write results to file.
+
+    The input dat_sample is in the format defined by tl.get_var_sample_file(), or a StudyGroups object built from it.
+    The output file TL_AICc_<analysis>.txt, named as in tl.output_path(), has the same layout as the output of
+    tl.get_quadratic_sig_data(), and can be read with tl.get_val_ind_sample_file().
+
+    """
+    dat_sample = tl.group_by_study(dat_sample)
+    sample_size = tl.get_sample_size(dat_sample)
+    with tl.telemetry.span('get_aicc_data', analysis = analysis, studies = len(dat_sample)), tl.batch_output():
+        for study in dat_sample.studies:
+            emp_delta, sample_delta = get_delta_aicc_samples(dat_sample[study])
+            tl.write_output(tl.output_path(out_folder, 'TL_AICc', analysis, sample_size), study,
+                            ['\t'.join(map(str, [study, emp_delta] + list(sample_delta)))])
+
+if __name__ == '__main__':
+    for analysis in ['partition', 'composition']:
+        dat_sample = tl.get_var_sample_file('out_files/taylor_QN_var_predicted_' + analysis + '_1000_full.txt')
+        get_aicc_data(dat_sample, analysis = analysis)
@@ -0,0 +1,303 @@
+"""Benchmarks of the sampling, I/O and post-processing steps of the TL project.
+
+Each benchmark is registered with benchmark() in one of three groups: 'sampling' (drawing partitions and
+compositions), 'io' (reading the output of sample_var()) and 'postprocess' (fitting TL to the samples).
+The sampling benchmarks are run on Q-N combos picked from the quantiles of Q * N among the combos of the
+empirical data (see benchmark_combos()), and all benchmarks are run with each of SAMPLE_SIZES samples.
+Each repeat of a sampling benchmark stops after SAMPLING_T_LIMIT seconds, as the largest combos would otherwise
+take hours, and starts from an empty partition-count cache, so that every repeat is timed cold.
+Every benchmark runs in a fresh interpreter, which reports the best wall time over several repeats,
+the throughput (items processed per second, e.g. variances drawn or records read) and its peak RSS.
+The results of each run are appended to results.json in the benchmark folder, and compared with
+baseline.json (saved with --save-baseline); benchmarks that take more time per item or use more memory than the
+baseline by more than the tolerance are flagged, and the runner then exits with status 1.
+Usage: python TL_benchmark.py [benchmark names] [--group G] [--sample-sizes S ...] [--save-baseline]
+
+"""
+from __future__ import division
+import TL_functions as tl
+import numpy as np
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import argparse
+import subprocess
+from collections import OrderedDict
+
+BENCH_FOLDER = './out_files/benchmarks/'
+DATA_FILES = ['data_literature.txt', 'data_Glenda.txt']
+SAMPLE_SIZES = [1000, 4000]
+QN_QUANTILES = [10, 50, 90] # Quantiles of Q * N at which the Q-N combos of the sampling benchmarks are picked
+N_STUDIES = 20 # Number of studies in the synthetic output of sample_var() read and fitted by the other benchmarks
+TOLERANCE = 0.2 # Relative increase in time or peak RSS over the baseline that is flagged as a regression
+SEED = 20150101
+SAMPLING_T_LIMIT = 20 # Seconds after which a repeat of a sampling benchmark stops drawing
+
+benchmarks = OrderedDict() # Benchmark name -> (group, function)
+
+def benchmark(name, group):
+    """Register a benchmark function.
+
+    The function takes (data, sample_size, combo), where data holds the empirical records of DATA_FILES
+    and combo is a (Q, N) pair for the sampling benchmarks and None otherwise. It does its setup and returns
+    (run, n_items, cleanup), where run() is the timed call, n_items the number of items it processes,
+    and cleanup (or None) is called once all repeats are done. A run() that may stop early returns
+    the number of items it did process instead of None.
+
+    """
+    def register(bench_func):
+        benchmarks[name] = (group, bench_func)
+        return bench_func
+    return register
+
+def get_data():
+    """Empirical records of all files in DATA_FILES, with the combos below Q_MIN or N_MIN removed."""
+    data = np.concatenate([tl.get_QN_mean_var_data(data_dir) for data_dir in DATA_FILES])
+    return data[(data['Q'] >= tl.Q_MIN) & (data['N'] >= tl.N_MIN)]
+
+def benchmark_combos(data, quantiles = QN_QUANTILES):
+    """Q-N combos of data at the given quantiles of Q * N, so that the benchmarks follow the real distribution."""
+    combos = np.unique(np.array(zip(data['Q'], data['N']), dtype = [('Q', '<i8'), ('N', '<i8')]))
+    combos = combos[np.argsort(combos['Q'] * combos['N'], kind = 'mergesort')]
+    index = [int(round(quantile / 100 * (len(combos) - 1))) for quantile in quantiles]
+    return [(int(combos['Q'][i]), int(combos['N'][i])) for i in index]
+
+def synthetic_var_sample(data, sample_size, n_studies = N_STUDIES, seed = SEED):
+    """Records in the format of get_var_sample_file() for the first n_studies studies in data with at least n_MIN rows.
+
+    The sample variances are the empirical variances with log-normal noise, which is enough to time reading
+    and fitting them without drawing the partitions.
+
+    """
+    groups = tl.group_by_study(data)
+    studies = [study for study in groups.studies if len(groups[study]) >= tl.n_MIN][:n_studies]
+    dat_study = np.concatenate([groups[study] for study in studies])
+    records = np.zeros(len(dat_study), dtype = tl.var_sample_dtype(sample_size))
+    for name in ['study', 'Q', 'N', 'mean', 'var']:
+        records[name] = dat_study[name]
+    np.random.seed(seed)
+    tl.get_sample_matrix(records)[:] = dat_study['var'][:, None] * \
+                                       np.exp(np.random.normal(0, 0.5, (len(records), sample_size)))
+    return records
+
+def write_var_sample(records, path):
+    """Write records to path in the text format of the output of sample_var()."""
+    with open(path, 'w') as out_file:
+        for record in records:
+            print>>out_file, '\t'.join(map(str, record))
+
+@benchmark('RandomComposition_weak', 'sampling')
+def bench_random_composition(data, sample_size, combo):
+    q, n = combo
+    def run():
+        np.random.seed(SEED)
+        for i in xrange(sample_size):
+            tl.RandomComposition_weak(q, n)
+    return run, sample_size, None
+
+def bench_var_for_Q_N(analysis, comp_method = 'legacy'):
+    def bench_func(data, sample_size, combo):
+        q, n = combo
+        def run():
+            tl.partition_counts.clear() # Cold, as for the first combo of a worker
+            return len(tl.get_var_for_Q_N(q, n, sample_size, SAMPLING_T_LIMIT, analysis, comp_method = comp_method,
+                                          exact = False, cache = False, seed = SEED))
+        return run, sample_size, None
+    return bench_func
+
+benchmark('get_var_for_Q_N_partition', 'sampling')(bench_var_for_Q_N('partition'))
+benchmark('get_var_for_Q_N_composition', 'sampling')(bench_var_for_Q_N('composition'))
+benchmark('get_var_for_Q_N_composition_uniform', 'sampling')(bench_var_for_Q_N('composition', comp_method = 'uniform'))
+
+@benchmark('get_var_sample_file_text', 'io')
+def bench_read_text(data, sample_size, combo):
+    records = synthetic_var_sample(data, sample_size)
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, 'taylor_QN_var_predicted.txt')
+    write_var_sample(records, path)
+    def run():
+        tl.get_var_sample_file(path, sample_size = sample_size)
+    return run, len(records), lambda: shutil.rmtree(folder)
+
+@benchmark('get_var_sample_file_binary', 'io')
+def bench_read_binary(data, sample_size, combo):
+    records = synthetic_var_sample(data, sample_size)
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, 'taylor_QN_var_predicted.txt')
+    write_var_sample(records, path)
+    tl.convert_var_sample_file(path, sample_size = sample_size)
+    def run(): # Touch every sample, as the file is only memory-mapped
+        tl.get_sample_matrix(tl.get_var_sample_file(path, sample_size = sample_size)).sum()
+    return run, len(records), lambda: shutil.rmtree(folder)
+
+@benchmark('quadratic_term_samples', 'postprocess')
+def bench_quadratic_term_samples(data, sample_size, combo):
+    groups = tl.group_by_study(synthetic_var_sample(data, sample_size))
+    def run():
+        for study in groups.studies:
+            tl.quadratic_term_samples(groups[study]['mean'], tl.get_sample_matrix(groups[study]))
+    return run, len(groups) * sample_size, None
+
+@benchmark('TL_from_sample', 'postprocess')
+def bench_TL_from_sample(data, sample_size, combo):
+    groups = tl.group_by_study(synthetic_var_sample(data, sample_size))
+    folder = tempfile.mkdtemp() + '/'
+    def run():
+        tl.TL_from_sample(groups, out_folder = folder, seed = SEED)
+    return run, len(groups) * sample_size, lambda: shutil.rmtree(folder)
+
+@benchmark('get_quadratic_sig_data', 'postprocess')
+def bench_quadratic_sig_data(data, sample_size, combo):
+    groups = tl.group_by_study(synthetic_var_sample(data, sample_size))
+    folder = tempfile.mkdtemp() + '/'
+    def run():
+        tl.get_quadratic_sig_data(groups, out_folder = folder)
+    return run, len(groups) * sample_size, lambda: shutil.rmtree(folder)
+
+def run_benchmark(name, data, sample_size, combo, repeat):
+    """Run one benchmark and return its result: best time (s), throughput (items/s) and peak RSS (MB).
+
+    The best repeat is the one with the highest throughput, which is the one with the shortest time
+    unless run() stopped early; n_items is the number of items processed in that repeat, out of n_planned.
+
+    """
+    bench_func = benchmarks[name][1]
+    tl.set_sample_cache() # In memory only, and not used by the benchmarks
+    run, n_items, cleanup = bench_func(data, sample_size, combo)
+    try:
+        repeats = []
+        for i in xrange(repeat):
+            start = time.time()
+            n_done = run()
+            seconds = time.time() - start
+            n_done = n_items if n_done is None else n_done
+            repeats.append((n_done / seconds if seconds > 0 else float('inf'), seconds, n_done))
+    finally:
+        if cleanup is not None: cleanup()
+    throughput, best, n_done = max(repeats)
+    return {'time': best, 'throughput': throughput, 'n_items': n_done, 'n_planned': n_items,
+            'peak_rss_mb': tl.peak_rss_mb()}
+
+def run_benchmark_subprocess(name, sample_size, combo, repeat):
+    """Run one benchmark in a fresh interpreter (see run_worker()), so that its peak RSS is its own, and return its result."""
+    args = [sys.executable, os.path.abspath(__file__), '--worker', name, '--sample-sizes', str(sample_size),
+            '--repeat', str(repeat)]
+    if combo is not None: args += ['--combo', str(combo[0]), str(combo[1])]
+    return json.loads(subprocess.check_output(args).splitlines()[-1]) # Result on the last line of the output
+
+def run_worker(name, sample_size, combo, repeat):
+    """Run one benchmark in this process and print its result as JSON on the last line of the output."""
+    print json.dumps(run_benchmark(name, get_data(), sample_size, combo, repeat))
+
+def benchmark_key(name, sample_size, combo):
+    key = name + '[sample_size=' + str(sample_size)
+    if combo is not None: key += ',Q=' + str(combo[0]) + ',N=' + str(combo[1])
+    return key + ']'
+
+def run_benchmarks(names = None, sample_sizes = SAMPLE_SIZES, repeat = 3):
+    """Run the benchmarks in names (all registered benchmarks by default), each in a fresh interpreter.
+
+    Returns an OrderedDict of results keyed by benchmark_key().
+
+    """
+    if names is None: names = list(benchmarks)
+    data = get_data()
+    combos = benchmark_combos(data)
+    results = OrderedDict()
+    for name in names:
+        group = benchmarks[name][0]
+        for sample_size in sample_sizes:
+            for combo in (combos if group == 'sampling' else [None]):
+                key = benchmark_key(name, sample_size, combo)
+                result = run_benchmark_subprocess(name, sample_size, combo, repeat)
+                result['group'] = group
+                results[key] = result
+                print key, round(result['time'], 4), 's', round(result['throughput'], 1), 'items/s', \
+                      round(result['peak_rss_mb'], 1), 'MB', \
+                      '(stopped early)' if result['n_items'] < result['n_planned'] else ''
+    return results
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr = open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def find_regressions(results, baseline, tolerance = TOLERANCE):
+    """List of (key, measure, baseline value, new value) for results slower or larger than baseline by more than tolerance.
+
+    Speed is compared as time per item (1 / throughput), so that runs stopped early by SAMPLING_T_LIMIT compare fairly.
+
+    """
+    measures = [('time per item', lambda result: 1 / result['throughput'] if result['throughput'] > 0 else float('inf')),
+                ('peak_rss_mb', lambda result: result['peak_rss_mb'])]
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline: continue
+        for measure, get_value in measures:
+            if get_value(result) > get_value(baseline[key]) * (1 + tolerance):
+                regressions.append((key, measure, get_value(baseline[key]), get_value(result)))
+    return regressions
+
+def load_json(path, default):
+    if not os.path.exists(path): return default
+    with open(path) as json_file:
+        return json.load(json_file, object_pairs_hook = OrderedDict)
+
+def save_json(path, obj):
+    """Atomically write obj to path as JSON."""
+    fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(path)), suffix = '.tmp')
+    with os.fdopen(fd, 'w') as json_file:
+        json.dump(obj, json_file, indent = 1)
+    os.rename(tmp_path, path)
+
+def record_run(results, bench_folder = BENCH_FOLDER, save_baseline = False, tolerance = TOLERANCE):
+    """Append results to results.json in bench_folder, compare them with baseline.json, and return the regressions.
+
+    If save_baseline is True, the results replace the baseline entries of the same benchmarks instead.
+
+    """
+    if not os.path.exists(bench_folder):
+        os.makedirs(bench_folder)
+    run = OrderedDict([('time', time.strftime('%Y-%m-%dT%H:%M:%S')), ('commit', git_commit()),
+                       ('host', platform.node()), ('python', platform.python_version()),
+                       ('numpy', np.__version__), ('results', results)])
+    results_path = os.path.join(bench_folder, 'results.json')
+    save_json(results_path, load_json(results_path, []) + [run])
+    baseline_path = os.path.join(bench_folder, 'baseline.json')
+    baseline = load_json(baseline_path, OrderedDict())
+    if save_baseline:
+        baseline.update(results)
+        save_json(baseline_path, baseline)
+        return []
+    return find_regressions(results, baseline, tolerance = tolerance)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmark the TL project.')
+    parser.add_argument('names', nargs = '*', help = 'benchmarks to run (default: all of ' + ', '.join(benchmarks) + ')')
+    parser.add_argument('--group', choices = ['sampling', 'io', 'postprocess'], help = 'only run the benchmarks of one group')
+    parser.add_argument('--sample-sizes', type = int, nargs = '+', default = SAMPLE_SIZES, help = 'numbers of samples')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'repeats per benchmark, of which the best time is kept')
+    parser.add_argument('--folder', default = BENCH_FOLDER, help = 'folder of results.json and baseline.json')
+    parser.add_argument('--tolerance', type = float, default = TOLERANCE, help = 'relative increase flagged as a regression')
+    parser.add_argument('--save-baseline', action = 'store_true', help = 'save the results as the new baseline')
+    parser.add_argument('--worker', metavar = 'NAME', help = argparse.SUPPRESS) # Run one benchmark, see run_worker()
+    parser.add_argument('--combo', type = int, nargs = 2, help = argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        run_worker(args.worker, args.sample_sizes[0], args.combo, args.repeat)
+        sys.exit()
+    unknown = [name for name in args.names if name not in benchmarks]
+    if unknown: parser.error('unknown benchmarks: ' + ', '.join(unknown))
+    names = args.names or list(benchmarks)
+    if args.group: names = [name for name in names if benchmarks[name][0] == args.group]
+    results = run_benchmarks(names, sample_sizes = args.sample_sizes, repeat = args.repeat)
+    regressions = record_run(results, bench_folder = args.folder, save_baseline = args.save_baseline,
+                             tolerance = args.tolerance)
+    for key, measure, old, new in regressions:
+        print 'Regression:', key, measure, round(old, 4), '->', round(new, 4)
+    if regressions: sys.exit(1)
@@ -1,28 +1,713 @@
-"""Module with functions to carry out analyses for the TL project"""
+"""Module with functions to carry out analyses for the TL project
+
+Only NumPy and the standard library are imported with the module. SciPy, statsmodels, pypartitions
+and matplotlib are imported on first use (see LazyModule), so that worker processes that only
+sample partitions or compositions start quickly.
+
+"""
 from __future__ import division, with_statement
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from mpl_toolkits.axes_grid.inset_locator import inset_axes
-import pypartitions as parts
-from macroecotools import AICc
 import numpy as np
-import scipy
-from scipy import stats
-import scikits.statsmodels.api as sm
+import importlib
 import random
 import csv
 import signal
-from pyper import *
+import time
+import os
+import sys
+import tempfile
+import shutil
+import cPickle
+import hashlib
+import fcntl
+import urllib
+import multiprocessing
+import resource
+import json
+from StringIO import StringIO
+from collections import OrderedDict
+from decimal import Decimal
 from contextlib import contextmanager
 
 # Define constants
 Q_MIN = 5 # Minimal Q for a (Q, N) combo to be included 
 N_MIN = 3 # Minimal N for a (Q, N) combo to be included
 n_MIN = 5 # Minimal number of valid points in a study to be included 
+EXACT_MAX_CELLS = 5 * 10 ** 8 # Maximal number of (q, n, sum of squares) cells updated by the exact variance engine
+EXACT_MAX_STATES = 2 * 10 ** 7 # Maximal number of cells held in memory by the exact variance engine (8 bytes each)
+KDE_BINNED_MIN = 10 ** 4 # Minimal number of values for comp_dens() to use the binned KDE instead of stats.gaussian_kde
 
 class TimeoutException(Exception): pass
 
+class LazyModule(object):
+    """Stand-in for a module that is imported on first attribute access.
+
+    setup, if given, is called right before the import, e.g. to select the matplotlib backend.
+
+    """
+    def __init__(self, name, setup = None):
+        self._name = name
+        self._setup = setup
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            if self._setup is not None: self._setup()
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+def use_agg():
+    import matplotlib
+    matplotlib.use('Agg')
+
+plt = LazyModule('matplotlib.pyplot', setup = use_agg)
+parts = LazyModule('pypartitions')
+stats = LazyModule('scipy.stats')
+sm = LazyModule('scikits.statsmodels.api')
+aicc = LazyModule('TL_aicc')
+
+def analysis_name(analysis, comp_method = 'legacy'):
+    """Name of an analysis in file names and keys, e.g. 'partition' or 'composition_legacy'."""
+    if analysis == 'partition': return analysis
+    else: return analysis + '_' + comp_method
+
+def spawn_seed(seed, *key):
+    """Derive the seed of the task identified by key from a master seed, or return None if seed is None.
+
+    As with the spawn() method of numpy's SeedSequence, child seeds are obtained by hashing the master seed
+    with the key, so they are statistically independent of each other and do not depend on the order
+    in which tasks are run or on the number of worker processes.
+
+    """
+    if seed is None: return None
+    return int(hashlib.sha256(repr((seed, ) + key)).hexdigest()[:8], 16)
+
+def seed_rngs(seed):
+    """Seed both random number generators used in sampling: numpy's, and the random module used by pypartitions."""
+    np.random.seed(seed)
+    random.seed(seed)
+
+@contextmanager
+def saved_rng_state(active = True):
+    """Restore the state of both random number generators seeded by seed_rngs() on exit, if active is True."""
+    if not active:
+        yield
+        return
+    np_state, py_state = np.random.get_state(), random.getstate()
+    try:
+        yield
+    finally:
+        np.random.set_state(np_state)
+        random.setstate(py_state)
+
+def replace_file(tmp_path, path):
+    """Rename tmp_path, written with tempfile.mkstemp(), over path.
+
+    mkstemp() creates files readable by their owner only, so tmp_path first gets the mode of the file it replaces,
+    or that of a file created with open() if there is none.
+
+    """
+    if os.path.exists(path):
+        shutil.copymode(path, tmp_path)
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0666 & ~umask)
+    os.rename(tmp_path, path)
+
+class PartitionCountCache(object):
+    """Process-wide cache of the partition-count tables used by pypartitions, keyed by (q, n).
+
+    pypartitions memoizes the number of partitions in the dictionary passed to rand_partitions().
+    The tables are kept in memory in least-recently-used order and evicted once the total number of
+    memoized counts exceeds max_entries. If cache_dir is given, tables are also pickled to disk,
+    so that later runs and other worker processes can start from a filled table.
+
+    """
+    def __init__(self, max_entries = 10 ** 7, cache_dir = None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.tables = OrderedDict()
+        self.sizes = {}
+
+    def _path(self, q, n):
+        return os.path.join(self.cache_dir, 'partition_counts_' + str(q) + '_' + str(n) + '.pkl')
+
+    def get(self, q, n):
+        """Return the (possibly empty) count table for (q, n), loading it from disk if needed."""
+        key = (q, n)
+        if key in self.tables:
+            table = self.tables.pop(key)
+        elif self.cache_dir and os.path.exists(self._path(q, n)):
+            with open(self._path(q, n), 'rb') as table_file:
+                table = cPickle.load(table_file)
+            self.sizes[key] = len(table)
+        else:
+            table = {}
+            self.sizes[key] = 0
+        self.tables[key] = table # Most recently used table goes to the end
+        return table
+
+    def update(self, q, n):
+        """Record that the table for (q, n) has been used and may have grown.
+
+        New entries are written to disk if cache_dir is set, then least-recently-used
+        tables are evicted until the in-memory size is back under max_entries.
+
+        """
+        key = (q, n)
+        if key not in self.tables: return
+        table = self.tables[key]
+        if len(table) > self.sizes[key] and self.cache_dir:
+            self.save(q, n)
+        self.sizes[key] = len(table)
+        while len(self.tables) > 1 and sum(self.sizes[k] for k in self.tables) > self.max_entries:
+            old_key, old_table = self.tables.popitem(last = False)
+            del self.sizes[old_key]
+
+    def save(self, q, n):
+        """Atomically write the table for (q, n) to cache_dir."""
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        fd, tmp_path = tempfile.mkstemp(dir = self.cache_dir, suffix = '.tmp')
+        with os.fdopen(fd, 'wb') as tmp_file:
+            cPickle.dump(self.tables[(q, n)], tmp_file, cPickle.HIGHEST_PROTOCOL)
+        replace_file(tmp_path, self._path(q, n))
+
+    def clear(self):
+        self.tables = OrderedDict()
+        self.sizes = {}
+
+partition_counts = PartitionCountCache()
+
+def set_partition_count_cache(max_entries = 10 ** 7, cache_dir = None):
+    """Replace the process-wide partition-count cache, e.g. to enable the on-disk copy."""
+    global partition_counts
+    partition_counts = PartitionCountCache(max_entries = max_entries, cache_dir = cache_dir)
+    return partition_counts
+
+class SamplingBudget(object):
+    """Cooperative time budget for a sampling loop.
+
+    Unlike time_limit(), which relies on SIGALRM and therefore only works in the main thread,
+    the sampling loop polls expired() between draws, so a budget can be used in any thread
+    or worker process. The number of samples drawn is recorded with add() to report a rate.
+
+    """
+    def __init__(self, t_limit = None):
+        self.t_limit = t_limit
+        self.start = time.time()
+        self.n_drawn = 0
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def expired(self):
+        return self.t_limit is not None and self.elapsed() >= self.t_limit
+
+    def remaining(self):
+        """Seconds left, or None without a time limit."""
+        if self.t_limit is None: return None
+        return self.t_limit - self.elapsed()
+
+    def add(self, count = 1):
+        self.n_drawn += count
+
+    def rate(self):
+        """Samples drawn per second so far."""
+        elapsed = self.elapsed()
+        if elapsed > 0: return self.n_drawn / elapsed
+        else: return float('inf')
+
+class SampleCache(object):
+    """Content-addressed cache of simulated variances, shared across studies and runs.
+
+    The variances drawn for a (Q, N) combo depend only on Q, N, the analysis (with comp_method for
+    compositions, and whether the exact engine was used), the sample size and the seed, and not on the study,
+    so they are stored under a hash of these (see key()). Only seeded variances are cached, as every
+    unseeded draw has to be independent of the others (see get_var_for_Q_N()). Entries are kept in memory up to max_memory_bytes,
+    and as .npy files in cache_dir if it is given, so that reruns and other worker processes reuse them.
+    Once the files in cache_dir exceed max_bytes, the least recently used ones (by modification time,
+    which is refreshed on every hit) are removed.
+
+    """
+    def __init__(self, cache_dir = None, max_bytes = 2 * 10 ** 9, max_memory_bytes = 10 ** 8):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self.entries = OrderedDict()
+        self.memory_bytes = 0
+
+    def key(self, q, n, analysis, sample_size, seed = None, comp_method = 'legacy', exact = True):
+        """Hash identifying the variances of one (Q, N) combo."""
+        name = analysis_name(analysis, comp_method)
+        if exact and exact_feasible(q, n, analysis, comp_method = comp_method): name += '_exact'
+        return hashlib.sha1(repr((int(q), int(n), name, int(sample_size), seed))).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def __contains__(self, key):
+        return key in self.entries or bool(self.cache_dir) and os.path.exists(self._path(key))
+
+    def get(self, key):
+        """Return the cached variances for key, or None if there are none."""
+        if key in self.entries:
+            QN_var = self.entries.pop(key)
+            self.entries[key] = QN_var # Most recently used entry goes to the end
+        elif self.cache_dir and os.path.exists(self._path(key)):
+            try:
+                QN_var = np.load(self._path(key))
+                os.utime(self._path(key), None)
+            except (IOError, OSError, ValueError): # Removed or still being written by another process
+                return None
+            self._keep(key, QN_var)
+        else: return None
+        return QN_var
+
+    def put(self, key, QN_var):
+        """Cache the variances for key, writing them atomically to cache_dir if it is set."""
+        QN_var = np.array(QN_var, dtype = float)
+        self._keep(key, QN_var)
+        if self.cache_dir:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            fd, tmp_path = tempfile.mkstemp(dir = self.cache_dir, suffix = '.tmp')
+            with os.fdopen(fd, 'wb') as tmp_file:
+                np.save(tmp_file, QN_var)
+            replace_file(tmp_path, self._path(key))
+            self.evict()
+
+    def _keep(self, key, QN_var):
+        if key in self.entries:
+            self.memory_bytes -= self.entries.pop(key).nbytes
+        self.entries[key] = QN_var
+        self.memory_bytes += QN_var.nbytes
+        while len(self.entries) > 1 and self.memory_bytes > self.max_memory_bytes:
+            old_key, old_var = self.entries.popitem(last = False)
+            self.memory_bytes -= old_var.nbytes
+
+    def evict(self):
+        """Remove the least recently used files from cache_dir until they fit in max_bytes."""
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npy'): continue
+            try:
+                file_stat = os.stat(os.path.join(self.cache_dir, name))
+            except OSError: continue # Removed by another process
+            files.append((file_stat.st_mtime, file_stat.st_size, name))
+        total = sum(size for mtime, size, name in files)
+        for mtime, size, name in sorted(files):
+            if total <= self.max_bytes: break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError: pass
+            total -= size
+
+    def clear(self):
+        self.entries = OrderedDict()
+        self.memory_bytes = 0
+
+sample_cache = SampleCache()
+
+def set_sample_cache(cache_dir = None, max_bytes = 2 * 10 ** 9, max_memory_bytes = 10 ** 8):
+    """Replace the process-wide sample cache, e.g. to enable the on-disk copy."""
+    global sample_cache
+    sample_cache = SampleCache(cache_dir = cache_dir, max_bytes = max_bytes, max_memory_bytes = max_memory_bytes)
+    return sample_cache
+
+class CostModel(object):
+    """Predicts how long sampling a (Q, N) combo takes, calibrated from recorded timings.
+
+    For each analysis, the log of the time per sample drawn is modeled as a linear function of log(Q),
+    log(N) and their product, fitted by least squares to the timings passed to record(). Combos handled by
+    the exact variance engine are modeled separately, with time proportional to the number of cells updated
+    by the dynamic program (see exact_dp_size()). The time taken to fill the partition-count table of a combo
+    on its first draw, which cannot be interrupted, is modeled like the time per sample, as mode 'table'
+    (see table_over_budget()). Until min_timings timings have been recorded, rough default
+    coefficients are used, which are good enough to rank combos but not to decide whether one fits a budget.
+    If path is given, timings are appended to it as they are recorded, one line each so that several
+    worker processes can share the file, and read back when the model is created, skipping malformed lines.
+
+    """
+    default_coefs = {'sample': np.array([np.log(10 ** -6), 1, 0.5, 0]), 'exact': np.log(10 ** -8),
+                     'table': np.array([np.log(10 ** -7), 2, 1, 0])}
+
+    def __init__(self, path = None, min_timings = 10):
+        self.path = path
+        self.min_timings = min_timings
+        self.timings = {} # Lists of (q, n, count, seconds), keyed by (analysis name, mode)
+        self.coefs = {}
+        if path and os.path.exists(path):
+            with open(path) as timing_file:
+                for line in timing_file:
+                    try:
+                        name, mode, q, n, count, seconds = line.split()
+                        timing = (int(q), int(n), int(count), float(seconds))
+                    except ValueError: continue # Torn line left by a worker killed while writing it
+                    self.timings.setdefault((name, mode), []).append(timing)
+
+    def record(self, q, n, analysis, mode, count, seconds, comp_method = 'legacy'):
+        """Record that drawing count samples (mode 'sample'), building the exact distribution
+        
+        (mode 'exact', count = 1) or filling the partition-count table (mode 'table', count = 1)
+        of (q, n) took the given number of seconds.
+        
+        """
+        if count <= 0 or seconds <= 0: return
+        key = (analysis_name(analysis, comp_method), mode)
+        self.timings.setdefault(key, []).append((q, n, count, seconds))
+        self.coefs.pop(key, None)
+        if self.path:
+            with open(self.path, 'a') as timing_file:
+                print>>timing_file, key[0], mode, q, n, count, repr(seconds)
+
+    def calibrated(self, analysis, mode = 'sample', comp_method = 'legacy'):
+        """Whether predictions for analysis and mode are based on enough recorded timings."""
+        return len(self.timings.get((analysis_name(analysis, comp_method), mode), [])) >= self.min_timings
+
+    def _fit(self, analysis, mode, comp_method):
+        key = (analysis_name(analysis, comp_method), mode)
+        if key not in self.coefs:
+            if not self.calibrated(analysis, mode, comp_method = comp_method):
+                self.coefs[key] = self.default_coefs[mode]
+            else:
+                q, n, count, seconds = np.array(self.timings[key], dtype = float).T
+                if mode != 'exact':
+                    log_q, log_n = np.log(q), np.log(n)
+                    X = np.column_stack((np.ones(len(q)), log_q, log_n, log_q * log_n))
+                    self.coefs[key] = np.linalg.lstsq(X, np.log(seconds / count), rcond = -1)[0]
+                else:
+                    cells = np.array([exact_dp_size(int(q_i), int(n_i), analysis)[0] for q_i, n_i in zip(q, n)])
+                    self.coefs[key] = np.mean(np.log(seconds / cells))
+        return self.coefs[key]
+
+    def predict(self, q, n, analysis = 'partition', sample_size = 1000, comp_method = 'legacy', exact = True):
+        """Predicted number of seconds needed by get_var_for_Q_N() to draw sample_size variances for (q, n)."""
+        if exact and exact_feasible(q, n, analysis, comp_method = comp_method):
+            coef = self._fit(analysis, 'exact', comp_method)
+            return np.exp(coef) * exact_dp_size(q, n, analysis)[0]
+        coefs = self._fit(analysis, 'sample', comp_method)
+        log_q, log_n = np.log(q), np.log(n)
+        return sample_size * np.exp(np.dot(coefs, [1, log_q, log_n, log_q * log_n]))
+
+    def table_over_budget(self, q, n, t_limit):
+        """Whether filling the partition-count table of (q, n) is predicted to take more than t_limit seconds,
+
+        judged only from calibrated predictions.
+
+        """
+        if t_limit is None or not self.calibrated('partition', 'table'):
+            return False
+        log_q, log_n = np.log(q), np.log(n)
+        return np.exp(np.dot(self._fit('partition', 'table', 'legacy'), [1, log_q, log_n, log_q * log_n])) > t_limit
+
+    def over_budget(self, q, n, t_limit, analysis = 'partition', sample_size = 1000, comp_method = 'legacy',
+                    exact = True):
+        """Whether (q, n) is predicted to need more than t_limit seconds, judged only from calibrated predictions."""
+        mode = 'exact' if exact and exact_feasible(q, n, analysis, comp_method = comp_method) else 'sample'
+        if t_limit is None or not self.calibrated(analysis, mode, comp_method = comp_method):
+            return False
+        return self.predict(q, n, analysis = analysis, sample_size = sample_size, comp_method = comp_method,
+                            exact = exact) > t_limit
+
+cost_model = CostModel()
+
+def set_cost_model(path = None, min_timings = 10):
+    """Replace the process-wide cost model, e.g. to record timings to and calibrate from a file."""
+    global cost_model
+    cost_model = CostModel(path = path, min_timings = min_timings)
+    return cost_model
+
+def peak_rss_mb():
+    """Peak resident set size of the current process in MB (ru_maxrss is in kB on Linux and in bytes on OS X)."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': return max_rss / 2 ** 20
+    return max_rss / 2 ** 10
+
+class Telemetry(object):
+    """Structured record of a run, written as one JSON object per line (JSONL) to path.
+
+    Each event has the fields 'event' (its type), 'time' (Unix time), 'worker' (name of the process),
+    'pid' and 'peak_rss_mb' (see peak_rss_mb()), plus the fields passed to emit(). Lines are appended
+    under an exclusive lock, so that worker processes can share the file. Without a path, events are dropped.
+    The events written by the analysis are:
+    combo - one Q-N combo of a study sampled by sample_combo(), with the fields study, Q, N, analysis, replicate,
+            sample_size, status ('complete', 'timeout', 'checkpoint' if read back from its checkpoint, or 'cached'
+            if served from sample_cache),
+            samples (number of variances drawn in this call), total (number of variances now available), seconds and rate
+    study - a study finished by sample_var() or run_pipeline(), with the fields study, analysis, status
+            ('written' or 'skipped') and, if skipped, failed (the [Q, N] pairs of the combos that timed out)
+    span - the wall time of a step (see span()), with the fields name, seconds and status ('ok' or 'error')
+    The events are summarized with TL_telemetry.py.
+
+    """
+    def __init__(self, path = None):
+        self.path = path
+
+    def emit(self, event, **fields):
+        if not self.path: return
+        record = OrderedDict([('event', event), ('time', time.time()),
+                              ('worker', multiprocessing.current_process().name), ('pid', os.getpid())])
+        record.update(sorted(fields.items()))
+        record['peak_rss_mb'] = peak_rss_mb()
+        line = json.dumps(record, default = to_json) + '\n'
+        with open(self.path, 'a') as event_file:
+            fcntl.flock(event_file, fcntl.LOCK_EX)
+            try:
+                event_file.write(line)
+            finally:
+                fcntl.flock(event_file, fcntl.LOCK_UN)
+
+    @contextmanager
+    def span(self, name, **fields):
+        """Emit a span event with the wall time of the enclosed block."""
+        start, status = time.time(), 'error'
+        try:
+            yield
+            status = 'ok'
+        finally:
+            self.emit('span', name = name, seconds = time.time() - start, status = status, **fields)
+
+def to_json(obj):
+    """Convert NumPy scalars in telemetry events to Python numbers."""
+    if isinstance(obj, np.generic): return obj.item()
+    raise TypeError(repr(obj) + ' is not JSON serializable')
+
+telemetry = Telemetry()
+
+def set_telemetry(path = None):
+    """Replace the process-wide telemetry, e.g. to write events to a file (None to drop them)."""
+    global telemetry
+    telemetry = Telemetry(path = path)
+    return telemetry
+
+class OutputSink(object):
+    """Buffered writer of the rows of one output file, one study at a time.
+
+    Rows are buffered in memory and flushed, once more than buffer_bytes are buffered or on close(),
+    to one shard file per study in <path>.shards/, each written in a single bulk write to a temporary file
+    that is then renamed into place, so that neither concurrent writers nor a crash can leave torn or
+    interleaved lines. merge() combines all shards in the folder, including those left by other processes
+    or by an interrupted run, with the rows already in path, atomically replaces path with the result,
+    and removes the folder, which only exists while there are shards to merge.
+    Writers of all output files in the folder of path are serialized by a lock on that folder.
+    Rows in the merged file are ordered by study (the first field of each row), keeping the order of rows
+    within a study, and the rows of a study in a shard replace its earlier rows in path,
+    so that the file does not depend on the order in which studies were finished.
+    append() instead adds the rows of a study that is not yet in path to its end, without rewriting the file.
+
+    """
+    def __init__(self, path, buffer_bytes = 10 ** 7):
+        self.path = path
+        self.shard_dir = path + '.shards'
+        self.buffer_bytes = buffer_bytes
+        self.buffers = OrderedDict()
+        self.n_bytes = 0
+
+    def _shard_path(self, study):
+        return os.path.join(self.shard_dir, urllib.quote(str(study), safe = '') + '.txt')
+
+    @contextmanager
+    def _lock(self):
+        """Exclusive lock on the folder of path, so that no lock files are left behind."""
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd) # Releases the lock
+
+    def write(self, study, lines):
+        """Buffer lines (strings without the line break) as rows of study."""
+        lines = [line + '\n' for line in lines]
+        self.buffers.setdefault(study, []).extend(lines)
+        self.n_bytes += sum(len(line) for line in lines)
+        if self.n_bytes > self.buffer_bytes:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows to the shard files of their studies."""
+        if not self.buffers: return
+        with self._lock():
+            if not os.path.exists(self.shard_dir):
+                os.makedirs(self.shard_dir)
+            for study, lines in self.buffers.items():
+                shard_path = self._shard_path(study)
+                if os.path.exists(shard_path): # Rows written to the study by an earlier flush
+                    with open(shard_path) as shard_file:
+                        lines = shard_file.readlines() + lines
+                fd, tmp_path = tempfile.mkstemp(dir = self.shard_dir, suffix = '.tmp')
+                with os.fdopen(fd, 'w') as tmp_file:
+                    tmp_file.write(''.join(lines))
+                replace_file(tmp_path, shard_path)
+        self.buffers = OrderedDict()
+        self.n_bytes = 0
+
+    def append(self, study, lines):
+        """Append lines as rows of study to path in one write, unless path already has rows of study.
+
+        Returns whether the lines were appended. The appended study comes after the studies already in path,
+        and is put in order with them by the next merge().
+
+        """
+        with self._lock():
+            studies = studies_in_file(self.path)
+            if str(study) in studies: return False
+            with open(self.path, 'a') as out_file:
+                out_file.write(''.join(line + '\n' for line in lines))
+            studies.add(str(study))
+            stat = os.stat(self.path)
+            file_studies[self.path] = ((stat.st_size, stat.st_mtime), studies)
+        return True
+
+    def merge(self):
+        """Merge all shard files into path, then remove them and their folder."""
+        with self._lock():
+            if not os.path.isdir(self.shard_dir): return
+            shard_names = sorted(name for name in os.listdir(self.shard_dir) if name.endswith('.txt'))
+            if not shard_names:
+                shutil.rmtree(self.shard_dir)
+                return
+            rows = {}
+            if os.path.exists(self.path):
+                with open(self.path) as out_file:
+                    for line in out_file:
+                        if line.strip():
+                            rows.setdefault(line.split(None, 1)[0], []).append(line)
+            for name in shard_names:
+                with open(os.path.join(self.shard_dir, name)) as shard_file:
+                    rows[urllib.unquote(name[:-4])] = shard_file.readlines()
+            fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(self.path)), suffix = '.tmp')
+            with os.fdopen(fd, 'w') as tmp_file:
+                for study in sorted(rows):
+                    tmp_file.write(''.join(rows[study]))
+            replace_file(tmp_path, self.path)
+            shutil.rmtree(self.shard_dir) # Including temporary files of flushes interrupted before their rename
+
+    def close(self):
+        self.flush()
+        self.merge()
+
+output_sinks = None # OutputSink objects by output path while batch_output() is active
+file_studies = {} # Output path -> ((size, modification time), set of studies in the file)
+
+def studies_in_file(path):
+    """Set of the studies (first field of each row) in the output file at path, reread only once the file changes."""
+    if not os.path.exists(path): return set()
+    stat = os.stat(path)
+    if path not in file_studies or file_studies[path][0] != (stat.st_size, stat.st_mtime):
+        studies = set()
+        with open(path) as out_file:
+            for line in out_file:
+                if line.strip():
+                    studies.add(line.split(None, 1)[0])
+        file_studies[path] = ((stat.st_size, stat.st_mtime), studies)
+    return file_studies[path][1]
+
+def write_output(path, study, lines, flush = False):
+    """Write the rows of one study to the output file at path through an OutputSink.
+
+    Within batch_output(), the rows are collected by the sink of path and merged when the batch ends,
+    and flush makes sure that they are on disk in a shard file on return.
+    Otherwise the rows are appended to path if the study is not in it yet, and merged into path,
+    replacing the earlier rows of the study, if it is.
+
+    """
+    if output_sinks is None:
+        sink = OutputSink(path)
+        if not sink.append(study, lines):
+            sink.write(study, lines)
+            sink.close()
+    else:
+        if path not in output_sinks:
+            output_sinks[path] = OutputSink(path)
+        output_sinks[path].write(study, lines)
+        if flush: output_sinks[path].flush()
+
+def merge_outputs(out_folder):
+    """Merge the shard files left in out_folder, e.g. by an interrupted run, into their output files."""
+    if not os.path.isdir(out_folder): return
+    for name in sorted(os.listdir(out_folder)):
+        if name.endswith('.shards') and os.path.isdir(os.path.join(out_folder, name)):
+            OutputSink(os.path.join(out_folder, name[:-len('.shards')])).merge()
+
+def flush_outputs():
+    """Write the rows collected so far by batch_output() to their shard files, so that they survive a crash."""
+    if output_sinks is not None:
+        for sink in output_sinks.values():
+            sink.flush()
+
+@contextmanager
+def batch_output():
+    """Collect the rows written with write_output() in this process, and merge them into their files on exit."""
+    global output_sinks
+    if output_sinks is not None: # Already batching
+        yield
+        return
+    output_sinks = {}
+    try:
+        yield
+    finally:
+        sinks, output_sinks = output_sinks, None
+        for sink in sinks.values():
+            sink.close()
+
+class StudyGroups(object):
+    """Records of a data array grouped by study.
+
+    The records are sorted once by study (stably, so the order within a study is kept),
+    after which the records of each study are a contiguous slice that is looked up in O(1).
+    Functions that take a data array with a 'study' field also accept a StudyGroups object.
+    Input:
+    data - any structured array with a 'study' field, e.g. from get_QN_mean_var_data() or get_var_sample_file()
+
+    """
+    def __init__(self, data):
+        if isinstance(data, StudyGroups):
+            data = data.data
+        study = data['study']
+        if len(study) > 1 and np.any(study[1:] < study[:-1]):
+            data = data[np.argsort(study, kind = 'mergesort')]
+        self.data = data
+        self.studies, starts = np.unique(data['study'], return_index = True)
+        ends = list(starts[1:]) + [len(data)]
+        self.slices = dict((study, slice(start, end)) for study, start, end in zip(self.studies, starts, ends))
+    
+    @property
+    def dtype(self):
+        return self.data.dtype
+    
+    def __getitem__(self, study):
+        return self.data[self.slices[study]]
+    
+    def __contains__(self, study):
+        return study in self.slices
+    
+    def __iter__(self):
+        return iter(self.studies)
+    
+    def __len__(self):
+        return len(self.studies)
+
+def group_by_study(data):
+    """Return data as a StudyGroups object, building the index only if needed."""
+    if isinstance(data, StudyGroups):
+        return data
+    return StudyGroups(data)
+
+def get_study(data, study):
+    """Return the records of one study from either a StudyGroups object or a plain data array."""
+    if isinstance(data, StudyGroups):
+        if study in data: return data[study]
+        else: return data.data[:0]
+    return data[data['study'] == study]
+
+def get_study_type(study_info, study):
+    """Type (spatial or temporal) of a study in the records read by get_study_info(), or None if it is missing."""
+    info = get_study(study_info, study)
+    if len(info): return info['type'][0]
+    return None
+
 @contextmanager
 def time_limit(seconds):
     """Function to skip step after given time"""
@@ -36,26 +721,344 @@ def time_limit(seconds):
         signal.alarm(0)
 
 def get_QN_mean_var_data(data_dir):
-    """Read in data file with study, Q, and N"""
+    """Read in data file with study, Q, and N
+
+    If data_dir is one of the input files of the compiled dataset (see compile_dataset()), the records
+    are taken from the dataset, which is rebuilt first if any of its input files has changed.
+
+    """
+    dataset = find_dataset(data_dir)
+    if dataset is not None:
+        return dataset_QN_data(dataset, data_dir)
     data = np.genfromtxt(data_dir, dtype = 'S25, i15, i15, f15, f15', delimiter = '\t', 
                          names = ['study', 'Q', 'N', 'mean', 'var'])
     return data
 
 def get_study_info(data_dir):
-    """Read in data file with study, taxon, and type"""
+    """Read in data file with study, taxon, and type
+
+    As with get_QN_mean_var_data(), the records are taken from the compiled dataset if data_dir is one of its inputs.
+
+    """
+    dataset = find_dataset(data_dir)
+    if dataset is not None:
+        return dataset_study_info(dataset)
     data = np.genfromtxt(data_dir, dtype = 'S25, S25, S25', delimiter = '\t',
                           names = ['study', 'taxon', 'type'])
     return data
 
-def get_var_sample_file(data_dir, sample_size = 1000):
-    """Read in the file generated by the function sample_var()"""
+def get_study_sources(data_dir):
+    """Source metadata of each study (see compile_dataset()), given the file with study, taxon, and type
+
+    As with get_study_info(), the records are taken from the compiled dataset if data_dir is one of its inputs.
+    Otherwise they are joined from DATASET_SOURCES in the folder of data_dir, and without that file
+    every study has source and sp_id -1.
+
+    """
+    dataset = find_dataset(data_dir)
+    if dataset is not None:
+        return dataset_study_sources(dataset)
+    info = read_tsv(data_dir, 3)
+    sources_dir = os.path.join(os.path.dirname(data_dir), DATASET_SOURCES)
+    studies, taxa, types = study_records(info, read_sources(sources_dir, info))
+    return studies[['study', 'source', 'sp_id', 'paper', 'sp', 'ecological', 'significance']]
+
+DATASET_NAME = 'TL_dataset.npz' # Compiled dataset, saved in the folder of its input files
+DATASET_VERSION = 2 # Version of the layout of the compiled dataset, datasets of other versions are rebuilt
+DATASET_DATA = ['data_literature.txt', 'data_Glenda.txt']
+DATASET_INFO = 'study_taxon_type.txt'
+DATASET_SOURCES = 'data_sources.txt'
+FLAG_MEAN = 1 # Validation flag of an observation whose mean differs from Q / N
+FLAG_VAR = 2 # Validation flag of an observation whose variance is outside [0, Q ** 2 / N]
+
+def read_tsv(data_dir, n_col, header = False):
+    """Rows of a tab-delimited file as lists of n_col strings, padded with empty strings.
+
+    Rows with more than n_col non-empty fields raise ValueError.
+
+    """
+    rows = []
+    with open(data_dir) as data_file:
+        reader = csv.reader(data_file, delimiter = '\t')
+        if header: next(reader)
+        for row in reader:
+            if not any(field.strip() for field in row): continue
+            row = [field.strip() for field in row]
+            while len(row) > n_col and not row[-1]: row.pop()
+            if len(row) > n_col:
+                raise ValueError(data_dir + ', line ' + str(reader.line_num) + ': expected ' + str(n_col) + ' fields')
+            rows.append(row + [''] * (n_col - len(row)))
+    return rows
+
+def rounding_error(text_values):
+    """Half a unit in the last digit of each number as written, the largest error from rounding it."""
+    return np.array([0.5 * 10.0 ** Decimal(x).as_tuple().exponent for x in text_values])
+
+def validate_QN_data(Q, N, mean, var, mean_error = 0, var_error = 0, rtol = 1e-6):
+    """Validation flags of observations (sum of FLAG_MEAN and FLAG_VAR, 0 for consistent observations).
+
+    The mean should equal Q / N, and the variance (with N - 1 in the denominator) should lie between 0 and
+    Q ** 2 / N, its value when all of Q is in one of the N units; both up to the rounding errors of mean and var
+    (see rounding_error()) and a relative tolerance of rtol.
+    Observations that cannot be checked at all (N < 1, Q < 0, or values that are not finite) raise ValueError.
+
+    """
+    Q, N = np.asarray(Q, dtype = float), np.asarray(N, dtype = float)
+    mean, var = np.asarray(mean, dtype = float), np.asarray(var, dtype = float)
+    invalid = (N < 1) | (Q < 0) | ~np.isfinite(mean) | ~np.isfinite(var)
+    if np.any(invalid):
+        raise ValueError('invalid observations in rows ' + ', '.join(map(str, np.nonzero(invalid)[0][:10])))
+    flags = np.zeros(len(Q), dtype = '<i2')
+    flags[np.abs(mean - Q / N) > mean_error + rtol * Q / N] += FLAG_MEAN
+    flags[(var < -var_error) | (var > Q ** 2 / N * (1 + rtol) + var_error)] += FLAG_VAR
+    return flags
+
+def categorical(values):
+    """Categories (sorted) and integer codes of values."""
+    categories, codes = np.unique(np.asarray(values, dtype = 'S'), return_inverse = True)
+    return categories, codes.astype('<i2')
+
+def read_sources(sources_dir, info):
+    """Row of sources_dir (8 fields) for each study in info (rows of study, taxon, type),
+
+    or a row with source and sp_id -1 for studies without a source or if sources_dir does not exist.
+
+    """
+    sources = {}
+    if os.path.exists(sources_dir):
+        for row in read_tsv(sources_dir, 8, header = True): # The last column is unnamed notes
+            sources[row[0] + '_' + row[2]] = row
+    return [sources.get(row[0], ['-1', '', '-1', '', '', '', '', '']) for row in info]
+
+def study_records(info, source_rows):
+    """Studies array of the compiled dataset (see compile_dataset()), with the taxa and types its codes refer to."""
+    taxa, taxon_codes = categorical([row[1] for row in info])
+    types, type_codes = categorical([row[2] for row in info])
+    str_len = lambda values: max([1] + [len(x) for x in values])
+    studies = np.zeros(len(info), dtype = [('study', 'S25'), ('taxon', '<i2'), ('type', '<i2'), ('source', '<i4'),
+                                           ('sp_id', '<i4'),
+                                           ('paper', 'S' + str(str_len([row[1] for row in source_rows]))),
+                                           ('sp', 'S' + str(str_len([row[3] for row in source_rows]))),
+                                           ('ecological', 'S8'), ('significance', 'S8')])
+    studies['study'] = [row[0] for row in info]
+    studies['taxon'], studies['type'] = taxon_codes, type_codes
+    for field, col in [('source', 0), ('sp_id', 2), ('paper', 1), ('sp', 3), ('ecological', 4), ('significance', 6)]:
+        studies[field] = [row[col] for row in source_rows]
+    return studies, taxa, types
+
+def compile_dataset(folder = '.', data_names = DATASET_DATA, info_name = DATASET_INFO, sources_name = DATASET_SOURCES,
+                    verbose = True):
+    """Validate the input files in folder and save them as one compiled dataset (DATASET_NAME in folder).
+
+    The dataset is an .npz file with the arrays:
+    obs - one record per row of the files in data_names, with the fields study_id (index into studies), dataset
+          (index into datasets), Q, N, mean, var, log_mean, log_var (-inf where mean or var is 0)
+          and flags (see validate_QN_data())
+    studies - one record per study of info_name, with the fields study, taxon and type (indices into taxa and types),
+              and the metadata of the study in sources_name: source, sp_id, paper, sp, ecological and significance.
+              Study 'S_k' is species k (sp_id) of source S; studies without a source have source and sp_id -1.
+    datasets, taxa, types - names of the data files, taxa and types
+    inputs - names of all input files, from which the dataset is rebuilt by load_dataset() whenever one of them changes
+    version - DATASET_VERSION
+    Studies in the data files that are missing from info_name raise ValueError. Observations failing validation are
+    kept, flagged, and reported if verbose is True.
+
+    """
+    info = read_tsv(os.path.join(folder, info_name), 3)
+    study_index = dict((row[0], i) for i, row in enumerate(info))
+    if len(study_index) < len(info):
+        raise ValueError(info_name + ': duplicate studies')
+    sources_dir = os.path.join(folder, sources_name)
+    if not os.path.exists(sources_dir):
+        raise IOError(sources_dir + ' not found')
+    studies, taxa, types = study_records(info, read_sources(sources_dir, info))
+
+    obs = []
+    for i_data, data_name in enumerate(data_names):
+        rows = read_tsv(os.path.join(folder, data_name), 5)
+        missing = sorted(set(row[0] for row in rows if row[0] not in study_index))
+        if missing:
+            raise ValueError(data_name + ': studies missing from ' + info_name + ': ' + ', '.join(missing))
+        obs_data = np.zeros(len(rows), dtype = [('study_id', '<i4'), ('dataset', '<i2'), ('Q', '<i8'), ('N', '<i8'),
+                                                ('mean', '<f8'), ('var', '<f8'), ('log_mean', '<f8'),
+                                                ('log_var', '<f8'), ('flags', '<i2')])
+        obs_data['study_id'] = [study_index[row[0]] for row in rows]
+        obs_data['dataset'] = i_data
+        for field, col in [('Q', 1), ('N', 2), ('mean', 3), ('var', 4)]:
+            obs_data[field] = [row[col] for row in rows]
+        with np.errstate(divide = 'ignore'):
+            obs_data['log_mean'], obs_data['log_var'] = np.log(obs_data['mean']), np.log(obs_data['var'])
+        obs_data['flags'] = validate_QN_data(obs_data['Q'], obs_data['N'], obs_data['mean'], obs_data['var'],
+                                             mean_error = rounding_error([row[3] for row in rows]),
+                                             var_error = rounding_error([row[4] for row in rows]))
+        for flag, desc in [(FLAG_MEAN, 'mean differs from Q / N'), (FLAG_VAR, 'var is outside [0, Q ** 2 / N]')]:
+            flagged = obs_data[(obs_data['flags'] & flag) > 0]
+            if verbose and len(flagged):
+                print data_name + ':', len(flagged), 'rows whose', desc, 'in studies', \
+                      ', '.join(sorted(set(studies['study'][flagged['study_id']])))
+        obs.append(obs_data)
+
+    path = os.path.join(folder, DATASET_NAME)
+    fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(path)), suffix = '.tmp')
+    with os.fdopen(fd, 'wb') as tmp_file:
+        np.savez(tmp_file, obs = np.concatenate(obs), studies = studies, datasets = np.array(data_names, dtype = 'S'),
+                 taxa = taxa, types = types, inputs = np.array(list(data_names) + [info_name, sources_name], dtype = 'S'),
+                 version = DATASET_VERSION)
+    replace_file(tmp_path, path)
+
+def load_dataset(folder = '.'):
+    """Load the compiled dataset in folder as a dict of arrays (see compile_dataset()).
+
+    The dataset is compiled first if it does not exist, or if it is older than any of its input files
+    or has another layout version, and the input files are all there to rebuild it from. Such rebuilds are quiet; call compile_dataset() directly
+    to see the observations that fail validation.
+
+    """
+    path = os.path.join(folder, DATASET_NAME)
+    if os.path.exists(path):
+        with np.load(path) as npz_file:
+            dataset = dict((name, npz_file[name]) for name in npz_file.files)
+        input_paths = [os.path.join(folder, name) for name in dataset['inputs']]
+        if not all(os.path.exists(x) for x in input_paths) or \
+           (all(os.path.getmtime(x) <= os.path.getmtime(path) for x in input_paths) and
+            dataset.get('version') == DATASET_VERSION):
+            return dataset
+        compile_dataset(folder, data_names = list(dataset['datasets']), verbose = False)
+    else: compile_dataset(folder, verbose = False)
+    return load_dataset(folder)
+
+def find_dataset(data_dir):
+    """The compiled dataset in the folder of data_dir if data_dir is one of its input files, None otherwise.
+
+    Without a compiled dataset in the folder, one is only compiled if all the default input files are there.
+
+    """
+    folder, name = os.path.split(data_dir)
+    folder = folder or '.'
+    inputs = DATASET_DATA + [DATASET_INFO, DATASET_SOURCES]
+    if not os.path.exists(os.path.join(folder, DATASET_NAME)) and \
+       (name not in inputs or not all(os.path.exists(os.path.join(folder, x)) for x in inputs)):
+        return None
+    dataset = load_dataset(folder)
+    if name not in dataset['inputs']: return None
+    return dataset
+
+def dataset_QN_data(dataset, data_name):
+    """Records of one data file of the compiled dataset, in the format of get_QN_mean_var_data()."""
+    obs = dataset['obs'][dataset['obs']['dataset'] == list(dataset['datasets']).index(os.path.basename(data_name))]
+    data = np.zeros(len(obs), dtype = [('study', 'S25'), ('Q', '<i8'), ('N', '<i8'), ('mean', '<f8'), ('var', '<f8')])
+    data['study'] = dataset['studies']['study'][obs['study_id']]
+    for field in ['Q', 'N', 'mean', 'var']:
+        data[field] = obs[field]
+    return data
+
+def dataset_study_info(dataset):
+    """Studies of the compiled dataset in the format of get_study_info()."""
+    studies = dataset['studies']
+    data = np.zeros(len(studies), dtype = [('study', 'S25'), ('taxon', 'S25'), ('type', 'S25')])
+    data['study'] = studies['study']
+    data['taxon'], data['type'] = dataset['taxa'][studies['taxon']], dataset['types'][studies['type']]
+    return data
+
+def dataset_study_sources(dataset):
+    """Studies of the compiled dataset with their source metadata, in the format of get_study_sources()."""
+    studies = dataset['studies']
+    return studies[['study', 'source', 'sp_id', 'paper', 'sp', 'ecological', 'significance']]
+
+def var_sample_dtype(sample_size = 1000):
+    """Record type of the binary version of the file generated by sample_var().
+
+    Each record holds the metadata (study, Q, N, mean, var) followed by the sample variances,
+    so that get_sample_matrix() can view the samples as a float64 matrix without copying.
+
+    """
     names_data = ['study', 'Q', 'N', 'mean', 'var']
     names_sample = ['sample'+str(i) for i in xrange(1, sample_size + 1)]
     names_data.extend(names_sample)
-    type_data = 'S15, i15, i15' + ',<f8'*(len(names_data) - 3)
-    data = np.genfromtxt(data_dir, delimiter = '\t', names = names_data, dtype = type_data)
+    formats = ['S15', '<i8', '<i8'] + ['<f8'] * (len(names_data) - 3)
+    return np.dtype({'names': names_data, 'formats': formats})
+
+def binary_path(data_dir):
+    """Path of the binary (.npy) version of a text output file."""
+    return os.path.splitext(data_dir)[0] + '.npy'
+
+def read_binary(data_dir, dtype):
+    """Memory-map the binary version of data_dir if it exists, is at least as recent as the text file,
+
+    and has the expected record type. Otherwise return None.
+
+    """
+    bin_dir = binary_path(data_dir)
+    if not os.path.exists(bin_dir) or bin_dir == data_dir:
+        return None
+    if os.path.exists(data_dir) and os.path.getmtime(bin_dir) < os.path.getmtime(data_dir):
+        return None
+    data = np.load(bin_dir, mmap_mode = 'r')
+    if data.dtype != dtype:
+        return None
+    return data
+
+def write_binary(data_dir, data):
+    """Atomically save data as the binary version of data_dir."""
+    bin_dir = binary_path(data_dir)
+    fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(bin_dir)), suffix = '.tmp')
+    with os.fdopen(fd, 'wb') as tmp_file:
+        np.save(tmp_file, data)
+    replace_file(tmp_path, bin_dir)
+
+def get_var_sample_file(data_dir, sample_size = 1000):
+    """Read in the file generated by the function sample_var()
+
+    If an up-to-date binary version created by convert_var_sample_file() exists, it is
+    memory-mapped instead of parsing the text file.
+
+    """
+    data = read_binary(data_dir, var_sample_dtype(sample_size))
+    if data is not None:
+        return data
+    data = np.genfromtxt(data_dir, delimiter = '\t', dtype = var_sample_dtype(sample_size))
     return data
 
+def convert_var_sample_file(data_dir, sample_size = 1000):
+    """Convert the text file generated by sample_var() into the binary format read by get_var_sample_file().
+
+    The binary file has the same name with the extension .npy.
+
+    """
+    data = get_var_sample_file(data_dir, sample_size = sample_size)
+    write_binary(data_dir, np.array(data, dtype = var_sample_dtype(sample_size)))
+
+def get_sample_matrix(dat_sample):
+    """Return the sample variances of records read by get_var_sample_file() as a (records x samples) matrix.
+
+    For contiguous records (including memory-mapped files and their slices) the matrix is a view.
+    The samples of a record are contiguous, but consecutive rows are one record (metadata included) apart,
+    so the view is not C-contiguous; pass it through np.ascontiguousarray() where a contiguous matrix is needed.
+
+    """
+    names_sample = dat_sample.dtype.names[5:]
+    if len(dat_sample) == 0:
+        return np.empty((0, len(names_sample)))
+    if not dat_sample.flags['C_CONTIGUOUS']:
+        dat_sample = np.ascontiguousarray(dat_sample)
+    offset = dat_sample.dtype.fields[names_sample[0]][1]
+    return np.ndarray((len(dat_sample), len(names_sample)), dtype = '<f8', buffer = dat_sample, offset = offset,
+                      strides = (dat_sample.dtype.itemsize, 8))
+
+def get_sample_size(dat_sample):
+    """Number of samples per record of dat_sample, in the format of get_var_sample_file() or a StudyGroups object."""
+    return len(dat_sample.dtype.names) - 5
+
+def output_path(out_folder, prefix, analysis, sample_size = 1000):
+    """Path of a post-processed output file, e.g. TL_form_partition.txt, or TL_form_partition_4000.txt
+
+    for results from 4000 samples, so that runs with different sample sizes do not replace each other's rows.
+
+    """
+    name = prefix + '_' + analysis
+    if sample_size != 1000: name += '_' + str(sample_size)
+    return out_folder + name + '.txt'
+
 def get_val_ind_sample_file(data_dir, sample_size = 1000):
     """Read in a file with 'study' as the first column, value from empirical TL as the second column,
     
@@ -70,13 +1073,49 @@ def get_val_ind_sample_file(data_dir, sample_size = 1000):
     return data
 
 def get_tl_par_file(data_dir):
-    """Read in the file generated by the function TL_form_sample()"""
-    type_data = 'S15' + ',f15' * 14
+    """Read in the file generated by the function TL_form_sample()
+    
+    Files written before the bootstrap confidence intervals of the empirical b and intercept were added
+    have 15 columns, and are read without the four CI columns. In files mixing both, e.g. after new studies
+    were merged into an older file, the CI columns of the older rows are read as nan.
+    A header row (starting with 'study') is skipped, and a file without rows gives an empty array.
+    
+    """
     names_data = ['study', 'b_obs', 'inter_obs', 'R2_obs', 'p_obs', 'b_expc', 'inter_expc', 'R2_expc', \
-                  'p_sample', 'b_z', 'b_lower', 'b_upper', 'inter_z', 'inter_lower', 'inter_upper']
-    data = np.genfromtxt(data_dir, delimiter = ' ', names = names_data, dtype = type_data)
+                  'p_sample', 'b_z', 'b_lower', 'b_upper', 'inter_z', 'inter_lower', 'inter_upper', \
+                  'b_obs_lower', 'b_obs_upper', 'inter_obs_lower', 'inter_obs_upper']
+    with open(data_dir) as data_file:
+        rows = [line.split() for line in data_file if line.strip()]
+    if rows and rows[0][0] == 'study': rows = rows[1:]
+    if rows: names_data = names_data[:max(len(row) for row in rows)]
+    type_data = {'names': names_data, 'formats': ['S15'] + ['<f8'] * (len(names_data) - 1)}
+    if not rows:
+        return np.zeros(0, dtype = type_data)
+    n_col = len(names_data)
+    lines = [' '.join(row + ['nan'] * (n_col - len(row))) for row in rows]
+    data = np.genfromtxt(lines, delimiter = ' ', names = names_data, dtype = type_data)
     return data
     
+def sample_metrics_dtype():
+    """Record type of the per-sample metrics written by TL_from_sample()."""
+    return np.dtype({'names': ['study', 'sample', 'b', 'inter', 'R2', 'p', 'quad_p'],
+                     'formats': ['S15', '<i8', '<f8', '<f8', '<f8', '<f8', '<f8']})
+
+def get_sample_metrics_file(data_dir):
+    """Read in the per-sample metrics file generated by TL_from_sample().
+
+    Columns are study, sample (1-based, matching the sample columns of get_var_sample_file()), b, intercept,
+    R-squared, p-value of b, and p-value of the quadratic term. The first read saves a binary copy next
+    to the text file (see binary_path()), which is memory-mapped by later reads until the text file changes.
+
+    """
+    data = read_binary(data_dir, sample_metrics_dtype())
+    if data is not None:
+        return data
+    data = np.genfromtxt(data_dir, delimiter = '\t', dtype = sample_metrics_dtype())
+    write_binary(data_dir, data)
+    return data
+
 def RandomComposition_weak(q, n):
     indices = sorted(np.random.randint(0, q, n - 1))
     parts = [(indices + [q])[i] - ([0] + indices)[i] for i in range(len(indices)+1)]
@@ -98,59 +1137,727 @@ def rand_compositions(q, n, sample_size, zeros):
     comps = [list(x) for x in set(tuple(x) for x in comps)]
     return comps
 
-def get_var_for_Q_N(q, n, sample_size, t_limit, analysis):
-    """Given q and n, returns a list of variance of length sample size with variance of 
-    
-    each sample partitions or compositions.
-    
+def rand_compositions_batch(q, n, sample_size, method = 'legacy'):
+    """Draw sample_size weak compositions of q into n parts at once.
+
+    Returns an integer matrix of shape (sample_size, n), one composition per row.
+    Parts within a row are not sorted, which does not affect any statistic computed on them.
+    Input:
+    q, n - total and number of parts
+    sample_size - number of compositions (rows) to draw
+    method - 'legacy' reproduces RandomComposition_weak(), i.e. n - 1 cut points drawn
+             independently from 0, ..., q - 1 (the last part is always at least 1);
+             'uniform' draws each of the C(q + n - 1, n - 1) weak compositions with equal probability
+             (stars and bars), via a multinomial with Dirichlet(1, ..., 1) probabilities.
+
     """
-    QN_var = []
+    if method == 'legacy':
+        # Same random stream as sample_size consecutive calls of RandomComposition_weak()
+        cuts = np.sort(np.random.randint(0, q, (sample_size, n - 1)), axis = 1)
+        bounds = np.zeros((sample_size, n + 1), dtype = cuts.dtype)
+        bounds[:, 1:n] = cuts
+        bounds[:, n] = q
+        return np.diff(bounds, axis = 1)
+    elif method == 'uniform':
+        # Sequential conditional binomials of a multinomial(q, p) with p ~ Dirichlet(1, ..., 1)
+        weights = np.random.exponential(size = (sample_size, n))
+        tail = np.cumsum(weights[:, ::-1], axis = 1)[:, ::-1] # sum of weights[:, j:]
+        comps = np.zeros((sample_size, n), dtype = np.int64)
+        remain = np.empty(sample_size, dtype = np.int64)
+        remain.fill(q)
+        for j in xrange(n - 1):
+            comps[:, j] = np.random.binomial(remain, np.minimum(weights[:, j] / tail[:, j], 1))
+            remain -= comps[:, j]
+        comps[:, n - 1] = remain
+        return comps
+    else: raise ValueError('Unknown composition method: ' + str(method))
+
+def var_compositions_batch(q, n, sample_size, method = 'legacy'):
+    """Return the variance (ddof = 1) of each of sample_size weak compositions of q into n parts,
+
+    drawn with rand_compositions_batch().
+
+    """
+    comps = rand_compositions_batch(q, n, sample_size, method = method)
+    return np.var(comps, axis = 1, ddof = 1)
+
+def rand_partitions_batch(q, n, sample_size):
+    """Draw sample_size partitions of q into n parts (zeros allowed) against a single cached count table.
+
+    Returns an integer matrix of shape (sample_size, n), one partition per row.
+
+    """
+    table = partition_counts.get(q, n)
     try:
-        with time_limit(t_limit):
-            for Niter in range(sample_size):
-                if analysis == 'partition':
-                    QN_parts = parts.rand_partitions(q, n, 1, 'bottom_up', {}, True)
-                else: QN_parts = rand_compositions(q, n, 1, True)
-                QN_var.append(np.var(QN_parts[0], ddof = 1))
-            return QN_var
-    except TimeoutException, msg:
-        print 'Timed out!'
+        QN_parts = parts.rand_partitions(q, n, sample_size, 'bottom_up', table, True)
+    finally:
+        partition_counts.update(q, n)
+    return np.array(QN_parts, dtype = np.int64).reshape(sample_size, n)
+
+def var_partitions_batch(q, n, sample_size):
+    """Return the variance (ddof = 1) of each of sample_size partitions drawn with rand_partitions_batch()."""
+    return np.var(rand_partitions_batch(q, n, sample_size), axis = 1, ddof = 1)
+
+def partition_ssq_counts(q, n):
+    """Return the number of partitions of q into at most n parts, by sum of squares of the parts.
+
+    The output is an array of length q ** 2 + 1 whose i-th element is the (floating point) number
+    of partitions with sum of squares i. Uses the recursion over (q, n, sum of squares)
+    P(q, n) = P(q, n - 1) + P(q - n, n) shifted by 2q - n, where the second term
+    removes one from each part of the partitions with exactly n positive parts.
+
+    """
+    n = min(n, q)
+    layer = [np.zeros(q_i ** 2 + 1) for q_i in xrange(q + 1)] # P(q_i, 0)
+    layer[0][0] = 1
+    for n_i in xrange(1, n + 1):
+        for q_i in xrange(n_i, q + 1): # In place: P(q_i - n_i, n_i) is already in the current layer
+            shift = 2 * q_i - n_i
+            prev = layer[q_i - n_i]
+            layer[q_i][shift:shift + len(prev)] += prev
+    return layer[q]
+
+def composition_ssq_counts(q, n):
+    """Return the number of weak compositions of q into n parts, by sum of squares of the parts.
+
+    The output is an array of length q ** 2 + 1, scaled by an arbitrary constant to avoid overflow.
+    Uses the recursion C(s, k) = sum over x of C(s - x, k - 1) shifted by x ** 2, with all
+    partial sums s = 0, ..., q of one layer k updated at once.
+
+    """
+    ssq_max = q ** 2
+    layer = np.zeros((q + 1, ssq_max + 1))
+    for x in xrange(q + 1):
+        layer[x, x ** 2] = 1
+    for k in xrange(2, n + 1):
+        new_layer = np.zeros((q + 1, ssq_max + 1))
+        for x in xrange(q + 1):
+            new_layer[x:, x ** 2:] += layer[:q + 1 - x, :ssq_max + 1 - x ** 2]
+        layer = new_layer / new_layer[q].max()
+    return layer[q]
+
+def exact_dp_size(q, n, analysis):
+    """Approximate number of cells updated and held in memory by the dynamic program behind exact_var_dist()."""
+    if analysis == 'partition':
+        n = min(n, q)
+        return n * (q + 1) ** 3 // 3, (q + 1) ** 3 // 3
+    else: return (n - 1) * 5 * (q + 1) ** 4 // 12, 2 * (q + 1) ** 3
+
+def exact_feasible(q, n, analysis = 'partition', comp_method = 'uniform', max_cells = EXACT_MAX_CELLS,
+                   max_states = EXACT_MAX_STATES):
+    """Whether exact_var_dist() is available for (q, n) within the given budgets."""
+    if n < 2 or (analysis != 'partition' and comp_method != 'uniform'):
+        return False
+    cells, states = exact_dp_size(q, n, analysis)
+    return cells <= max_cells and states <= max_states
+
+def exact_var_dist(q, n, analysis = 'partition', comp_method = 'uniform', max_cells = EXACT_MAX_CELLS,
+                   max_states = EXACT_MAX_STATES):
+    """Exact distribution of the variance (ddof = 1) of the feasible set of (q, n).
+
+    The sample variance of a partition or composition depends only on its sum of squares,
+    var = (ssq - q ** 2 / n) / (n - 1), so the distribution is obtained from the counts
+    by sum of squares. Partitions are taken to be uniform with zeros allowed, as in pypartitions;
+    compositions are uniform weak compositions, which matches comp_method = 'uniform' in
+    rand_compositions_batch().
+    Returns a tuple (values, probs) with the distinct variances in increasing order and their
+    probabilities, or None if the dynamic program would update more than max_cells cells or hold more
+    than max_states cells in memory, or if there is no exact counterpart of the sampler
+    (n < 2, or 'legacy' compositions).
+
+    """
+    if not exact_feasible(q, n, analysis, comp_method = comp_method, max_cells = max_cells, max_states = max_states):
+        return None
+    if analysis == 'partition':
+        counts = partition_ssq_counts(q, n)
+    else: counts = composition_ssq_counts(q, n)
+    ssq = np.nonzero(counts)[0]
+    values = (ssq - q ** 2 / n) / (n - 1)
+    probs = counts[ssq] / counts[ssq].sum()
+    return values, probs
+
+exact_var_dists = OrderedDict() # Most recent exact distributions, keyed by (q, n, analysis, comp_method, budgets)
+
+def get_exact_var_dist(q, n, analysis = 'partition', comp_method = 'uniform', max_cells = EXACT_MAX_CELLS,
+                       max_states = EXACT_MAX_STATES):
+    """Memoized version of exact_var_dist(), keeping the 100 most recently used distributions."""
+    key = (q, n, analysis, comp_method, max_cells, max_states)
+    if key in exact_var_dists:
+        dist = exact_var_dists.pop(key)
+    else:
+        start = time.time()
+        dist = exact_var_dist(q, n, analysis = analysis, comp_method = comp_method, max_cells = max_cells,
+                              max_states = max_states)
+        if dist is not None:
+            cost_model.record(q, n, analysis, 'exact', 1, time.time() - start, comp_method = comp_method)
+        if len(exact_var_dists) >= 100:
+            exact_var_dists.popitem(last = False)
+    exact_var_dists[key] = dist
+    return dist
+
+def exact_var_summary(q, n, analysis = 'partition', comp_method = 'uniform', max_cells = EXACT_MAX_CELLS,
+                      max_states = EXACT_MAX_STATES):
+    """Exact mean, standard deviation, and 2.5 and 97.5 percentiles of the variance of the feasible set.
+
+    Returns a dictionary with keys 'mean', 'sd', 'lower', 'upper', or None if exact_var_dist() is not
+    applicable, in which case the quantities have to be estimated from samples. The percentiles are the
+    smallest values whose cumulative probability reaches 0.025 and 0.975. The z-score of an empirical
+    variance is (var - mean) / sd.
+
+    """
+    dist = get_exact_var_dist(q, n, analysis = analysis, comp_method = comp_method, max_cells = max_cells,
+                              max_states = max_states)
+    if dist is None:
+        return None
+    values, probs = dist
+    mean = np.sum(values * probs)
+    sd = np.sum((values - mean) ** 2 * probs) ** 0.5
+    cdf = np.cumsum(probs)
+    lower = values[min(np.searchsorted(cdf, 0.025), len(values) - 1)]
+    upper = values[min(np.searchsorted(cdf, 0.975), len(values) - 1)]
+    return {'mean': mean, 'sd': sd, 'lower': lower, 'upper': upper}
+
+def var_summaries(dat_sample, analysis = 'partition', comp_method = 'legacy', exact = True):
+    """Mean, and 2.5 and 97.5 percentiles of the variance of the feasible set for each record of dat_sample.
+
+    The input dat_sample is in the format defined by get_var_sample_file(). The values of a record are
+    exact (see exact_var_summary()) if exact is True and the exact distribution of its Q and N is available,
+    and estimated from its sample variances otherwise, so that they carry no sampling noise wherever possible.
+    Output: arrays of the mean, lower and upper percentiles, one value per record.
+
+    """
+    var_matrix = get_sample_matrix(dat_sample)
+    expc = var_matrix.mean(axis = 1)
+    expc_lower, expc_upper = np.percentile(var_matrix, [2.5, 97.5], axis = 1)
+    if exact:
+        for i, (q, n) in enumerate(zip(dat_sample['Q'], dat_sample['N'])):
+            summary = exact_var_summary(int(q), int(n), analysis = analysis, comp_method = comp_method)
+            if summary is not None:
+                expc[i], expc_lower[i], expc_upper[i] = summary['mean'], summary['lower'], summary['upper']
+    return expc, expc_lower, expc_upper
+
+def partial_var_path(out_folder, q, n, analysis, comp_method = 'legacy', seed = None):
+    """Path of the file holding variances drawn for (q, n) by a run that ran out of time.
+
+    seed is the seed of the combo, or any other key that keeps the variances of unrelated rows apart.
+
+    """
+    name = analysis_name(analysis, comp_method) + '_' + str(q) + '_' + str(n)
+    if seed is not None: name += '_' + str(seed)
+    return os.path.join(out_folder, 'partial', name + '.npy')
+
+def save_partial_var(out_folder, q, n, analysis, QN_var, comp_method = 'legacy', seed = None):
+    """Atomically save the variances drawn so far for (q, n), so that a later run can top them up."""
+    path = partial_var_path(out_folder, q, n, analysis, comp_method = comp_method, seed = seed)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(path), suffix = '.tmp')
+    with os.fdopen(fd, 'wb') as tmp_file:
+        np.save(tmp_file, np.array(QN_var, dtype = float))
+    replace_file(tmp_path, path)
+
+def load_partial_var(out_folder, q, n, analysis, comp_method = 'legacy', seed = None):
+    """Load the partial variances saved for (q, n), or return an empty list if there are none.
+
+    The file is kept until remove_partial_var() is called once the combo is complete, so that the variances
+    are not lost if the run topping them up is interrupted.
+
+    """
+    path = partial_var_path(out_folder, q, n, analysis, comp_method = comp_method, seed = seed)
+    if not os.path.exists(path):
+        return []
+    return list(np.load(path))
+
+def remove_partial_var(out_folder, q, n, analysis, comp_method = 'legacy', seed = None):
+    """Remove the partial variances saved for (q, n), if any."""
+    path = partial_var_path(out_folder, q, n, analysis, comp_method = comp_method, seed = seed)
+    if os.path.exists(path):
+        os.remove(path)
+
+def get_var_for_Q_N(q, n, sample_size, t_limit, analysis, comp_method = 'legacy', exact = True, budget = None,
+                    prior = None, cache = True, seed = None):
+    """Given q and n, returns a list of variance of length sample size with variance of
+
+    each sample partitions or compositions.
+    If exact is True and the exact distribution of the variance is available from get_exact_var_dist(),
+    the variances are drawn directly from it, which is equivalent to sampling the feasible set.
+    Partitions are drawn one at a time against the shared count table for (q, n) in partition_counts.
+    Compositions are drawn in batches with var_compositions_batch(), where comp_method is
+    either 'legacy' (same procedure as rand_compositions()) or 'uniform' (stars and bars).
+    Sampling stops once budget (a SamplingBudget, by default one of t_limit seconds) has expired,
+    in which case the shorter list drawn so far is returned. Variances already drawn by an
+    earlier run can be passed as prior, and only the remaining ones are drawn.
+    The first partition drawn for (q, n) fills its count table, which cannot be interrupted; if the calibrated
+    cost_model predicts that this takes longer than the time left (see CostModel.table_over_budget()),
+    nothing is drawn.
+    The time spent is recorded in the process-wide cost_model (see CostModel).
+    If cache is True and seed is given, the variances are looked up in the process-wide sample_cache first
+    (see SampleCache), and complete lists of variances are stored there. Without a seed the cache is neither
+    read nor written, so that repeated calls for the same combo return independent draws.
+    If seed is given, the random number generators are reseeded with spawn_seed(seed, i) before drawing
+    the i-th variance onwards, one partition or one batch of compositions at a time, so that the variances
+    are reproducible, and a run topping up the variances of an earlier run that timed out draws the same
+    variances as an uninterrupted run. The state of the generators is restored afterwards, so that reseeding
+    does not change the random numbers drawn by the caller.
+
+    """
+    cache = cache and seed is not None
+    if cache:
+        cache_key = sample_cache.key(q, n, analysis, sample_size, seed = seed, comp_method = comp_method, exact = exact)
+        cached = sample_cache.get(cache_key)
+        if cached is not None: return list(cached)
+    with saved_rng_state(seed is not None):
+        QN_var = list(prior) if prior is not None else []
+        if budget is None:
+            budget = SamplingBudget(t_limit)
+        if exact:
+            dist = get_exact_var_dist(q, n, analysis = analysis, comp_method = comp_method)
+            if dist is not None:
+                values, probs = dist
+                n_left = sample_size - len(QN_var)
+                if seed is not None: seed_rngs(spawn_seed(seed, len(QN_var)))
+                QN_var.extend(values[np.random.choice(len(values), n_left, p = probs)])
+                budget.add(n_left)
+                if cache: sample_cache.put(cache_key, QN_var)
+                return QN_var
+        n_prior, start = len(QN_var), time.time()
+        if analysis == 'partition':
+            table = partition_counts.get(q, n)
+            # The first draw fills the count table and cannot be interrupted, so it is only started if it fits the budget
+            skip = not table and cost_model.table_over_budget(q, n, budget.remaining())
+            if skip:
+                print 'Skipped! Q =', q, 'N =', n, 'is predicted to need more than the time left to build its count table'
+            try:
+                while not skip and len(QN_var) < sample_size and not budget.expired():
+                    if seed is not None: seed_rngs(spawn_seed(seed, len(QN_var)))
+                    new_table, table_start = not table, time.time()
+                    QN_parts = parts.rand_partitions(q, n, 1, 'bottom_up', table, True)
+                    if new_table: cost_model.record(q, n, analysis, 'table', 1, time.time() - table_start)
+                    QN_var.append(np.var(QN_parts[0], ddof = 1))
+                    budget.add()
+            finally:
+                partition_counts.update(q, n)
+        else:
+            chunk_size = max(1, 10 ** 6 // n) # Keep each batch at about 10 ** 6 parts
+            while len(QN_var) < sample_size and not budget.expired():
+                n_chunk = min(chunk_size, sample_size - len(QN_var))
+                if seed is not None: seed_rngs(spawn_seed(seed, len(QN_var)))
+                QN_var.extend(var_compositions_batch(q, n, n_chunk, method = comp_method))
+                budget.add(n_chunk)
+        cost_model.record(q, n, analysis, 'sample', len(QN_var) - n_prior, time.time() - start, comp_method = comp_method)
+        if len(QN_var) < sample_size:
+            print 'Timed out! Q =', q, 'N =', n, 'samples =', len(QN_var), 'samples/s =', budget.rate()
+        elif cache: sample_cache.put(cache_key, QN_var)
         return QN_var
 
-def sample_var(data, study, sample_size = 1000, t_limit = 7200, analysis = 'partition', out_folder = './out_files/'):
+def checkpoint_dir(out_folder, study, analysis, sample_size, comp_method = 'legacy', seed = None):
+    """Folder holding the per-combo checkpoints of sample_var() for one study.
+
+    The folder depends on everything the variances are drawn with, so that a run with another comp_method
+    or master seed does not reuse the checkpoints of an earlier one.
+
+    """
+    name = analysis_name(analysis, comp_method) + '_' + str(sample_size)
+    if seed is not None: name += '_seed' + str(seed)
+    return os.path.join(out_folder, 'checkpoints', name, str(study))
+
+def checkpoint_path(out_folder, study, q, n, analysis, sample_size, replicate = 0, comp_method = 'legacy', seed = None):
+    """Checkpoint file of one (study, Q, N, analysis, sample_size) combo.
+
+    replicate distinguishes rows of the same study that share Q and N. seed is the master seed.
+
+    """
+    return os.path.join(checkpoint_dir(out_folder, study, analysis, sample_size, comp_method = comp_method, seed = seed),
+                        str(q) + '_' + str(n) + '_' + str(replicate) + '.txt')
+
+def save_checkpoint(path, line):
+    """Atomically write one finished output row of sample_var()."""
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(path), suffix = '.tmp')
+    with os.fdopen(fd, 'w') as tmp_file:
+        print>>tmp_file, line
+    replace_file(tmp_path, path)
+
+def get_replicates(data_study):
+    """Number each record of a study among the records with the same Q and N (0, 1, ...)."""
+    replicates = []
+    seen = {}
+    for record in data_study:
+        replicate = seen.get((record[1], record[2]), 0)
+        seen[(record[1], record[2])] = replicate + 1
+        replicates.append(replicate)
+    return replicates
+
+def combo_seed(seed, q, n, analysis, sample_size, replicate = 0, comp_method = 'legacy'):
+    """Seed of the variances of one Q-N combo, spawned from the master seed with spawn_seed().
+
+    The seed does not depend on the study, so that studies sharing a Q-N combo share its variances
+    in sample_cache, while rows of one study with the same Q and N (see get_replicates()) get independent ones.
+
+    """
+    return spawn_seed(seed, int(q), int(n), analysis_name(analysis, comp_method), int(sample_size), int(replicate))
+
+def sample_combo(record, replicate = 0, sample_size = 1000, t_limit = 7200, analysis = 'partition',
+                 out_folder = './out_files/', comp_method = 'legacy', exact = True, checkpoint = True, seed = None):
+    """Sample one Q-N combo and return its line for the output file of sample_var(), or None if it ran out of time.
+
+    record is the row of the combo (study, Q, N, mean, var), and replicate numbers rows of the same study
+    that share Q and N (see get_replicates()). seed is the master seed, from which the seed of the combo
+    is derived with combo_seed(). The other arguments are as in sample_var().
+
+    """
+    study, q, n = record[0], record[1], record[2]
+    path = checkpoint_path(out_folder, study, q, n, analysis, sample_size, replicate = replicate,
+                           comp_method = comp_method, seed = seed)
+    seed = combo_seed(seed, q, n, analysis, sample_size, replicate = replicate, comp_method = comp_method)
+    event = {'study': study, 'Q': q, 'N': n, 'analysis': analysis_name(analysis, comp_method), 'replicate': replicate,
+             'sample_size': sample_size}
+    if checkpoint and os.path.exists(path):
+        telemetry.emit('combo', status = 'checkpoint', samples = 0, total = sample_size, seconds = 0, rate = None,
+                       **event)
+        with open(path) as ckpt_file:
+            return ckpt_file.read().rstrip('\n')
+    out_row = [x for x in record]
+    # Without a seed, the partial variances are private to the row, so that rows sharing Q and N draw independently
+    partial_key = seed if seed is not None else str(study) + '_' + str(replicate)
+    prior = load_partial_var(out_folder, q, n, analysis, comp_method = comp_method, seed = partial_key)[:sample_size]
+    cached = seed is not None and sample_cache.key(q, n, analysis, sample_size, seed = seed, comp_method = comp_method,
+                                                   exact = exact) in sample_cache
+    start = time.time()
+    QN_var = get_var_for_Q_N(q, n, sample_size, t_limit, analysis, comp_method = comp_method, exact = exact,
+                             prior = prior, seed = seed)
+    seconds = time.time() - start
+    if cached: # Nothing drawn, so that the sampling rates only count variances actually drawn
+        telemetry.emit('combo', status = 'cached', samples = 0, total = len(QN_var), seconds = seconds, rate = None,
+                       **event)
+    else:
+        telemetry.emit('combo', status = 'complete' if len(QN_var) >= sample_size else 'timeout',
+                       samples = len(QN_var) - len(prior), total = len(QN_var), seconds = seconds,
+                       rate = (len(QN_var) - len(prior)) / seconds if seconds > 0 else None, **event)
+    if len(QN_var) < sample_size:
+        save_partial_var(out_folder, q, n, analysis, QN_var, comp_method = comp_method, seed = partial_key)
+        return None
+    out_row.extend(QN_var)
+    var_line = '\t'.join([str(x) for x in out_row])
+    if checkpoint: save_checkpoint(path, var_line)
+    remove_partial_var(out_folder, q, n, analysis, comp_method = comp_method, seed = partial_key)
+    return var_line
+
+def study_done(out_folder, study, analysis, sample_size, comp_method = 'legacy', seed = None):
+    """Whether sample_var() has already written the study from its checkpoints."""
+    return os.path.exists(os.path.join(checkpoint_dir(out_folder, study, analysis, sample_size,
+                                                      comp_method = comp_method, seed = seed), 'done'))
+
+def write_study_var(var_lines, study, sample_size = 1000, analysis = 'partition', out_folder = './out_files/',
+                    checkpoint = True, mark_done = True, comp_method = 'legacy', seed = None):
+    """Write the lines of a finished study to the output file of sample_var(),
+
+    and mark the study as done (see mark_study_done()) if checkpoint and mark_done are True.
+
+    """
+    write_output(out_folder + 'taylor_QN_var_predicted_' + analysis + '_' + str(sample_size) + '_full.txt', study,
+                 var_lines, flush = True) # On disk before the study is marked as done
+    if checkpoint and mark_done:
+        mark_study_done(out_folder, study, analysis, sample_size, comp_method = comp_method, seed = seed)
+
+def mark_study_done(out_folder, study, analysis, sample_size, comp_method = 'legacy', seed = None):
+    """Replace the checkpoints of a study by a 'done' marker, so that later runs skip the study.
+
+    Until then, a rerun reads the combos of the study back from their checkpoints and writes the study again,
+    so a study should only be marked once all of its output, including post-processing, is on disk.
+
+    """
+    study_dir = checkpoint_dir(out_folder, study, analysis, sample_size, comp_method = comp_method, seed = seed)
+    if not os.path.exists(study_dir):
+        os.makedirs(study_dir)
+    for ckpt_name in os.listdir(study_dir):
+        os.remove(os.path.join(study_dir, ckpt_name))
+    open(os.path.join(study_dir, 'done'), 'w').close()
+
+def var_lines_to_records(var_lines, sample_size = 1000):
+    """Convert lines of the output file of sample_var() into records in the binary format of get_var_sample_file()."""
+    return np.atleast_1d(np.genfromtxt(StringIO('\n'.join(var_lines)), delimiter = '\t',
+                                       dtype = var_sample_dtype(sample_size)))
+
+def sample_var(data, study, sample_size = 1000, t_limit = 7200, analysis = 'partition', out_folder = './out_files/',
+               comp_method = 'legacy', exact = True, checkpoint = True, seed = None, mark_done = True):
     """Obtain and record the variance of partition or composition samples.
     
     Input:
-    data - data list read in with get_QN_mean_var_data()
+    data - data list read in with get_QN_mean_var_data(), or a StudyGroups object built from it
     study - ID of study
     sample_size - number of samples to be drawn, default value is 1000
     t_limit - abort sampling procedure for one Q-N combo after t_limit seconds, default value is 7200 (2 hours)
     analysis - partition or composition
+    comp_method - how compositions are drawn, 'legacy' or 'uniform' (see rand_compositions_batch())
+    exact - draw variances from the exact distribution whenever it fits the budget (see exact_var_dist())
+    checkpoint - save each finished Q-N combo to its own file as soon as it completes (see checkpoint_path()),
+                 and skip combos that are already saved. Once all combos of the study are done, the study
+                 is appended to the output file from the checkpoints, which are then replaced by a 'done' marker
+                 so that the study is not appended again.
+    mark_done - if False, the study is written without the 'done' marker, which is then left to the caller
+                (see mark_study_done()), e.g. once the study has been post-processed
+    seed - master seed; if given, the variances of each Q-N combo are drawn from their own stream
+           (see combo_seed()), and are the same whichever order or process the combos are sampled in
+    If a Q-N combo runs out of time, the variances drawn so far are saved with save_partial_var()
+    and the study is skipped; the next run for the same combo continues from those variances.
+    Returns the lines written to the output file, or None if the study was skipped or had been written before.
+
+    """
+    data_study = get_study(data, study)
+    if checkpoint and study_done(out_folder, study, analysis, sample_size, comp_method = comp_method, seed = seed):
+        return None
+    var_lines = []
+    for record, replicate in zip(data_study, get_replicates(data_study)):
+        var_line = sample_combo(record, replicate = replicate, sample_size = sample_size, t_limit = t_limit,
+                                analysis = analysis, out_folder = out_folder, comp_method = comp_method,
+                                exact = exact, checkpoint = checkpoint, seed = seed)
+        if var_line is None: break # Break out of for-loop if a Q-N combo is skipped
+        var_lines.append(var_line)
     
+    if len(data_study) == len(var_lines): # If no QN combos are omitted, print to file
+        write_study_var(var_lines, study, sample_size = sample_size, analysis = analysis, out_folder = out_folder,
+                        checkpoint = checkpoint, mark_done = mark_done, comp_method = comp_method, seed = seed)
+        telemetry.emit('study', study = study, analysis = analysis_name(analysis, comp_method), status = 'written')
+        return var_lines
+    record = data_study[len(var_lines)]
+    telemetry.emit('study', study = study, analysis = analysis_name(analysis, comp_method), status = 'skipped',
+                   failed = [[record['Q'], record['N']]])
+    return None
+
+def get_z_score(emp_var, sim_var_list, summary = None):
+    """Return the z-score as a measure of the discrepancy between empirical and sample variance
+
+    If summary, the output of exact_var_summary(), is given, the exact mean and standard deviation are used
+    instead of those of sim_var_list.
+
     """
-    data_study = data[data['study'] == study]
-    var_parts = []
-    for record in data_study:
-        q = record[1]
-        n = record[2]
-        out_row = [x for x in record]
-        QN_var = get_var_for_Q_N(q, n, sample_size, t_limit, analysis)
-        if len(QN_var) == sample_size:
-            out_row.extend(QN_var)
-            var_parts.append(out_row)
-        else: break # Break out of for-loop if a Q-N combo is skipped
-    
-    if len(data_study) == len(var_parts): # If no QN combos are omitted, print to file
-        out_write_var = open(out_folder + 'taylor_QN_var_predicted_' + analysis + '_' + str(sample_size) + '_full.txt', 'a')
-        for var_row in var_parts:
-            print>>out_write_var, '\t'.join([str(x) for x in var_row])
-        out_write_var.close()
-
-def get_z_score(emp_var, sim_var_list):
-    """Return the z-score as a measure of the discrepancy between empirical and sample variance"""
+    if summary is not None:
+        return (emp_var - summary['mean']) / summary['sd']
     sd_sim = (np.var(sim_var_list, ddof = 1)) ** 0.5
     return (emp_var - np.mean(sim_var_list)) / sd_sim
 
+class RunningStats(object):
+    """Streaming count, mean, variance, minimum and maximum with constant memory.
+
+    Values are added one batch at a time with Welford's update (batches are combined with
+    Chan et al.'s parallel formula), and accumulators from different workers can be combined
+    with merge(). The results equal those of np.mean(), np.var() etc. on all values up to
+    rounding; nan values propagate as they do in numpy.
+
+    """
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0 # Sum of squared deviations from the mean
+        self.min = np.inf
+        self.max = -np.inf
+
+    def _combine(self, n, mean, m2, min_val, max_val):
+        if n == 0: return
+        n_tot = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * n / n_tot
+        self.m2 += m2 + delta ** 2 * self.n * n / n_tot
+        self.n = n_tot
+        self.min = min(self.min, min_val) if not np.isnan(min_val) else min_val
+        self.max = max(self.max, max_val) if not np.isnan(max_val) else max_val
+
+    def add(self, values):
+        """Add a single value or an array of values."""
+        values = np.ravel(np.asarray(values, dtype = float))
+        if len(values) == 0: return
+        mean = np.mean(values)
+        self._combine(len(values), mean, np.sum((values - mean) ** 2), np.min(values), np.max(values))
+
+    def merge(self, other):
+        """Add all values accumulated by another RunningStats object."""
+        self._combine(other.n, other.mean, other.m2, other.min, other.max)
+
+    def var(self, ddof = 1):
+        return self.m2 / (self.n - ddof)
+
+    def sd(self, ddof = 1):
+        return self.var(ddof = ddof) ** 0.5
+
+    def z_score(self, emp_val):
+        """Same as get_z_score(emp_val, values) on all values added so far."""
+        return (emp_val - self.mean) / self.sd()
+
+class QuantileSketch(object):
+    """Mergeable streaming quantile sketch with bounded relative error (DDSketch).
+
+    Values are counted in logarithmically spaced buckets (separately for positive and negative values,
+    with values of absolute value below min_value counted as zero), so memory grows only with the
+    logarithm of the range of the values, not with their number. Sketches built on different parts of
+    the data can be combined with merge() without loss of accuracy.
+    Error bound: quantile(q) is within relative_accuracy * |x| of x, the order statistic of rank
+    floor(q * (n - 1)) of the values added. np.percentile() interpolates between this order
+    statistic and the next one, so the two can additionally differ by their gap.
+    nan values are not counted.
+
+    """
+    def __init__(self, relative_accuracy = 0.001, min_value = 1e-12):
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zero = 0
+        self.n = 0
+
+    def _add_keys(self, store, values):
+        keys, counts = np.unique(np.ceil(np.log(values) / self.log_gamma).astype(int), return_counts = True)
+        for key, count in zip(keys, counts):
+            store[key] = store.get(key, 0) + count
+
+    def add(self, values):
+        """Add a single value or an array of values."""
+        values = np.ravel(np.asarray(values, dtype = float))
+        values = values[~np.isnan(values)]
+        self._add_keys(self.positive, values[values >= self.min_value])
+        self._add_keys(self.negative, -values[values <= -self.min_value])
+        self.zero += np.sum(np.abs(values) < self.min_value)
+        self.n += len(values)
+
+    def merge(self, other):
+        """Add all values counted by another sketch with the same relative_accuracy and min_value."""
+        for store, other_store in [(self.positive, other.positive), (self.negative, other.negative)]:
+            for key, count in other_store.items():
+                store[key] = store.get(key, 0) + count
+        self.zero += other.zero
+        self.n += other.n
+
+    def _value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def quantile(self, q):
+        """Return the estimated q-quantile (0 <= q <= 1), or nan if the sketch is empty."""
+        if self.n == 0: return np.nan
+        rank = int(q * (self.n - 1))
+        count = 0
+        for key in sorted(self.negative, reverse = True): # Most negative values first
+            count += self.negative[key]
+            if count > rank: return -self._value(key)
+        count += self.zero
+        if count > rank: return 0.0
+        for key in sorted(self.positive):
+            count += self.positive[key]
+            if count > rank: return self._value(key)
+        return self._value(max(self.positive))
+
+    def percentile(self, pct):
+        """Same as quantile(pct / 100), for use in place of np.percentile()."""
+        return self.quantile(pct / 100)
+
+def linregress_batch(x, y, mask = None):
+    """Least-squares regressions of each column of y on x, equivalent to calling stats.linregress() per column.
+
+    Input:
+    x - independent variable, either a vector shared by all columns or a matrix of the same shape as y
+    y - matrix of dependent variables, one regression per column
+    mask - optional boolean matrix of the same shape as y, points with False are left out of the regression
+    Output: arrays of slope, intercept, r, and p-value of the slope, one value per column.
+    Columns with fewer than two points get nan.
+
+    """
+    y = np.asarray(y, dtype = float)
+    x = np.asarray(x, dtype = float)
+    if x.ndim == 1:
+        x = x[:, None] * np.ones(y.shape)
+    if mask is None:
+        mask = np.ones(y.shape, dtype = bool)
+    w = mask.astype(float)
+    x = np.where(mask, x, 0) # Masked entries may be inf or nan, e.g. log(0)
+    y = np.where(mask, y, 0)
+    TINY = 1.0e-20
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        n = w.sum(axis = 0)
+        xmean = (w * x).sum(axis = 0) / n
+        ymean = (w * y).sum(axis = 0) / n
+        dx = (x - xmean) * w
+        dy = (y - ymean) * w
+        ssxm = (dx ** 2).sum(axis = 0)
+        ssym = (dy ** 2).sum(axis = 0)
+        ssxym = (dx * dy).sum(axis = 0)
+        r_den = np.sqrt(ssxm * ssym)
+        r = np.where(r_den == 0, 0.0, ssxym / r_den)
+        r = np.clip(r, -1.0, 1.0)
+        slope = ssxym / ssxm
+        intercept = ymean - slope * xmean
+        df = n - 2
+        t = r * np.sqrt(df / ((1.0 - r + TINY) * (1.0 + r + TINY)))
+        prob = 2 * stats.t.sf(np.abs(t), df)
+    prob = np.where(n == 2, np.where(ssym == 0, 1.0, 0.0), prob) # Same convention as stats.linregress()
+    few = n < 2
+    slope[few], intercept[few], r[few], prob[few] = np.nan, np.nan, np.nan, np.nan
+    return slope, intercept, r, prob
+
+def bootstrap_TL(list_of_mean, list_of_var, n_boot = 1000, alpha = 0.05, seed = None):
+    """Percentile bootstrap confidence intervals of the empirical b and intercept of Taylor's law.
+
+    The (mean, var) rows of a study are resampled with replacement n_boot times at once, as one
+    (rows x n_boot) index matrix, and TL is refitted to all resamples with one call of linregress_batch().
+    Resamples in which all means are equal have no fit and are left out, and if no resample has a fit
+    (e.g. all means of the study are equal), the bounds are nan.
+    seed seeds the resampling (a RandomState of its own, leaving the global random state untouched).
+    Output: lower and upper bounds of the 100 * (1 - alpha)% intervals of b and of the intercept.
+
+    """
+    log_mean, log_var = np.log(np.asarray(list_of_mean, dtype = float)), np.log(np.asarray(list_of_var, dtype = float))
+    index = np.random.RandomState(seed).randint(0, len(log_mean), (len(log_mean), n_boot))
+    b, inter, r, p = linregress_batch(log_mean[index], log_var[index])
+    ok = np.isfinite(b)
+    if ok.sum() == 0: return [np.nan] * 4
+    percentiles = [100 * alpha / 2, 100 * (1 - alpha / 2)]
+    b_lower, b_upper = np.percentile(b[ok], percentiles)
+    inter_lower, inter_upper = np.percentile(inter[ok], percentiles)
+    return b_lower, b_upper, inter_lower, inter_upper
+
+def bootstrap_TL_task(task):
+    """Worker for bootstrap_TL_studies()."""
+    study, list_of_mean, list_of_var, n_boot, alpha, seed = task
+    return study, bootstrap_TL(list_of_mean, list_of_var, n_boot = n_boot, alpha = alpha, seed = seed)
+
+def bootstrap_TL_studies(data, n_boot = 1000, alpha = 0.05, seed = None, processes = None):
+    """Bootstrap confidence intervals of the empirical TL of each study, see bootstrap_TL().
+
+    data is in the format of get_QN_mean_var_data() or get_var_sample_file(), or a StudyGroups object built
+    from either. The resampling of each study is seeded with spawn_seed(seed, study), so that the intervals
+    do not depend on how studies are split between processes. If processes is given, studies are
+    bootstrapped in a pool of that many worker processes.
+    Output: dictionary with the output of bootstrap_TL() for each study.
+
+    """
+    data = group_by_study(data)
+    tasks = [(study, data[study]['mean'], data[study]['var'], n_boot, alpha, spawn_seed(seed, study))
+             for study in data.studies]
+    if processes is None:
+        return dict(map(bootstrap_TL_task, tasks))
+    pool = multiprocessing.Pool(processes)
+    boot_CIs = dict(pool.map(bootstrap_TL_task, tasks))
+    pool.close()
+    pool.join()
+    return boot_CIs
+
+def fit_TL_samples(list_of_mean, var_matrix):
+    """Fit Taylor's law (log variance against log mean) to every simulated sample of a study at once.
+
+    Input:
+    list_of_mean - mean of each Q-N combo of the study
+    var_matrix - (combos x samples) matrix of simulated variances, e.g. from get_sample_matrix().
+                 Zero variances are left out of the fit of their sample.
+    Output: arrays of b, intercept, R-squared, and p-value of b, one value per sample.
+
+    """
+    var_matrix = np.asarray(var_matrix, dtype = float)
+    mask = var_matrix > 0
+    log_var = np.log(np.where(mask, var_matrix, 1))
+    b, inter, r, p = linregress_batch(np.log(list_of_mean), log_var, mask = mask)
+    return b, inter, r ** 2, p
+
 def quadratic_term(list_of_mean, list_of_var):
     """Fit a quadratic term and return its p-value"""
     # Remove records with 0 variance
@@ -162,63 +1869,286 @@ def quadratic_term(list_of_mean, list_of_var):
     quad_res = sm.OLS(log_var, indep_var).fit()
     return quad_res.pvalues[2]
 
-def TL_from_sample(dat_sample, analysis = 'partition', out_folder = './out_files/'):
+def quadratic_term_samples(list_of_mean, var_matrix):
+    """Fit a quadratic term to every simulated sample of a study at once and return its p-values.
+
+    Gives the same result as calling quadratic_term() on each column of var_matrix, i.e. an OLS fit of
+    log variance on a constant, log mean, and log mean squared, with records of zero variance omitted
+    from the fit of their sample. The normal equations of all samples are solved together; log mean is
+    centered within each sample first, which leaves the quadratic coefficient and its standard error unchanged.
+    Input:
+    list_of_mean - mean of each Q-N combo of the study
+    var_matrix - (combos x samples) matrix of simulated variances, e.g. from get_sample_matrix()
+    Output: array of p-values of the quadratic term, nan for samples with fewer than four records above zero.
+
+    """
+    var_matrix = np.asarray(var_matrix, dtype = float)
+    mask = var_matrix > 0
+    w = mask.astype(float)
+    y = np.log(np.where(mask, var_matrix, 1)) * w
+    log_mean = np.log(np.asarray(list_of_mean, dtype = float))[:, None]
+    n = w.sum(axis = 0)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        x = (log_mean - (w * log_mean).sum(axis = 0) / n) * w
+        # Moments of x up to the fourth power, and cross products with y, one per sample
+        moments = [n] + [(x ** k).sum(axis = 0) for k in xrange(1, 5)]
+        xtx = np.empty((len(n), 3, 3))
+        for i in xrange(3):
+            for j in xrange(3):
+                xtx[:, i, j] = moments[i + j]
+        xty = np.column_stack([(x ** k * y).sum(axis = 0) for k in xrange(3)])
+        xtx_inv = np.linalg.pinv(xtx)
+        coef = np.einsum('sij,sj->si', xtx_inv, xty)
+        resid = (y - coef[:, 0] - coef[:, 1] * x - coef[:, 2] * x ** 2) * w
+        df = n - 3
+        scale = (resid ** 2).sum(axis = 0) / df
+        t = coef[:, 2] / np.sqrt(scale * xtx_inv[:, 2, 2])
+        p = 2 * stats.t.sf(np.abs(t), df)
+    p[df <= 0] = np.nan
+    return p
+
+def iter_sample_metrics(dat_study, chunk_size):
+    """Yield the output of get_sample_metrics() in consecutive blocks of at most chunk_size samples."""
+    var_matrix = get_sample_matrix(dat_study)
+    for start in xrange(0, var_matrix.shape[1], chunk_size):
+        var_chunk = var_matrix[:, start:start + chunk_size]
+        metrics = np.zeros(var_chunk.shape[1], dtype = sample_metrics_dtype())
+        metrics['study'] = dat_study['study'][0]
+        metrics['sample'] = np.arange(start + 1, start + var_chunk.shape[1] + 1)
+        metrics['b'], metrics['inter'], metrics['R2'], metrics['p'] = fit_TL_samples(dat_study['mean'], var_chunk)
+        metrics['quad_p'] = quadratic_term_samples(dat_study['mean'], var_chunk)
+        yield metrics
+
+def get_sample_metrics(dat_study):
+    """Return b, intercept, R-squared, p-value of b, and p-value of the quadratic term for every simulated sample
+
+    of one study, as a record array of type sample_metrics_dtype().
+
+    """
+    n_sample = get_sample_size(dat_study)
+    return np.concatenate(list(iter_sample_metrics(dat_study, max(n_sample, 1))))
+
+def TL_from_sample(dat_sample, analysis = 'partition', out_folder = './out_files/', metrics = True, chunk_size = None,
+                   n_boot = 0, seed = None, boot_CIs = None):
     """Obtain the empirical and simulated TL relationship given the output file from sample_var().
     
-    Here only the summary statistics are recorded for each study, instead of results from each 
-    individual sample, because the analysis can be quickly re-done given the input file, without
-    going through the time-limiting step of generating samples from partitions.
-    The input dat_sample is in the same format as defined by get_var_sample_file().
+    The main output file holds one row of summary statistics per study. The fits of the individual samples
+    are only kept if metrics is True, in a separate file (see below), as they can be quickly re-done given
+    the input file, without going through the time-limiting step of generating samples from partitions.
+    The input dat_sample is in the same format as defined by get_var_sample_file(), or a StudyGroups object built from it.
     The output file has the following columns: 
     study, empirical b, empirical intercept, empirical R-squared, empirical p-value, mean b, intercept, R-squared from samples, 
     percentage of significant TL in samples (at alpha = 0.05), z-score between empirical and sample b, 2.5 and 97.5 percentile of sample b,
-    z-score between empirical and sample intercept, 2.5 and 97.5 percentile of sample intercept.
-    
-    """
-    study_list = sorted(np.unique(dat_sample['study']))
-    for study in study_list:
-        dat_study = dat_sample[dat_sample['study'] == study]
-        emp_b, emp_inter, emp_r, emp_p, emp_std_err = stats.linregress(np.log(dat_study['mean']), np.log(dat_study['var']))
-        b_list = []
-        inter_list = []
-        psig = 0
-        R2_list = []
-        for i_sim in dat_sample.dtype.names[5:]:
-            var_sim = dat_study[i_sim][dat_study[i_sim] > 0] # Omit samples of zero variance 
-            mean_list = dat_study['mean'][dat_study[i_sim] > 0]
-            sim_b, sim_inter, sim_r, sim_p, sim_std_error = stats.linregress(np.log(mean_list), np.log(var_sim))
-            b_list.append(sim_b)
-            inter_list.append(sim_inter)
-            R2_list.append(sim_r ** 2)
-            if sim_p < 0.05: psig += 1
-        psig /= len(dat_sample.dtype.names[5:])
-        out_file = open(out_folder + 'TL_form_' + analysis + '.txt', 'a')
-        print>>out_file, study, emp_b, emp_inter, emp_r ** 2, emp_p, np.mean(b_list), np.mean(inter_list), np.mean(R2_list), \
-             psig, get_z_score(emp_b, b_list), np.percentile(b_list, 2.5), np.percentile(b_list, 97.5), get_z_score(emp_inter, inter_list), \
-             np.percentile(inter_list, 2.5), np.percentile(inter_list, 97.5)
-        out_file.close()
+    z-score between empirical and sample intercept, 2.5 and 97.5 percentile of sample intercept,
+    and the 2.5 and 97.5 percentiles of the empirical b and intercept from n_boot bootstrap resamples of the
+    study (see bootstrap_TL(), seeded with spawn_seed(seed, study)). Intervals already computed for many
+    studies, e.g. in parallel with bootstrap_TL_studies(), can be passed as boot_CIs. The bootstrap is off
+    by default (n_boot = 0), as it adds n_boot refits per study to the post-processing; the four interval
+    columns are then nan.
+    The file is TL_form_<analysis>.txt in out_folder, with _<sample size> appended to the name unless there are
+    1000 samples per record (see output_path()).
+    If metrics is True, the results of the individual samples are also written to TL_sample_metrics_<analysis>.txt
+    (see get_sample_metrics() and get_sample_metrics_file()), so that figures and summaries do not need to refit them.
+    If chunk_size is given, the samples are processed chunk_size at a time and summarized with RunningStats
+    and QuantileSketch, so that memory does not grow with the number of samples; the percentiles are then
+    approximate within the error bound of QuantileSketch.
+    
+    """
+    dat_sample = group_by_study(dat_sample)
+    sample_size = get_sample_size(dat_sample)
+    with telemetry.span('TL_from_sample', analysis = analysis, studies = len(dat_sample)), batch_output():
+        for study in dat_sample.studies:
+            dat_study = dat_sample[study]
+            emp_b, emp_inter, emp_r, emp_p, emp_std_err = stats.linregress(np.log(dat_study['mean']), np.log(dat_study['var']))
+            if chunk_size is None:
+                study_chunks = [get_sample_metrics(dat_study)]
+            else: study_chunks = iter_sample_metrics(dat_study, chunk_size)
+            b_stats, inter_stats, R2_stats = RunningStats(), RunningStats(), RunningStats()
+            b_sketch, inter_sketch = QuantileSketch(), QuantileSketch()
+            b_list, inter_list = [], []
+            n_sig = 0
+            # Samples of zero variance are omitted from the fits
+            for study_metrics in study_chunks:
+                if metrics:
+                    write_output(output_path(out_folder, 'TL_sample_metrics', analysis, sample_size), study,
+                                 ['\t'.join(map(str, row)) for row in study_metrics])
+                b_stats.add(study_metrics['b'])
+                inter_stats.add(study_metrics['inter'])
+                R2_stats.add(study_metrics['R2'])
+                n_sig += np.sum(study_metrics['p'] < 0.05)
+                if chunk_size is None:
+                    b_list, inter_list = study_metrics['b'], study_metrics['inter']
+                else:
+                    b_sketch.add(study_metrics['b'])
+                    inter_sketch.add(study_metrics['inter'])
+            if chunk_size is None:
+                b_lower, b_upper = np.percentile(b_list, 2.5), np.percentile(b_list, 97.5)
+                inter_lower, inter_upper = np.percentile(inter_list, 2.5), np.percentile(inter_list, 97.5)
+            else:
+                b_lower, b_upper = b_sketch.percentile(2.5), b_sketch.percentile(97.5)
+                inter_lower, inter_upper = inter_sketch.percentile(2.5), inter_sketch.percentile(97.5)
+            psig = n_sig / b_stats.n
+            if boot_CIs is not None and study in boot_CIs:
+                boot_CI = boot_CIs[study]
+            elif n_boot > 0:
+                boot_CI = bootstrap_TL(dat_study['mean'], dat_study['var'], n_boot = n_boot, seed = spawn_seed(seed, study))
+            else: boot_CI = [np.nan] * 4
+            form_row = [study, emp_b, emp_inter, emp_r ** 2, emp_p, b_stats.mean, inter_stats.mean, R2_stats.mean,
+                        psig, b_stats.z_score(emp_b), b_lower, b_upper, inter_stats.z_score(emp_inter), inter_lower, inter_upper]
+            form_row.extend(boot_CI)
+            write_output(output_path(out_folder, 'TL_form', analysis, sample_size), study,
+                         [' '.join(map(str, form_row))])
 
 def get_quadratic_sig_data(dat_sample, analysis = 'partition', out_folder = './out_files/'):
     """Compute the p-value of the quadratic term for each dataset
     
     as well as all of its partitions/compositions and write results to file.
+    The input dat_sample is in the format defined by get_var_sample_file(), or a StudyGroups object built from it.
+    The file is TL_quad_p_<analysis>.txt in out_folder, named as in output_path().
+    
+    """
+    dat_sample = group_by_study(dat_sample)
+    sample_size = get_sample_size(dat_sample)
+    with telemetry.span('get_quadratic_sig_data', analysis = analysis, studies = len(dat_sample)), batch_output():
+        for study in dat_sample.studies:
+            p_list = [study]
+            dat_study = dat_sample[study]
+            emp_quad_p = quadratic_term(dat_study['mean'], dat_study['var'])
+            p_list.append(emp_quad_p)
+            # Samples of zero variance are omitted from the fits
+            p_list.extend(quadratic_term_samples(dat_study['mean'], get_sample_matrix(dat_study)))
+            write_output(output_path(out_folder, 'TL_quad_p', analysis, sample_size), study,
+                         [' \t'.join(map(str, p_list))])
     
+def post_process_study(var_lines, sample_size = 1000, analysis = 'partition', out_folder = './out_files/', seed = None,
+                       n_boot = 0):
+    """Run TL_from_sample(), get_quadratic_sig_data() and TL_aicc.get_aicc_data() on the lines of one study
+
+    written by sample_var().
+
     """
-    study_list = sorted(np.unique(dat_sample['study']))
-    for study in study_list:
-        p_list = [study]
-        dat_study = dat_sample[dat_sample['study'] == study]
-        emp_quad_p = quadratic_term(dat_study['mean'], dat_study['var'])
-        p_list.append(emp_quad_p)
-        for i_sim in dat_sample.dtype.names[5:]:
-            var_sim = dat_study[i_sim][dat_study[i_sim] > 0] # Omit samples of zero variance 
-            mean_list = dat_study['mean'][dat_study[i_sim] > 0]
-            sim_quad_p = quadratic_term(mean_list, var_sim)
-            p_list.append(sim_quad_p)
-        out_file = open(out_folder + 'TL_quad_p_' + analysis + '.txt', 'a')
-        print>>out_file, ' \t'.join(map(str, p_list))
-        out_file.close()
+    dat_study = var_lines_to_records(var_lines, sample_size = sample_size)
+    TL_from_sample(dat_study, analysis = analysis, out_folder = out_folder, n_boot = n_boot, seed = seed)
+    get_quadratic_sig_data(dat_study, analysis = analysis, out_folder = out_folder)
+    aicc.get_aicc_data(dat_study, analysis = analysis, out_folder = out_folder)
+
+def TL_analysis(data, study, analysis = 'partition', sample_size = 1000, t_limit = 7200, out_folder = './out_files/',
+                comp_method = 'legacy', exact = True, seed = None, n_boot = 0):
+    """Full analysis of one study: sample_var(), followed by post_process_study()
+    
+    if all Q-N combos of the study were sampled in this call. The study is only marked as done once it has been
+    post-processed, so that a run interrupted in between post-processes it on the next run.
+    n_boot is the number of bootstrap resamples of the empirical TL in TL_from_sample() (none by default).
     
+    """
+    var_lines = sample_var(data, study, sample_size = sample_size, t_limit = t_limit, analysis = analysis,
+                           out_folder = out_folder, comp_method = comp_method, exact = exact, seed = seed,
+                           mark_done = False)
+    if var_lines:
+        post_process_study(var_lines, sample_size = sample_size, analysis = analysis, out_folder = out_folder, seed = seed,
+                           n_boot = n_boot)
+        flush_outputs()
+        mark_study_done(out_folder, study, analysis, sample_size, comp_method = comp_method, seed = seed)
+
+def sample_combo_task(task):
+    """Worker for run_pipeline(): sample one combo, returning its key and output line (None if timed out)."""
+    key, k, record, replicate, kwargs = task
+    return key, k, sample_combo(record, replicate = replicate, **kwargs)
+
+def run_pipeline(datasets, analyses = ('partition', 'composition'), sample_size = 1000, t_limit = 7200,
+                 out_folder = './out_files/', processes = 8, comp_method = 'legacy', exact = True,
+                 skip_over_budget = False, seed = None, n_boot = 0):
+    """Run the full analysis for a set of studies with one shared pool of worker processes.
+
+    Every (study, Q, N, analysis) combo is a separate task, and tasks are collected as they complete,
+    so that a slow combo only occupies one worker. As soon as all combos of a study are back,
+    the study is written to file and post-processed (see post_process_study())
+    in the main process, which is also the only process writing output files. A study is only marked as done
+    (see mark_study_done()) once it has been post-processed. Output rows are
+    collected with batch_output() and merged into the output files, ordered by study, at the end.
+    Tasks are started in decreasing order of their time predicted by the cost model, which records
+    its timings to cost_timings.txt in out_folder and is recalibrated from them on the next run.
+    Combos predicted to exceed t_limit are reported, and skipped if skip_over_budget is True.
+    If seed is given, variances are cached in sample_cache in out_folder (see SampleCache), so that studies
+    sharing a Q-N combo, and later runs with new studies, only sample combos that have not been seen before.
+    Input:
+    datasets - list of (data, study_list) pairs, data as read in with get_QN_mean_var_data()
+    analyses - feasible sets to analyze, partition and/or composition
+    processes - number of worker processes
+    seed - master seed; with a seed, the output is the same for any number of worker processes
+    n_boot - number of bootstrap resamples of the empirical TL of each study in TL_from_sample() (none by default)
+    The other arguments are as in sample_var().
+
+    """
+    model = set_cost_model(os.path.join(out_folder, 'cost_timings.txt'))
+    set_sample_cache(os.path.join(out_folder, 'sample_cache'))
+    set_telemetry(os.path.join(out_folder, 'telemetry.jsonl'))
+    kwargs = {'sample_size': sample_size, 't_limit': t_limit, 'out_folder': out_folder,
+              'comp_method': comp_method, 'exact': exact, 'seed': seed}
+    tasks = []
+    pending = {} # Output lines of each study, filled in as its combos complete
+    n_left = {} # Number of tasks of each study still to come back
+    for i_data, (data, study_list) in enumerate(datasets):
+        data = group_by_study(data)
+        for analysis in analyses:
+            for study in study_list:
+                if study_done(out_folder, study, analysis, sample_size, comp_method = comp_method, seed = seed): continue
+                data_study = data[study]
+                key = (i_data, analysis, study)
+                pending[key] = [None] * len(data_study)
+                n_left[key] = 0
+                task_kwargs = dict(kwargs, analysis = analysis)
+                for k, (record, replicate) in enumerate(zip(data_study, get_replicates(data_study))):
+                    q, n = record[1], record[2]
+                    task_seed = combo_seed(seed, q, n, analysis, sample_size, replicate = replicate, comp_method = comp_method)
+                    if task_seed is not None and sample_cache.key(q, n, analysis, sample_size, seed = task_seed, comp_method = comp_method,
+                                        exact = exact) in sample_cache:
+                        tasks.append((0, (key, k, tuple(record), replicate, task_kwargs)))
+                        n_left[key] += 1
+                        continue
+                    if model.over_budget(q, n, t_limit, analysis = analysis, sample_size = sample_size,
+                                         comp_method = comp_method, exact = exact):
+                        print 'Predicted to exceed t_limit! Q =', q, 'N =', n, 'analysis =', analysis, \
+                              'predicted s =', model.predict(q, n, analysis = analysis, sample_size = sample_size,
+                                                             comp_method = comp_method, exact = exact)
+                        if skip_over_budget: continue
+                    cost = model.predict(q, n, analysis = analysis, sample_size = sample_size,
+                                         comp_method = comp_method, exact = exact)
+                    tasks.append((cost, (key, k, tuple(record), replicate, task_kwargs)))
+                    n_left[key] += 1
+                if n_left[key] == 0: # All combos skipped, so the study never comes back from the pool
+                    del pending[key], n_left[key]
+                    print 'Skipped study', study, 'analysis =', analysis, '- all Q-N combos predicted to exceed t_limit'
+                    telemetry.emit('study', study = study, analysis = analysis_name(analysis, comp_method),
+                                   status = 'skipped', failed = [[record['Q'], record['N']] for record in data_study])
+    tasks.sort(key = lambda task: -task[0]) # Longest tasks first
+    print 'Predicted sampling time (s):', sum(cost for cost, task in tasks), 'over', len(tasks), 'combos'
+    merge_outputs(out_folder)
+    pool = multiprocessing.Pool(processes)
+    with batch_output():
+        for key, k, var_line in pool.imap_unordered(sample_combo_task, [task for cost, task in tasks]):
+            pending[key][k] = var_line
+            n_left[key] -= 1
+            if n_left[key] == 0:
+                var_lines = pending.pop(key)
+                i_data, analysis, study = key
+                if None not in var_lines: # Studies with a skipped Q-N combo are left for a later run
+                    write_study_var(var_lines, study, sample_size = sample_size, analysis = analysis,
+                                    out_folder = out_folder, mark_done = False)
+                    telemetry.emit('study', study = study, analysis = analysis_name(analysis, comp_method),
+                                   status = 'written')
+                    post_process_study(var_lines, sample_size = sample_size, analysis = analysis, out_folder = out_folder,
+                                       seed = seed, n_boot = n_boot)
+                    flush_outputs() # Post-processed rows on disk before the study is marked as done
+                    mark_study_done(out_folder, study, analysis, sample_size, comp_method = comp_method, seed = seed)
+                else:
+                    data_study = get_study(datasets[i_data][0], study)
+                    telemetry.emit('study', study = study, analysis = analysis_name(analysis, comp_method),
+                                   status = 'skipped', failed = [[record['Q'], record['N']] for record, var_line
+                                                                 in zip(data_study, var_lines) if var_line is None])
+    pool.close()
+    pool.join()
+
 def inclusion_criteria(dat_study, sig = False):
     """Criteria that datasets need to meet to be included in the analysis"""
     dat_study = dat_study[(dat_study['N'] >= N_MIN) * (dat_study['Q'] >= Q_MIN)]
@@ -287,7 +2217,7 @@ def plot_obs_expc(obs, expc, expc_upper, expc_lower, obs_type, loglog, legend =
     ax.tick_params(axis = 'both', which = 'major', labelsize = 6)
     return ax
 
-def plot_obs_expc_alt(obs, expc, obs_type, loglog, ax = None):
+def plot_obs_expc_alt(obs, expc, obs_type, loglog, ax = None, rasterized = False):
     """Alternative visual representation of the obs-expc plot, with not CI range but each dot plotted
     
     semi-transparently to illustrate the heat of different values. 
@@ -297,17 +2227,18 @@ def plot_obs_expc_alt(obs, expc, obs_type, loglog, ax = None):
     obs_type - list of the same length of obs, specifying whether each obs is spatial (red) or temporal (blue)
     loglog - whether both axes are to be transformed
     ax - whether the plot is generated on a given figure, or a new plot object is to be created
+    rasterized - whether the dots are saved as an image in vector formats such as pdf
     
     """
-    obs = list(obs)
+    obs, obs_type = np.asarray(obs), np.asarray(obs_type)
+    expc = np.asarray(expc, dtype = float)
     n_sample = len(expc)
     if not ax:
         fig = plt.figure(figsize = (3.5, 3.5))
         ax = plt.subplot(111)
     
     if loglog:
-        expc_above_zero = [[x for x in sublist if x > 0] for sublist in expc]
-        axis_min = 0.9 * np.min(expc_above_zero)
+        axis_min = 0.9 * np.min(expc[expc > 0])
         axis_max = 3 * np.max(expc)
         ax.set_xscale('log')
         ax.set_yscale('log')        
@@ -315,29 +2246,18 @@ def plot_obs_expc_alt(obs, expc, obs_type, loglog, ax = None):
         axis_min = 0.9 * np.min(expc)
         axis_max = 1.1 * np.max(expc)
 
-    # Sort all lists with respect to obs
-    index = sorted(range(len(obs)), key = lambda k: obs[k])
-    expc = [expc[i] for i in index]
-    expc_upper = [expc_upper[i] for i in index]
-    expc_lower = [expc_lower[i] for i in index]
-    obs = [obs[i] for i in index]
-    obs_type = [obs_type[i] for i in index]
-     
-    # Replace zeros in expc_lower with the minimal value above zero for the purpose of plotting   
-    i_spac = [i for i, x in enumerate(obs_type) if x == 'spatial']
-    i_temp = [i for i, x in enumerate(obs_type) if x == 'temporal']
-     
-    for j in range(n_sample):  
-        expc_sample = expc[j]
-        plt.scatter([obs[i] for i in i_spac], [expc_sample[i] for i in i_spac], c = '#EE4000',  edgecolors='none', alpha = 1 / n_sample * 10, s = 8)
-        plt.scatter([obs[i] for i in i_temp], [expc_sample[i] for i in i_temp], c = '#1C86EE',  edgecolors='none', alpha = 1 / n_sample * 10, s = 8)   
+    # All samples are drawn as a single collection
+    i_plot = np.nonzero((obs_type == 'spatial') | (obs_type == 'temporal'))[0]
+    colors = np.where(obs_type[i_plot] == 'spatial', '#EE4000', '#1C86EE')
+    plt.scatter(np.tile(obs[i_plot], n_sample), expc[:, i_plot].ravel(), c = list(np.tile(colors, n_sample)), \
+                edgecolors='none', alpha = min(1, 1 / n_sample * 10), s = 8, rasterized = rasterized)
     plt.plot([axis_min, axis_max],[axis_min, axis_max], 'k-')
     plt.xlim(axis_min, axis_max)
     plt.ylim(axis_min, axis_max)
     ax.tick_params(axis = 'both', which = 'major', labelsize = 6)
     return ax
 
-def plot_obs_expc_new(obs, expc, expc_upper, expc_lower, analysis, log, ax = None):
+def plot_obs_expc_new(obs, expc, expc_upper, expc_lower, analysis, log, ax = None, rasterized = False):
     """Modified version of obs-expc plot suggested by R2. The points are separated by whether their CIs are above, below, 
     
     or overlapping the empirical value
@@ -349,6 +2269,7 @@ def plot_obs_expc_new(obs, expc, expc_upper, expc_lower, analysis, log, ax = Non
     analysis - whether it is patitions or compositions
     log - whether the y axis is to be transformed. If True, expc/obs is plotted. If Flase, expc - obs is plotted.
     ax - whether the plot is generated on a given figure, or a new plot object is to be created
+    rasterized - whether the CIs and points are saved as an image in vector formats such as pdf
     
     """
     obs, expc, expc_upper, expc_lower = list(obs), list(expc), list(expc_upper), list(expc_lower)
@@ -383,9 +2304,12 @@ def plot_obs_expc_new(obs, expc, expc_upper, expc_lower, analysis, log, ax = Non
         ind_full.extend(sorted_index)
 
     xaxis_max = len(ind_full)
-    for i, ind in enumerate(ind_full):
-        plt.plot([i, i],[expc_lower_standardize[ind], expc_upper_standardize[ind]], '-', c = col, linewidth = 0.4)
-    plt.scatter(range(len(ind_full)), [expc_standardize[i] for i in ind_full], c = col,  edgecolors='none', s = 8)    
+    # CIs are drawn as a single collection of vertical segments
+    segments = [[(i, expc_lower_standardize[ind]), (i, expc_upper_standardize[ind])] for i, ind in enumerate(ind_full)]
+    from matplotlib.collections import LineCollection
+    plt.gca().add_collection(LineCollection(segments, colors = col, linewidths = 0.4, rasterized = rasterized))
+    plt.scatter(range(len(ind_full)), [expc_standardize[i] for i in ind_full], c = col,  edgecolors='none', s = 8, \
+                rasterized = rasterized)
     if log: 
         plt.plot([0, xaxis_max + 1], [1, 1], 'k-', linewidth = 1.5)
         ax.set_yscale('log')
@@ -424,8 +2348,54 @@ def plot_mean_var(mean, obs_var, expc_var, obs_type, loglog = True, ax = None):
     plt.ylabel('Variance', fontsize = 8)
     return ax
 
+class BinnedKDE(object):
+    """Gaussian kernel density estimate computed on a grid by linear binning and FFT convolution.
+
+    Equivalent to stats.gaussian_kde with covariance_factor() returning cov_factor, i.e. a kernel with
+    standard deviation cov_factor times the standard deviation of the data (ddof = 1), but costs
+    O(n + grid_size * log(grid_size)) instead of O(n) per evaluation point. The values are linearly binned
+    onto a regular grid spanning 5 kernel standard deviations beyond the data, with at least 20 grid points
+    per kernel standard deviation (up to max_grid_size), and the density is linearly interpolated between
+    grid points (and zero outside the grid). Called on an array of points, returns the density at each point.
+
+    """
+    def __init__(self, val_list, cov_factor, max_grid_size = 2 ** 16):
+        values = np.asarray(val_list, dtype = float).ravel()
+        self.n = len(values)
+        self.bandwidth = cov_factor * np.std(values, ddof = 1)
+        if not self.bandwidth > 0:
+            raise np.linalg.LinAlgError('singular matrix') # As gaussian_kde does for constant data
+        lo, hi = values.min() - 5 * self.bandwidth, values.max() + 5 * self.bandwidth
+        grid_size = int(min(max_grid_size, max(512, 2 ** np.ceil(np.log2(20 * (hi - lo) / self.bandwidth)))))
+        self.grid = np.linspace(lo, hi, grid_size)
+        step = self.grid[1] - self.grid[0]
+        # Linear binning: each value is split between its two neighboring grid points
+        pos = (values - lo) / step
+        index = np.minimum(pos.astype(int), grid_size - 2)
+        frac = pos - index
+        counts = np.bincount(index, weights = 1 - frac, minlength = grid_size) + \
+                 np.bincount(index + 1, weights = frac, minlength = grid_size)
+        # Convolve with the kernel, truncated at 5 standard deviations, via zero-padded FFTs
+        n_kernel = min(grid_size - 1, int(np.ceil(5 * self.bandwidth / step)))
+        offsets = np.arange(-n_kernel, n_kernel + 1) * step
+        kernel = np.exp(-0.5 * (offsets / self.bandwidth) ** 2) / (np.sqrt(2 * np.pi) * self.bandwidth)
+        fft_size = int(2 ** np.ceil(np.log2(grid_size + 2 * n_kernel)))
+        conv = np.fft.irfft(np.fft.rfft(counts, fft_size) * np.fft.rfft(kernel, fft_size), fft_size)
+        self.density = np.maximum(conv[n_kernel:n_kernel + grid_size], 0) / self.n
+
+    def evaluate(self, points):
+        return np.interp(np.asarray(points, dtype = float), self.grid, self.density, left = 0, right = 0)
+
+    __call__ = evaluate
+
 def comp_dens(val_list, cov_factor):
-    """Compute the density function given covariance factor."""
+    """Compute the density function given covariance factor.
+    
+    Above KDE_BINNED_MIN values, the density is computed with BinnedKDE instead of stats.gaussian_kde.
+    
+    """
+    if np.size(val_list) >= KDE_BINNED_MIN:
+        return BinnedKDE(val_list, cov_factor)
     density = stats.gaussian_kde(val_list)
     density.covariance_factor = lambda :  cov_factor
     density._compute_covariance()
@@ -520,7 +2490,8 @@ def plot_dens_par_comp_single_obs(obs, pars, comps, ax = None, legend = False, l
     else: plt.xlim((0.9 * min(full_values), 1.1 * max(full_values)))
     return ax
 
-def plot_emp_vs_sim(study_id, data_dir = './out_files/', feas_type = 'partition', ax = None, inset = True, legend = False):
+def plot_emp_vs_sim(study_id, data_dir = './out_files/', feas_type = 'partition', ax = None, inset = True, legend = False,
+                    var_dat = None):
     """Plot of empirical and simulated mean-variance relationships for a given data set
     
     to help visually illustrate our results.
@@ -529,23 +2500,21 @@ def plot_emp_vs_sim(study_id, data_dir = './out_files/', feas_type = 'partition'
     
     Input: 
     study_id - ID of the data set of interest, in the form listed in Appendix A. 
+    var_dat - simulated variances already read in with get_var_sample_file() (or grouped with group_by_study()),
+              instead of reading them from data_dir
     """
     if not ax:
         fig = plt.figure(figsize = (3.5, 3.5))
         ax = plt.subplot(111)
-    var_dat = get_var_sample_file(data_dir + 'taylor_QN_var_predicted_' + feas_type + '_full.txt')
-    var_study = var_dat[var_dat['study'] == study_id]
+    if var_dat is None:
+        var_dat = get_var_sample_file(data_dir + 'taylor_QN_var_predicted_' + feas_type + '_full.txt')
+    var_study = get_study(var_dat, study_id)
     sim_var = [var_study[x][5] for x in xrange(len(var_study))] # take the first simulated sequence
     
     b_emp, inter_emp, r, p, std_err = stats.linregress(np.log(var_study['mean']), np.log(var_study['var']))
-    b_list = []
-    for k in xrange(len(var_study[0]) - 5):
-        study_k = [var_study[x][k + 5] for x in xrange(len(var_study))]
-        mean_k = [var_study['mean'][p] for p in xrange(len(var_study)) if study_k[p] != 0]
-        study_k = [study_k[p] for p in xrange(len(study_k)) if study_k[p] != 0]
-        b_k, inter, r, p, std_err = stats.linregress(np.log(mean_k), np.log(study_k))
-        if k == 0: b_0, inter_0 = b_k, inter
-        b_list.append(b_k)
+    b_sample, inter_sample, R2_sample, p_sample = fit_TL_samples(var_study['mean'], get_sample_matrix(var_study))
+    b_0, inter_0 = b_sample[0], inter_sample[0]
+    b_list = list(b_sample)
    
     ax.set_xscale('log')
     ax.set_yscale('log')
@@ -561,6 +2530,7 @@ def plot_emp_vs_sim(study_id, data_dir = './out_files/', feas_type = 'partition'
     if legend:
         plt.legend([emp, sim], ['Empirical', (feas_type.title()) + 's'], loc = 4, prop = {'size': 8}) 
     if inset:
+        from mpl_toolkits.axes_grid.inset_locator import inset_axes
         axins = inset_axes(ax, width="30%", height="30%", loc=2)
         cov_factor = 0.2
         xs = np.linspace(0.9 * min(b_list + [b_emp]), 1.1 * max(b_list + [b_emp]), 200)
@@ -0,0 +1,40 @@
+"""Check the import time of TL_functions against its budget.
+
+Importing TL_functions should only load NumPy and the standard library (see LazyModule in TL_functions),
+which is what keeps the start-up of worker processes short. Each measurement imports the module in a fresh
+interpreter, and the best of several runs is compared with the budget.
+Usage: python TL_import_time.py [budget in seconds]
+The budget defaults to the TL_IMPORT_BUDGET environment variable, or IMPORT_BUDGET if it is not set.
+Exits with status 1 if the budget is exceeded or if any of HEAVY_MODULES is loaded by the import.
+test_lazy_imports() in test_TL_functions.py only checks the heavy modules, as wall times vary too much on
+loaded machines for a test.
+
+"""
+from __future__ import division
+import subprocess
+import sys
+import os
+
+IMPORT_BUDGET = 0.5 # Seconds allowed for importing TL_functions, NumPy included
+HEAVY_MODULES = ['matplotlib', 'mpl_toolkits', 'scipy', 'scikits', 'statsmodels', 'pypartitions', 'pyper',
+                 'macroecotools']
+
+def measure_import(module = 'TL_functions', repeat = 5):
+    """Best time over repeat fresh interpreters to import module, and the heavy modules loaded by the import."""
+    code = 'import sys, time; before = set(sys.modules); start = time.time(); import %s; ' \
+           'print time.time() - start; print " ".join(set(sys.modules) - before)' % module
+    times = []
+    for i in xrange(repeat):
+        out = subprocess.check_output([sys.executable, '-c', code]).splitlines()
+        times.append(float(out[0]))
+        loaded = set(name.split('.')[0] for name in out[1].split())
+    return min(times), sorted(loaded.intersection(HEAVY_MODULES))
+
+if __name__ == '__main__':
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else float(os.environ.get('TL_IMPORT_BUDGET', IMPORT_BUDGET))
+    import_time, heavy = measure_import()
+    print 'Import time of TL_functions:', round(import_time, 3), 's (budget', budget, 's)'
+    if heavy:
+        print 'Modules that should be imported lazily:', ', '.join(heavy)
+    if import_time > budget or heavy:
+        sys.exit(1)
@@ -1,242 +1,333 @@
 ## Test the plotting function
+"""Figures for the TL project.
+
+Each figure is registered with figure() together with the input files it reads, and draws from a
+FigureContext, in which every input is read once and shared by all figures. build_figures() skips figures
+whose output exists and whose inputs and code are unchanged since the last build (as recorded in
+figures_manifest.json), reads the inputs of the others in the main process, and renders them in parallel
+worker processes, which inherit the inputs already read.
+Usage: python TL_plot.py [figure names] [--force] [--processes N]
+
+"""
 from __future__ import division
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import TL_functions as tl
 import numpy as np
-from scipy import stats
 import random
+import os
+import json
+import hashlib
+import argparse
+import multiprocessing
+from collections import OrderedDict
+
+MANIFEST = 'figures_manifest.json'
+figures = OrderedDict() # Figure name -> (function drawing and saving the figure, inputs)
+
+def figure(name, inputs):
+    """Register the function drawing the figure saved as name + '.pdf', with the inputs it reads.
+
+    Each input is a tuple (reader, path) or (reader, path, kwargs), read with context.load().
+
+    """
+    def register(plot_func):
+        figures[name] = (plot_func, inputs)
+        return plot_func
+    return register
+
+class FigureContext(object):
+    """Input data of the figures, each read in at most once.
+
+    load() returns the data read by reader from path, and groups() the same data grouped by study
+    (see tl.group_by_study()), both kept for later calls with the same arguments.
+
+    """
+    def __init__(self):
+        self.data = {}
+
+    def load(self, reader, path, *args, **kwargs):
+        key = (reader.__name__, path, args, tuple(sorted(kwargs.items())))
+        if key not in self.data:
+            self.data[key] = reader(path, *args, **kwargs)
+        return self.data[key]
+
+    def groups(self, reader, path, *args, **kwargs):
+        key = ('groups', reader.__name__, path, args, tuple(sorted(kwargs.items())))
+        if key not in self.data:
+            self.data[key] = tl.group_by_study(self.load(reader, path, *args, **kwargs))
+        return self.data[key]
+
+context = FigureContext()
+
+def file_hash(path, manifest_entry = None):
+    """SHA-1 of the content of path, reused from manifest_entry if the size and modification time are unchanged."""
+    file_stat = os.stat(path)
+    if manifest_entry and manifest_entry.get('size') == file_stat.st_size and \
+       manifest_entry.get('mtime') == file_stat.st_mtime:
+        return manifest_entry['sha1']
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as in_file:
+        for block in iter(lambda: in_file.read(2 ** 20), ''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def code_hash():
+    """SHA-1 of the source of this module and of TL_functions, so that an edit to any plotting helper
+
+    shared by the figures, and not only to the figure function itself, marks the figures as out of date.
+
+    """
+    sha1 = hashlib.sha1()
+    for module_file in [__file__, tl.__file__]:
+        with open(module_file[:-1] if module_file.endswith('.pyc') else module_file) as source_file:
+            sha1.update(source_file.read())
+    return sha1.hexdigest()
+
+def load_input(ctx, figure_input):
+    reader, path = figure_input[:2]
+    kwargs = figure_input[2] if len(figure_input) > 2 else {}
+    return ctx.load(reader, path, **kwargs)
+
+def figure_state(name, manifest):
+    """Hashes of the code and inputs of a figure, in the format of its entry in the manifest."""
+    old_inputs = manifest.get(name, {}).get('inputs', {})
+    inputs = {}
+    for path in set(figure_input[1] for figure_input in figures[name][1]):
+        file_stat = os.stat(path)
+        inputs[path] = {'size': file_stat.st_size, 'mtime': file_stat.st_mtime,
+                        'sha1': file_hash(path, old_inputs.get(path))}
+    return {'code': code_hash(), 'inputs': inputs}
+
+def up_to_date(name, state, manifest):
+    if not os.path.exists(name + '.pdf') or name not in manifest: return False
+    old_state = manifest[name]
+    return old_state['code'] == state['code'] and \
+           dict((path, x['sha1']) for path, x in old_state['inputs'].items()) == \
+           dict((path, x['sha1']) for path, x in state['inputs'].items())
+
+def render_figure(name):
+    """Draw and save one figure in a fresh pyplot state. Returns name."""
+    plt.close('all')
+    figures[name][0](context)
+    plt.close('all')
+    return name
+
+def build_figures(names = None, force = False, processes = None):
+    """Render the figures in names (all registered figures by default) that are out of date, or all if force is True.
+
+    The manifest is updated after each figure, so that an interrupted build keeps the figures it finished.
+
+    """
+    if names is None: names = list(figures)
+    if os.path.exists(MANIFEST):
+        with open(MANIFEST) as manifest_file:
+            manifest = json.load(manifest_file)
+    else: manifest = {}
+    states = dict((name, figure_state(name, manifest)) for name in names)
+    to_build = [name for name in names if force or not up_to_date(name, states[name], manifest)]
+    for name in names:
+        if name not in to_build: print name, 'is up to date'
+    for name in to_build: # Read in the inputs once, before the worker processes are forked
+        for figure_input in figures[name][1]:
+            load_input(context, figure_input)
+    if processes is None: processes = min(len(to_build), multiprocessing.cpu_count())
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        built = pool.imap_unordered(render_figure, to_build)
+    else: built = (render_figure(name) for name in to_build)
+    for name in built:
+        print name, 'done'
+        manifest[name] = states[name]
+        with open(MANIFEST, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent = 1, sort_keys = True)
+    if processes > 1:
+        pool.close()
+        pool.join()
 
 # Figure 1 - visual representation using three studies
-study_list = ['1_1', '10_1', '52_11']
-fig = plt.figure(figsize = (10.5, 7))
-iplot = 1
-for feas_type in ['partition', 'composition']:
+@figure('Fig1', [(tl.get_var_sample_file, 'out_files/taylor_QN_var_predicted_partition_full.txt'),
+                 (tl.get_var_sample_file, 'out_files/taylor_QN_var_predicted_composition_full.txt')])
+def plot_fig1(ctx):
+    study_list = ['1_1', '10_1', '52_11']
+    fig = plt.figure(figsize = (10.5, 7))
+    iplot = 1
+    for feas_type in ['partition', 'composition']:
+        var_dat = ctx.groups(tl.get_var_sample_file, 'out_files/taylor_QN_var_predicted_' + feas_type + '_full.txt')
+        for study in study_list:
+            ax = plt.subplot(2, 3, iplot)
+            if iplot == 1 or iplot == 4: legend = True
+            else: legend = False
+            tl.plot_emp_vs_sim(study, feas_type = feas_type, ax = ax, legend = legend, var_dat = var_dat)
+            iplot += 1
+    plt.subplots_adjust(wspace = 0.29, hspace = 0.29)
+    plt.savefig('Fig1.pdf', dpi = 600)
+
+def plot_sample_dens(out_name, study_list, study_info, tl_pars_par, metrics_par, metrics_comp, par_quad, drop_nan = False):
+    """Compare the full distribution of empirical TLs and those from the feasible sets (Figures 2 and B2)."""
+    b_obs, b_par, b_comp, b_type = [], [], [], []
+    p_obs, p_par, p_comp = [], [], []
+    pcurv_obs, pcurv_par, pcurv_comp = [], [], []
+    r2_obs, r2_par, r2_comp = [], [], []
     for study in study_list:
-        ax = plt.subplot(2, 3, iplot)
-        if iplot == 1 or iplot == 4: legend = True
-        else: legend = False
-        tl.plot_emp_vs_sim(study, feas_type = feas_type, ax = ax, legend = legend)     
-        iplot += 1
-plt.subplots_adjust(wspace = 0.29, hspace = 0.29)
-plt.savefig('Fig1.pdf', dpi = 600)
+        b_obs.append(tl.get_study(tl_pars_par, study)['b_obs'][0])
+        p_obs.append(tl.get_study(tl_pars_par, study)['p_obs'][0])
+        r2_obs.append(tl.get_study(tl_pars_par, study)['R2_obs'][0])
+        pcurv_obs.append(tl.get_study(par_quad, study)['emp_val'][0])
+        b_type.append(tl.get_study_type(study_info, study))
+
+        sample_par = tl.get_study(metrics_par, study)
+        b_par.extend(sample_par['b'])
+        p_par.extend(sample_par['p'])
+        r2_par.extend(sample_par['R2'])
+        pcurv_par.extend(sample_par['quad_p'])
+
+        sample_comp = tl.get_study(metrics_comp, study)
+        b_comp.extend(sample_comp['b'])
+        p_comp.extend(sample_comp['p'])
+        r2_comp.extend(sample_comp['R2'])
+        pcurv_comp.extend(sample_comp['quad_p'])
+
+    fig = plt.figure(figsize = (7, 7))
+    ax_p = plt.subplot(221)
+    tl.plot_dens_par_comp(p_obs, p_par, p_comp, ax = ax_p, legend = True, loc = 1, vline = 0.05, xlim = [0, 0.2])
+    ax_p.annotate('(A)', xy = (0.05, 0.92), xycoords = 'axes fraction', fontsize = 10)
+    plt.xlabel('p-value for b', fontsize = 8)
+    plt.ylabel('Density', fontsize = 8)
+
+    ax_curv = plt.subplot(222)
+    if drop_nan:
+        pcurv_par = [x for x in pcurv_par if not np.isnan(x)]
+        pcurv_comp = [x for x in pcurv_comp if not np.isnan(x)]
+    tl.plot_dens_par_comp(pcurv_obs, pcurv_par, pcurv_comp, ax = ax_curv, vline = 0.05, xlim = [0, 1])
+    ax_curv.annotate('(B)', xy = (0.05, 0.92), xycoords = 'axes fraction', fontsize = 10)
+    plt.xlabel('p-value for quadratic term', fontsize = 8)
+    plt.ylabel('Density', fontsize = 8)
+
+    ax_r2 = plt.subplot(223)
+    tl.plot_dens_par_comp(r2_obs, r2_par, r2_comp, ax = ax_r2, xlim = [0, 1])
+    ax_r2.annotate('(C)', xy = (0.05, 0.92), xycoords = 'axes fraction', fontsize = 10)
+    plt.xlabel(r'$R^2$', fontsize = 8)
+    plt.ylabel('Density', fontsize = 8)
+
+    ax_b = plt.subplot(224)
+    tl.plot_dens_par_comp(b_obs, b_par, b_comp, ax = ax_b, xlim = [0, 4])
+    ax_b.annotate('(D)', xy = (0.05, 0.92), xycoords = 'axes fraction', fontsize = 10)
+    plt.xlabel('Exponent b', fontsize = 8)
+    plt.ylabel('Density', fontsize = 8)
+    plt.savefig(out_name, dpi = 600)
 
 # Figure 2 - compare the full distribution of empirical TLs and those from the feasible sets
-study_info = tl.get_study_info('study_taxon_type.txt')
-tl_pars_par = tl.get_tl_par_file('out_files/TL_form_partition.txt')
-
-var_par = tl.get_var_sample_file('out_files/taylor_QN_var_predicted_partition_1000_full.txt')
-var_comp = tl.get_var_sample_file('out_files/taylor_QN_var_predicted_composition_1000_full.txt')
-par_quad = tl.get_val_ind_sample_file('out_files/TL_quad_p_partition.txt')
-comp_quad = tl.get_val_ind_sample_file('out_files/TL_quad_p_composition.txt')
-
-b_obs, b_par, b_comp, b_type = [], [], [], []
-p_obs, p_par, p_comp = [], [], []
-pcurv_obs, pcurv_par, pcurv_comp = [], [], []
-r2_obs, r2_par, r2_comp = [], [], []
-for study in np.unique(var_par['study']):
-    b_obs.append((tl_pars_par['b_obs'][tl_pars_par['study'] == study])[0])
-    p_obs.append((tl_pars_par['p_obs'][tl_pars_par['study'] == study])[0])
-    r2_obs.append((tl_pars_par['R2_obs'][tl_pars_par['study'] == study])[0])
-    pcurv_obs.append((par_quad['emp_val'][par_quad['study'] == study])[0])
-    b_type.append((study_info['type'][study_info['study'] == study])[0])
-    
-    sample_par = var_par[var_par['study'] == study]
-    sample_comp = var_comp[var_comp['study'] == study]
-    for i in xrange(1000):
-        sample_par_i = [sample_par[x][i + 5] for x in xrange(len(sample_par))]
-        mean_par = [sample_par['mean'][p] for p in xrange(len(sample_par)) if sample_par_i[p] != 0]
-        sample_par_i = [sample_par_i[p] for p in xrange(len(sample_par_i)) if sample_par_i[p] != 0]
-        b_par_i, inter_par_i, r_par_i, p_par_i, std_err_par_i = stats.linregress(np.log(mean_par), np.log(sample_par_i))
-        b_par.append(b_par_i)
-        p_par.append(p_par_i)
-        r2_par.append(r_par_i ** 2)
-        pcurv_par.append(par_quad[par_quad['study'] == study][0][i + 2])
-        
-        sample_comp_i = [sample_comp[y][i + 5] for y in xrange(len(sample_comp))]
-        mean_comp = [sample_comp['mean'][q] for q in xrange(len(sample_comp)) if sample_comp_i[q] != 0]
-        sample_comp_i = [sample_comp_i[q] for q in xrange(len(sample_comp_i)) if sample_comp_i[q] != 0] 
-        b_comp_i, inter_comp_i, r_comp_i, p_comp_i, std_err_comp_i = stats.linregress(np.log(mean_comp), np.log(sample_comp_i))
-        b_comp.append(b_comp_i)
-        p_comp.append(p_comp_i)
-        r2_comp.append(r_comp_i ** 2)
-        pcurv_comp.append(comp_quad[comp_quad['study'] == study][0][i + 2])
-        
-fig = plt.figure(figsize = (7, 7)) 
-ax_p = plt.subplot(221)
-tl.plot_dens_par_comp(p_obs, p_par, p_comp, ax = ax_p, legend = True, loc = 1, vline = 0.05, xlim = [0, 0.2])
-ax_p.annotate('(A)', xy = (0.05, 0.92), xycoords = 'axes fraction', fontsize = 10)
-plt.xlabel('p-value for b', fontsize = 8)
-plt.ylabel('Density', fontsize = 8)
-
-ax_curv = plt.subplot(222)
-tl.plot_dens_par_comp(pcurv_obs, pcurv_par, pcurv_comp, ax = ax_curv, vline = 0.05, xlim = [0, 1])
-ax_curv.annotate('(B)', xy = (0.05, 0.92), xycoords = 'axes fraction', fontsize = 10)
-plt.xlabel('p-value for quadratic term', fontsize = 8)
-plt.ylabel('Density', fontsize = 8)
-
-ax_r2 = plt.subplot(223)
-tl.plot_dens_par_comp(r2_obs, r2_par, r2_comp, ax = ax_r2, xlim = [0, 1])
-ax_r2.annotate('(C)', xy = (0.05, 0.92), xycoords = 'axes fraction', fontsize = 10)
-plt.xlabel(r'$R^2$', fontsize = 8)
-plt.ylabel('Density', fontsize = 8)
-
-ax_b = plt.subplot(224) 
-tl.plot_dens_par_comp(b_obs, b_par, b_comp, ax = ax_b, xlim = [0, 4])
-ax_b.annotate('(D)', xy = (0.05, 0.92), xycoords = 'axes fraction', fontsize = 10)
-plt.xlabel('Exponent b', fontsize = 8)
-plt.ylabel('Density', fontsize = 8)
-plt.savefig('Fig2.pdf', dpi = 600)
+@figure('Fig2', [(tl.get_study_info, 'study_taxon_type.txt'), (tl.get_tl_par_file, 'out_files/TL_form_partition.txt'),
+                 (tl.get_sample_metrics_file, 'out_files/TL_sample_metrics_partition.txt'),
+                 (tl.get_sample_metrics_file, 'out_files/TL_sample_metrics_composition.txt'),
+                 (tl.get_val_ind_sample_file, 'out_files/TL_quad_p_partition.txt')])
+def plot_fig2(ctx):
+    metrics_par = ctx.groups(tl.get_sample_metrics_file, 'out_files/TL_sample_metrics_partition.txt')
+    plot_sample_dens('Fig2.pdf', metrics_par.studies, ctx.groups(tl.get_study_info, 'study_taxon_type.txt'),
+                     ctx.groups(tl.get_tl_par_file, 'out_files/TL_form_partition.txt'), metrics_par,
+                     ctx.groups(tl.get_sample_metrics_file, 'out_files/TL_sample_metrics_composition.txt'),
+                     ctx.groups(tl.get_val_ind_sample_file, 'out_files/TL_quad_p_partition.txt'))
 
 # Figure 3 - compare empirical versus feasible set variance and b
-tl_pars_par = tl.get_tl_par_file('out_files/TL_form_partition.txt')
-study_sig = tl_pars_par['study']
-
-var_par = tl.get_var_sample_file('out_files/taylor_QN_var_predicted_partition_1000_full.txt')
-var_comp = tl.get_var_sample_file('out_files/taylor_QN_var_predicted_composition_1000_full.txt')
-par_index = [i for i in range(len(var_par)) if var_par['study'][i] in study_sig]
-var_par = var_par[par_index]
-comp_index = [i for i in range(len(var_comp)) if var_comp['study'][i] in study_sig]
-var_comp = var_comp[comp_index]
-
-study_info = tl.get_study_info('study_taxon_type.txt')
-# Here the values are relative to the emp value
-expc_upper_par, expc_upper_comp, expc_par, expc_comp, expc_lower_par, expc_lower_comp = [], [], [], [], [], []
-
-for i in xrange(len(var_par)):
-    expc_sample_par = [var_par[i][j] for j in xrange(5, 1005)]
-    expc_par.append(np.mean(expc_sample_par))
-    expc_lower_par.append(np.percentile(expc_sample_par, 2.5))
-    expc_upper_par.append(np.percentile(expc_sample_par, 97.5))
-
-    expc_sample_comp = [var_comp[i][j] for j in xrange(5, 1005)]
-    expc_comp.append(np.mean(expc_sample_comp))
-    expc_lower_comp.append(np.percentile(expc_sample_comp, 2.5) )
-    expc_upper_comp.append(np.percentile(expc_sample_comp, 97.5))
-    
-fig = plt.figure(figsize = (7, 7))
-ax_par = plt.subplot(221)
-tl.plot_obs_expc_new(var_par['var'], expc_par, expc_upper_par, expc_lower_par, 'partition', True, ax = ax_par)
-plt.xlabel(r'Index for  $s^2$', fontsize = 10)
-plt.ylabel(r'$s_{partition}^2$ / $s_{empirical}^2$', fontsize = 12)
-plt.title('Partitions')
-
-ax_comp = plt.subplot(222)
-tl.plot_obs_expc_new(var_comp['var'], expc_comp, expc_upper_comp, expc_lower_comp, 'composition', True, ax = ax_comp)
-plt.xlabel(r'Index for  $s^2$', fontsize = 10)
-plt.ylabel(r'$s_{composition}^2$/ $s_{empirical}^2$', fontsize = 12)
-plt.title('Compositions')
-
-ax_b_par = plt.subplot(223)
-tl_pars_par = tl.get_tl_par_file('out_files/TL_form_partition.txt')
-tl.plot_obs_expc_new(tl_pars_par['b_obs'], tl_pars_par['b_expc'], tl_pars_par['b_upper'], \
-                     tl_pars_par['b_lower'], 'partition', False, ax = ax_b_par)
-plt.xlabel('Index for b', fontsize = 10)
-plt.ylabel(r'$b_{partition}$ - $b_{empirical}$', fontsize = 12)
-
-ax_b_comp = plt.subplot(224)
-tl_pars_comp = tl.get_tl_par_file('out_files/TL_form_composition.txt')
-tl.plot_obs_expc_new(tl_pars_comp['b_obs'], tl_pars_comp['b_expc'], tl_pars_comp['b_upper'], \
-                     tl_pars_comp['b_lower'], 'composition', False, ax = ax_b_comp)
-plt.xlabel('Index for b', fontsize = 10)
-plt.ylabel(r'$b_{composition}$ - $b_{empirical}$', fontsize = 12)
-
-plt.subplots_adjust(wspace = 0.29, hspace = 0.29)
-plt.savefig('Fig3.pdf', dpi = 600)
+@figure('Fig3', [(tl.get_tl_par_file, 'out_files/TL_form_partition.txt'),
+                 (tl.get_tl_par_file, 'out_files/TL_form_composition.txt'),
+                 (tl.get_var_sample_file, 'out_files/taylor_QN_var_predicted_partition_1000_full.txt'),
+                 (tl.get_var_sample_file, 'out_files/taylor_QN_var_predicted_composition_1000_full.txt')])
+def plot_fig3(ctx):
+    tl_pars_par = ctx.load(tl.get_tl_par_file, 'out_files/TL_form_partition.txt')
+    tl_pars_comp = ctx.load(tl.get_tl_par_file, 'out_files/TL_form_composition.txt')
+    study_sig = tl_pars_par['study']
+
+    var_par = ctx.load(tl.get_var_sample_file, 'out_files/taylor_QN_var_predicted_partition_1000_full.txt')
+    var_comp = ctx.load(tl.get_var_sample_file, 'out_files/taylor_QN_var_predicted_composition_1000_full.txt')
+    var_par = var_par[np.in1d(var_par['study'], study_sig)] # Rows in file order
+    var_comp = var_comp[np.in1d(var_comp['study'], study_sig)]
+
+    # Here the values are relative to the emp value; exact where the distribution of the variance is available
+    expc_par, expc_lower_par, expc_upper_par = tl.var_summaries(var_par, analysis = 'partition')
+    expc_comp, expc_lower_comp, expc_upper_comp = tl.var_summaries(var_comp, analysis = 'composition')
+
+    fig = plt.figure(figsize = (7, 7))
+    ax_par = plt.subplot(221)
+    tl.plot_obs_expc_new(var_par['var'], expc_par, expc_upper_par, expc_lower_par, 'partition', True, ax = ax_par, \
+                         rasterized = True)
+    plt.xlabel(r'Index for  $s^2$', fontsize = 10)
+    plt.ylabel(r'$s_{partition}^2$ / $s_{empirical}^2$', fontsize = 12)
+    plt.title('Partitions')
+
+    ax_comp = plt.subplot(222)
+    tl.plot_obs_expc_new(var_comp['var'], expc_comp, expc_upper_comp, expc_lower_comp, 'composition', True, ax = ax_comp, \
+                         rasterized = True)
+    plt.xlabel(r'Index for  $s^2$', fontsize = 10)
+    plt.ylabel(r'$s_{composition}^2$/ $s_{empirical}^2$', fontsize = 12)
+    plt.title('Compositions')
+
+    ax_b_par = plt.subplot(223)
+    tl.plot_obs_expc_new(tl_pars_par['b_obs'], tl_pars_par['b_expc'], tl_pars_par['b_upper'], \
+                         tl_pars_par['b_lower'], 'partition', False, ax = ax_b_par)
+    plt.xlabel('Index for b', fontsize = 10)
+    plt.ylabel(r'$b_{partition}$ - $b_{empirical}$', fontsize = 12)
+
+    ax_b_comp = plt.subplot(224)
+    tl.plot_obs_expc_new(tl_pars_comp['b_obs'], tl_pars_comp['b_expc'], tl_pars_comp['b_upper'], \
+                         tl_pars_comp['b_lower'], 'composition', False, ax = ax_b_comp)
+    plt.xlabel('Index for b', fontsize = 10)
+    plt.ylabel(r'$b_{composition}$ - $b_{empirical}$', fontsize = 12)
+
+    plt.subplots_adjust(wspace = 0.29, hspace = 0.29)
+    plt.savefig('Fig3.pdf', dpi = 600)
 
 # 10. Figure B1 - examples of empirical variance versus the full distribution from the feasible set
-var_par = tl.get_var_sample_file('out_files/taylor_QN_var_predicted_partition_1000_full.txt')
-var_comp = tl.get_var_sample_file('out_files/taylor_QN_var_predicted_composition_1000_full.txt')
-tl_pars_par = tl.get_tl_par_file('out_files/TL_form_partition.txt')
-random.seed(4) 
-qn_sets = random.sample(range(len(var_par)), 3) 
-
-fig = plt.figure(figsize = (10.5, 3.5)) 
-# Plot the 3 Q-N pairs 
-for i, qn_pair in enumerate(qn_sets):
-    ax_qn = plt.subplot(1, 3, i + 1)
-    dat_row_par = list(var_par[qn_pair])
-    study_comp = var_comp[var_comp['study'] == dat_row_par[0]]
-    dat_row_comp = study_comp[(study_comp['Q'] == dat_row_par[1]) * (study_comp['N'] == dat_row_par[2])]
-    dat_row_comp = list(dat_row_comp[0])
-    if i == 0:
-        tl.plot_dens_par_comp_single_obs(dat_row_par[4], dat_row_par[5:], dat_row_comp[5:], \
-                                         ax = ax_qn, legend = True, loc = 2)
-    else: tl.plot_dens_par_comp_single_obs(dat_row_par[4], dat_row_par[5:], dat_row_comp[5:], ax = ax_qn)
-    ax_qn.annotate('Q = ' + str(dat_row_par[1]), xy = (0.7, 0.92), xycoords = 'axes fraction', fontsize = 10)
-    ax_qn.annotate('N = ' + str(dat_row_par[2]), xy = (0.7, 0.82), xycoords = 'axes fraction', fontsize = 10)
-    plt.xlabel('Variance', fontsize = 10)
-    plt.ylabel('Density', fontsize = 10)
-plt.subplots_adjust(wspace = 0.29)
-plt.savefig('FigB1.pdf', dpi = 600)
+@figure('FigB1', [(tl.get_var_sample_file, 'out_files/taylor_QN_var_predicted_partition_1000_full.txt'),
+                  (tl.get_var_sample_file, 'out_files/taylor_QN_var_predicted_composition_1000_full.txt')])
+def plot_figB1(ctx):
+    var_par = ctx.load(tl.get_var_sample_file, 'out_files/taylor_QN_var_predicted_partition_1000_full.txt')
+    var_comp = ctx.groups(tl.get_var_sample_file, 'out_files/taylor_QN_var_predicted_composition_1000_full.txt')
+    random.seed(4)
+    qn_sets = random.sample(range(len(var_par)), 3)
+
+    fig = plt.figure(figsize = (10.5, 3.5))
+    # Plot the 3 Q-N pairs
+    for i, qn_pair in enumerate(qn_sets):
+        ax_qn = plt.subplot(1, 3, i + 1)
+        dat_row_par = list(var_par[qn_pair])
+        study_comp = var_comp[dat_row_par[0]]
+        dat_row_comp = study_comp[(study_comp['Q'] == dat_row_par[1]) * (study_comp['N'] == dat_row_par[2])]
+        dat_row_comp = list(dat_row_comp[0])
+        if i == 0:
+            tl.plot_dens_par_comp_single_obs(dat_row_par[4], dat_row_par[5:], dat_row_comp[5:], \
+                                             ax = ax_qn, legend = True, loc = 2)
+        else: tl.plot_dens_par_comp_single_obs(dat_row_par[4], dat_row_par[5:], dat_row_comp[5:], ax = ax_qn)
+        ax_qn.annotate('Q = ' + str(dat_row_par[1]), xy = (0.7, 0.92), xycoords = 'axes fraction', fontsize = 10)
+        ax_qn.annotate('N = ' + str(dat_row_par[2]), xy = (0.7, 0.82), xycoords = 'axes fraction', fontsize = 10)
+        plt.xlabel('Variance', fontsize = 10)
+        plt.ylabel('Density', fontsize = 10)
+    plt.subplots_adjust(wspace = 0.29)
+    plt.savefig('FigB1.pdf', dpi = 600)
 
 # Figure B2 - results from 4000 samples
-study_info = tl.get_study_info('study_taxon_type.txt')
-tl_pars_par = tl.get_tl_par_file('out_files/TL_form_partition_4000.txt')
-
-var_par_1000 = tl.get_var_sample_file('out_files/taylor_QN_var_predicted_partition_1000_full.txt')
-var_par = tl.get_var_sample_file('out_files/taylor_QN_var_predicted_partition_4000_full.txt', sample_size = 4000)
-var_comp = tl.get_var_sample_file('out_files/taylor_QN_var_predicted_composition_4000_full.txt', sample_size = 4000)
-par_quad = tl.get_val_ind_sample_file('out_files/TL_quad_p_partition_4000.txt', sample_size = 4000)
-comp_quad = tl.get_val_ind_sample_file('out_files/TL_quad_p_composition_4000.txt', sample_size = 4000)
-
-b_obs, b_par, b_comp, b_type = [], [], [], []
-p_obs, p_par, p_comp = [], [], []
-pcurv_obs, pcurv_par, pcurv_comp = [], [], []
-r2_obs, r2_par, r2_comp = [], [], []
-for study in np.unique(var_par_1000['study']):
-    b_obs.append((tl_pars_par['b_obs'][tl_pars_par['study'] == study])[0])
-    p_obs.append((tl_pars_par['p_obs'][tl_pars_par['study'] == study])[0])
-    r2_obs.append((tl_pars_par['R2_obs'][tl_pars_par['study'] == study])[0])
-    pcurv_obs.append((par_quad['emp_val'][par_quad['study'] == study])[0])
-    b_type.append((study_info['type'][study_info['study'] == study])[0])
-    
-    sample_par = var_par[var_par['study'] == study]
-    sample_comp = var_comp[var_comp['study'] == study]
-    for i in xrange(4000):
-        sample_par_i = [sample_par[x][i + 5] for x in xrange(len(sample_par))]
-        mean_par = [sample_par['mean'][p] for p in xrange(len(sample_par)) if sample_par_i[p] != 0]
-        sample_par_i = [sample_par_i[p] for p in xrange(len(sample_par_i)) if sample_par_i[p] != 0]
-        b_par_i, inter_par_i, r_par_i, p_par_i, std_err_par_i = stats.linregress(np.log(mean_par), np.log(sample_par_i))
-        b_par.append(b_par_i)
-        p_par.append(p_par_i)
-        r2_par.append(r_par_i ** 2)
-        pcurv_par.append(par_quad[par_quad['study'] == study][0][i + 2])
-        
-        sample_comp_i = [sample_comp[y][i + 5] for y in xrange(len(sample_comp))]
-        mean_comp = [sample_comp['mean'][q] for q in xrange(len(sample_comp)) if sample_comp_i[q] != 0]
-        sample_comp_i = [sample_comp_i[q] for q in xrange(len(sample_comp_i)) if sample_comp_i[q] != 0] 
-        b_comp_i, inter_comp_i, r_comp_i, p_comp_i, std_err_comp_i = stats.linregress(np.log(mean_comp), np.log(sample_comp_i))
-        b_comp.append(b_comp_i)
-        p_comp.append(p_comp_i)
-        r2_comp.append(r_comp_i ** 2)
-        pcurv_comp.append(comp_quad[comp_quad['study'] == study][0][i + 2])
-        
-fig = plt.figure(figsize = (7, 7)) 
-ax_p = plt.subplot(221)
-tl.plot_dens_par_comp(p_obs, p_par, p_comp, ax = ax_p, legend = True, loc = 1, vline = 0.05, xlim = [0, 0.2])
-ax_p.annotate('(A)', xy = (0.05, 0.92), xycoords = 'axes fraction', fontsize = 10)
-plt.xlabel('p-value for b', fontsize = 8)
-plt.ylabel('Density', fontsize = 8)
-
-ax_curv = plt.subplot(222)
-pcurv_par = [x for x in pcurv_par if not np.isnan(x)]
-pcurv_comp = [x for x in pcurv_comp if not np.isnan(x)]
-tl.plot_dens_par_comp(pcurv_obs, pcurv_par,  pcurv_comp, ax = ax_curv, vline = 0.05, xlim = [0, 1])
-ax_curv.annotate('(B)', xy = (0.05, 0.92), xycoords = 'axes fraction', fontsize = 10)
-plt.xlabel('p-value for quadratic term', fontsize = 8)
-plt.ylabel('Density', fontsize = 8)
-
-ax_r2 = plt.subplot(223)
-tl.plot_dens_par_comp(r2_obs, r2_par, r2_comp, ax = ax_r2, xlim = [0, 1])
-ax_r2.annotate('(C)', xy = (0.05, 0.92), xycoords = 'axes fraction', fontsize = 10)
-plt.xlabel(r'$R^2$', fontsize = 8)
-plt.ylabel('Density', fontsize = 8)
-
-ax_b = plt.subplot(224) 
-tl.plot_dens_par_comp(b_obs, b_par, b_comp, ax = ax_b, xlim = [0, 4])
-ax_b.annotate('(D)', xy = (0.05, 0.92), xycoords = 'axes fraction', fontsize = 10)
-plt.xlabel('Exponent b', fontsize = 8)
-plt.ylabel('Density', fontsize = 8)
-plt.savefig('FigB2.pdf', dpi = 600)
+@figure('FigB2', [(tl.get_study_info, 'study_taxon_type.txt'), (tl.get_tl_par_file, 'out_files/TL_form_partition_4000.txt'),
+                  (tl.get_sample_metrics_file, 'out_files/TL_sample_metrics_partition.txt'),
+                  (tl.get_sample_metrics_file, 'out_files/TL_sample_metrics_partition_4000.txt'),
+                  (tl.get_sample_metrics_file, 'out_files/TL_sample_metrics_composition_4000.txt'),
+                  (tl.get_val_ind_sample_file, 'out_files/TL_quad_p_partition_4000.txt', {'sample_size': 4000})])
+def plot_figB2(ctx):
+    study_list_1000 = ctx.groups(tl.get_sample_metrics_file, 'out_files/TL_sample_metrics_partition.txt').studies
+    plot_sample_dens('FigB2.pdf', study_list_1000, ctx.groups(tl.get_study_info, 'study_taxon_type.txt'),
+                     ctx.groups(tl.get_tl_par_file, 'out_files/TL_form_partition_4000.txt'),
+                     ctx.groups(tl.get_sample_metrics_file, 'out_files/TL_sample_metrics_partition_4000.txt'),
+                     ctx.groups(tl.get_sample_metrics_file, 'out_files/TL_sample_metrics_composition_4000.txt'),
+                     ctx.groups(tl.get_val_ind_sample_file, 'out_files/TL_quad_p_partition_4000.txt', sample_size = 4000),
+                     drop_nan = True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Build the figures of the TL project.')
+    parser.add_argument('names', nargs = '*', help = 'figures to build (default: all of ' + ', '.join(figures) + ')')
+    parser.add_argument('--force', action = 'store_true', help = 'rebuild figures that are up to date')
+    parser.add_argument('--processes', type = int, default = None, help = 'number of worker processes')
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in figures]
+    if unknown: parser.error('unknown figures: ' + ', '.join(unknown))
+    build_figures(args.names or None, force = args.force, processes = args.processes)
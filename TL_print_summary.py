@@ -2,33 +2,40 @@
 from __future__ import division
 import TL_functions as tl
 import numpy as np
-from scipy import stats
 
-study_info = tl.get_study_info('study_taxon_type.txt')
-tl_pars_par = tl.get_tl_par_file('TL_form_partition.txt')
-tl_pars_comp = tl.get_tl_par_file('TL_form_composition.txt')
+study_info = tl.group_by_study(tl.get_study_info('study_taxon_type.txt'))
+study_sources = tl.group_by_study(tl.get_study_sources('study_taxon_type.txt'))
+tl_pars_par = tl.group_by_study(tl.get_tl_par_file('TL_form_partition.txt'))
+tl_pars_comp = tl.group_by_study(tl.get_tl_par_file('TL_form_composition.txt'))
 
-var_par = tl.get_var_sample_file('taylor_QN_var_predicted_partition_1000_full.txt')
-var_comp = tl.get_var_sample_file('taylor_QN_var_predicted_composition_1000_full.txt')
+var_par = tl.group_by_study(tl.get_var_sample_file('taylor_QN_var_predicted_partition_1000_full.txt'))
+var_comp = tl.group_by_study(tl.get_var_sample_file('taylor_QN_var_predicted_composition_1000_full.txt'))
+metrics_par = tl.group_by_study(tl.get_sample_metrics_file('TL_sample_metrics_partition.txt'))
+metrics_comp = tl.group_by_study(tl.get_sample_metrics_file('TL_sample_metrics_composition.txt'))
+
+study_spatial = [study for study in var_par.studies if tl.get_study_type(study_info, study) == 'spatial']
+study_temporal = [study for study in var_par.studies if tl.get_study_type(study_info, study) == 'temporal']
+# 0. Data
+sources = set(source for study in var_par.studies for source in tl.get_study(study_sources, study)['source'] if source >= 0)
+print "Number of studies, and of sources they are taken from: ", str(len(var_par.studies)), " ,", \
+      str(len(sources)) if sources else 'unknown (no ' + tl.DATASET_SOURCES + ')'
 
-study_spatial = [study for study in np.unique(var_par['study']) if study_info['type'] [study_info['study'] == study]== 'spatial']
-study_temporal = [study for study in np.unique(var_par['study']) if study_info['type'][study_info['study'] == study] == 'temporal']
 # 1. Curvature
-par_quad = tl.get_val_ind_sample_file('TL_quad_p_partition.txt')
-comp_quad = tl.get_val_ind_sample_file('TL_quad_p_composition.txt')
+par_quad = tl.group_by_study(tl.get_val_ind_sample_file('TL_quad_p_partition.txt'))
+comp_quad = tl.group_by_study(tl.get_val_ind_sample_file('TL_quad_p_composition.txt'))
 
 sig_spatial, sig_temporal, sig_par, sig_comp, tot_sig = 0, 0, 0, 0, 0
 for study in study_spatial:
-    row_study_par = list(par_quad[par_quad['study'] == study][0])
-    row_study_comp = list(comp_quad[comp_quad['study'] == study][0])
+    row_study_par = list(tl.get_study(par_quad, study)[0])
+    row_study_comp = list(tl.get_study(comp_quad, study)[0])
     if row_study_par[1] < 0.05: sig_spatial += 1
     sig_par += len([x for x in row_study_par[2:] if x < 0.05])
     sig_comp += len([x for x in row_study_comp[2:] if x < 0.05])
     tot_sig += len(row_study_comp[2:])
     
 for study in study_temporal:
-    row_study_par = list(par_quad[par_quad['study'] == study][0])
-    row_study_comp = list(comp_quad[comp_quad['study'] == study][0])
+    row_study_par = list(tl.get_study(par_quad, study)[0])
+    row_study_comp = list(tl.get_study(comp_quad, study)[0])
     if row_study_par[1] < 0.05: sig_temporal += 1
     sig_par += len([x for x in row_study_par[2:] if x < 0.05])
     sig_comp += len([x for x in row_study_comp[2:] if x < 0.05])
@@ -40,30 +47,25 @@ print "Proportion of partitions with curvature: ", str(sig_par / tot_sig)
 print "Proportion of compositions with curvature: ", str(sig_comp / tot_sig)
 
 # 2. Exponent b, p, avg r^2
-b_obs, b_par, b_comp, b_type = [], [], [], []
-r2_obs, r2_par, r2_comp, p_obs, p_par, p_comp = [], [], [], [], [], []
-for study in np.unique(var_par['study']):
-    b_obs.append((tl_pars_par['b_obs'][tl_pars_par['study'] == study])[0])
-    b_type.append((study_info['type'][study_info['study'] == study])[0])
-    r2_obs.append((tl_pars_par['R2_obs'][tl_pars_par['study'] == study])[0])
-    p_obs.append((tl_pars_par['p_obs'][tl_pars_par['study'] == study])[0])
-    sample_par = var_par[var_par['study'] == study]
-    sample_comp = var_comp[var_comp['study'] == study]
-    for i in xrange(1000):
-        sample_par_i = [sample_par[x][i + 5] for x in xrange(len(sample_par))]
-        mean_par = [sample_par['mean'][p] for p in xrange(len(sample_par)) if sample_par_i[p] != 0]
-        sample_par_i = [sample_par_i[p] for p in xrange(len(sample_par_i)) if sample_par_i[p] != 0]
-        b, inter, r, p, std_error = stats.linregress(np.log(mean_par), np.log(sample_par_i))
-        b_par.append(b)
-        r2_par.append(r ** 2)
-        p_par.append(p)
-        sample_comp_i = [sample_comp[y][i + 5] for y in xrange(len(sample_comp))]
-        mean_comp = [sample_comp['mean'][q] for q in xrange(len(sample_comp)) if sample_comp_i[q] != 0]
-        sample_comp_i = [sample_comp_i[q] for q in xrange(len(sample_comp_i)) if sample_comp_i[q] != 0]        
-        b, inter, r, p, std_error = stats.linregress(np.log(mean_comp), np.log(sample_comp_i))
-        b_comp.append(b)
-        r2_comp.append(r ** 2)
-        p_comp.append(p)
+# Results from the samples are accumulated without keeping every value in memory
+b_obs, b_type, r2_obs, p_obs = [], [], [], []
+b_par, b_comp, r2_par, r2_comp = tl.RunningStats(), tl.RunningStats(), tl.RunningStats(), tl.RunningStats()
+b_12_par, b_12_comp, sig_par, sig_comp = 0, 0, 0, 0
+for study in var_par.studies:
+    b_obs.append(tl.get_study(tl_pars_par, study)['b_obs'][0])
+    b_type.append(tl.get_study_type(study_info, study))
+    r2_obs.append(tl.get_study(tl_pars_par, study)['R2_obs'][0])
+    p_obs.append(tl.get_study(tl_pars_par, study)['p_obs'][0])
+    sample_par = tl.get_study(metrics_par, study)
+    sample_comp = tl.get_study(metrics_comp, study)
+    b_par.add(sample_par['b'])
+    b_12_par += np.sum((sample_par['b'] > 1) * (sample_par['b'] < 2))
+    r2_par.add(sample_par['R2'])
+    sig_par += np.sum(sample_par['p'] < 0.05)
+    b_comp.add(sample_comp['b'])
+    b_12_comp += np.sum((sample_comp['b'] > 1) * (sample_comp['b'] < 2))
+    r2_comp.add(sample_comp['R2'])
+    sig_comp += np.sum(sample_comp['p'] < 0.05)
 
 b_spatial = [b_obs[i] for i in range(len(b_obs)) if b_type[i] == 'spatial']
 b_temporal = [b_obs[i] for i in range(len(b_obs)) if b_type[i] == 'temporal']
@@ -71,20 +73,20 @@ r2_spatial = [r2_obs[i] for i in range(len(r2_obs)) if b_type[i] == 'spatial']
 r2_temporal = [r2_obs[i] for i in range(len(r2_obs)) if b_type[i] == 'temporal']
 p_spatial = [p_obs[i] for i in range(len(p_obs)) if b_type[i] == 'spatial']
 p_temporal = [p_obs[i] for i in range(len(p_obs)) if b_type[i] == 'temporal']
-print "b in partitions - min, max, proportion between 1 & 2: ", str(min(b_par)), " ,", \
-      str(max(b_par)), " ,", str(len([x for x in b_par if 1 < x < 2]) / len(b_par))
-print "b in compositions - min, max, proportion between 1 & 2: ", str(min(b_comp)), " ,", \
-      str(max(b_comp)), " ,", str(len([x for x in b_comp if 1 < x < 2]) / len(b_comp))
+print "b in partitions - min, max, proportion between 1 & 2: ", str(b_par.min), " ,", \
+      str(b_par.max), " ,", str(b_12_par / b_par.n)
+print "b in compositions - min, max, proportion between 1 & 2: ", str(b_comp.min), " ,", \
+      str(b_comp.max), " ,", str(b_12_comp / b_comp.n)
 print "b in spatial TL - min, max, proportion between 1 & 2: ", str(min(b_spatial)), " ,", \
       str(max(b_spatial)), " ,", str(len([x for x in b_spatial if 1 < x < 2]) / len(b_spatial))
 print "b in temporal TL - min, max, proportion between 1 & 2: ", str(min(b_temporal)), " ,", \
       str(max(b_temporal)), " ,", str(len([x for x in b_temporal if 1 < x < 2]) / len(b_temporal))
-print "Proportion of TL from partitions that are significant: ", str(len([p for p in p_par if p < 0.05]) / 1000 / 111)
-print "Proportion of TL from compositions that are significant: ", str(len([p for p in p_comp if p < 0.05]) / 1000 / 111)
+print "Proportion of TL from partitions that are significant: ", str(sig_par / 1000 / 111)
+print "Proportion of TL from compositions that are significant: ", str(sig_comp / 1000 / 111)
 print "Proportion of spatial TL that are significant: ", str(len([p for p in p_spatial if p < 0.05]) / len(p_spatial))
 print "Proportion of temporal TL that are significant: ", str(len([p for p in p_temporal if p < 0.05]) / len(p_temporal))
-print "R2 from partitions - min, max, average: ", str(min(r2_par)), " ,", str(max(r2_par)), " ,", str(np.mean(r2_par))
-print "R2 from compositios - min, max, average: ", str(min(r2_comp)), " ,", str(max(r2_comp)), " ,", str(np.mean(r2_comp))
+print "R2 from partitions - min, max, average: ", str(r2_par.min), " ,", str(r2_par.max), " ,", str(r2_par.mean)
+print "R2 from compositios - min, max, average: ", str(r2_comp.min), " ,", str(r2_comp.max), " ,", str(r2_comp.mean)
 print "R2 from spatial TL - min, max, average: ", str(min(r2_spatial)), " ,", str(max(r2_spatial)), " ,", str(np.mean(r2_spatial))
 print "R2 from temporal TL - min, max, average: ", str(min(r2_temporal)), " ,", str(max(r2_temporal)), " ,", str(np.mean(r2_temporal))
 
@@ -94,35 +96,33 @@ var_tot_spa, var_tot_temp = 0, 0
 b_out_spa_par, b_out_spa_comp, b_out_temp_par, b_out_temp_comp = 0, 0, 0, 0
 
 for study in study_sig_spatial:
-    var_par_study = var_par[var_par['study'] == study]
+    var_par_study = tl.get_study(var_par, study)
     var_tot_spa += len(var_par_study)
-    for row in var_par_study: 
-        var_feas = list(row)[5:]
-        if not np.percentile(var_feas, 2.5) < row[4] < np.percentile(var_feas, 97.5): var_out_spa_par += 1
-    var_comp_study = var_comp[var_comp['study'] == study]
-    for row in var_comp_study: 
-        var_feas = list(row)[5:]
-        if not np.percentile(var_feas, 2.5) < row[4] < np.percentile(var_feas, 97.5): var_out_spa_comp += 1
+    # Quantiles are exact where the distribution of the variance is available (see tl.var_summaries())
+    expc, lower, upper = tl.var_summaries(var_par_study, analysis = 'partition')
+    var_out_spa_par += np.sum(~((lower < var_par_study['var']) & (var_par_study['var'] < upper)))
+    var_comp_study = tl.get_study(var_comp, study)
+    expc, lower, upper = tl.var_summaries(var_comp_study, analysis = 'composition')
+    var_out_spa_comp += np.sum(~((lower < var_comp_study['var']) & (var_comp_study['var'] < upper)))
     
-    b_row_par = tl_pars_par[tl_pars_par['study'] == study]
+    b_row_par = tl.get_study(tl_pars_par, study)
     if not b_row_par['b_lower'] < b_row_par['b_obs'] < b_row_par['b_upper']: b_out_spa_par += 1
-    b_row_comp = tl_pars_comp[tl_pars_comp['study'] == study]
+    b_row_comp = tl.get_study(tl_pars_comp, study)
     if not b_row_comp['b_lower'] < b_row_comp['b_obs'] < b_row_comp['b_upper']: b_out_spa_comp += 1
     
 for study in study_sig_temporal:
-    var_par_study = var_par[var_par['study'] == study]
+    var_par_study = tl.get_study(var_par, study)
     var_tot_temp += len(var_par_study)
-    for row in var_par_study: 
-        var_feas = list(row)[5:]
-        if not np.percentile(var_feas, 2.5) < row[4] < np.percentile(var_feas, 97.5): var_out_temp_par += 1
-    var_comp_study = var_comp[var_comp['study'] == study]
-    for row in var_comp_study: 
-        var_feas = list(row)[5:]
-        if not np.percentile(var_feas, 2.5) < row[4] < np.percentile(var_feas, 97.5): var_out_temp_comp += 1
+    # Quantiles are exact where the distribution of the variance is available (see tl.var_summaries())
+    expc, lower, upper = tl.var_summaries(var_par_study, analysis = 'partition')
+    var_out_temp_par += np.sum(~((lower < var_par_study['var']) & (var_par_study['var'] < upper)))
+    var_comp_study = tl.get_study(var_comp, study)
+    expc, lower, upper = tl.var_summaries(var_comp_study, analysis = 'composition')
+    var_out_temp_comp += np.sum(~((lower < var_comp_study['var']) & (var_comp_study['var'] < upper)))
     
-    b_row_par = tl_pars_par[tl_pars_par['study'] == study]
+    b_row_par = tl.get_study(tl_pars_par, study)
     if not b_row_par['b_lower'] < b_row_par['b_obs'] < b_row_par['b_upper']: b_out_temp_par += 1
-    b_row_comp = tl_pars_comp[tl_pars_comp['study'] == study]
+    b_row_comp = tl.get_study(tl_pars_comp, study)
     if not b_row_comp['b_lower'] < b_row_comp['b_obs'] < b_row_comp['b_upper']: b_out_temp_comp += 1
 
 print "Proportion of variance out of 95% quantile: spaital (par, comp), temporal (par, comp): ", \
@@ -0,0 +1,78 @@
+"""Summarize the telemetry events written by a run of the TL analysis (see tl.Telemetry).
+
+The report has the sampling time, number of variances drawn and rate per analysis and status (combos read back
+from checkpoints or served from the sample cache draw nothing and have no rate), the time per
+worker process, the slowest and the timed-out Q-N combos, the studies that were skipped, and the wall time
+of the post-processing steps recorded as spans.
+Usage: python TL_telemetry.py [path of telemetry.jsonl] [--top K]
+
+"""
+from __future__ import division
+import numpy as np
+import json
+import argparse
+from collections import OrderedDict
+
+def read_events(path):
+    """List of the events in a telemetry file, skipping a torn last line left by an interrupted run."""
+    events = []
+    with open(path) as event_file:
+        for line in event_file:
+            try:
+                events.append(json.loads(line))
+            except ValueError: pass
+    return events
+
+def group_events(events, event, key):
+    """Events of one type grouped by key, a function of the event, in order of first appearance."""
+    groups = OrderedDict()
+    for x in events:
+        if x['event'] == event:
+            groups.setdefault(key(x), []).append(x)
+    return groups
+
+def combo_label(x):
+    return ' '.join([str(x['study']), 'Q =', str(x['Q']), 'N =', str(x['N']), x['analysis']])
+
+def print_report(events, top = 10):
+    combos = [x for x in events if x['event'] == 'combo']
+    print 'Sampling by analysis and status:'
+    print '%-24s %-10s %8s %12s %12s %12s %10s' % ('analysis', 'status', 'combos', 'hours', 'samples', 'samples/s',
+                                                 'max RSS MB')
+    for (analysis, status), group in group_events(events, 'combo', lambda x: (x['analysis'], x['status'])).items():
+        seconds = sum(x['seconds'] for x in group)
+        samples = sum(x['samples'] for x in group)
+        # Combos read back from checkpoints or sample_cache draw nothing, and have no sampling rate
+        rate = '%.1f' % (samples / seconds if seconds > 0 else 0) if status not in ['checkpoint', 'cached'] else '-'
+        print '%-24s %-10s %8d %12.3f %12d %12s %10.1f' % (analysis, status, len(group), seconds / 3600, samples, rate,
+                                                           max(x['peak_rss_mb'] for x in group))
+    print '\nSampling by worker:'
+    for worker, group in group_events(events, 'combo', lambda x: (x['worker'], x['pid'])).items():
+        print '%-24s %8d combos %12.3f hours' % ('%s (%d)' % worker, len(group), sum(x['seconds'] for x in group) / 3600)
+    print '\nSlowest combos:'
+    for x in sorted(combos, key = lambda x: -x['seconds'])[:top]:
+        print '%-48s %10.1f s %10s %s' % (combo_label(x), x['seconds'], x['status'], x['samples'])
+    timeouts = [x for x in combos if x['status'] == 'timeout']
+    if timeouts:
+        print '\nTimed-out combos:'
+        for x in timeouts:
+            print '%-48s %10.1f s %8d of %d drawn' % (combo_label(x), x['seconds'], x['total'], x['sample_size'])
+    studies = group_events(events, 'study', lambda x: x['status'])
+    print '\nStudies:', ', '.join('%d %s' % (len(group), status) for status, group in studies.items())
+    for x in studies.get('skipped', []):
+        print '  skipped', x['study'], x['analysis'], 'failed Q-N combos:', ' '.join('%d-%d' % tuple(qn) for qn in x['failed'])
+    spans = group_events(events, 'span', lambda x: x['name'])
+    if spans:
+        print '\nSpans:'
+        print '%-24s %8s %12s %12s %12s %8s' % ('name', 'calls', 'total s', 'median s', 'max s', 'errors')
+        for name, group in spans.items():
+            seconds = [x['seconds'] for x in group]
+            print '%-24s %8d %12.3f %12.3f %12.3f %8d' % (name, len(group), sum(seconds), np.median(seconds),
+                                                          max(seconds), sum(x['status'] != 'ok' for x in group))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Summarize the telemetry of a TL run.')
+    parser.add_argument('path', nargs = '?', default = './out_files/telemetry.jsonl', help = 'telemetry file')
+    parser.add_argument('--top', type = int, default = 10, help = 'number of slowest combos to list')
+    args = parser.parse_args()
+    print_report(read_events(args.path), top = args.top)
@@ -0,0 +1,472 @@
+"""Tests of TL_functions. Run with: python -m pytest"""
+from __future__ import division
+import TL_functions as tl
+import numpy as np
+import itertools
+import os
+import pytest
+
+def weak_compositions(q, n):
+    """All weak compositions of q into n parts, by brute force."""
+    return [comp for comp in itertools.product(xrange(q + 1), repeat = n) if sum(comp) == q]
+
+def test_rand_compositions_batch_shape():
+    np.random.seed(1)
+    for method in ['legacy', 'uniform']:
+        comps = tl.rand_compositions_batch(17, 6, 500, method = method)
+        assert comps.shape == (500, 6)
+        assert np.all(comps >= 0)
+        assert np.all(comps.sum(axis = 1) == 17)
+
+def test_rand_compositions_batch_legacy_stream():
+    np.random.seed(2)
+    comps = tl.rand_compositions_batch(30, 5, 200, method = 'legacy')
+    np.random.seed(2)
+    comps_weak = [tl.RandomComposition_weak(30, 5) for i in xrange(200)]
+    assert np.array_equal(comps, np.array(comps_weak))
+
+def test_rand_compositions_batch_uniform():
+    q, n, sample_size = 4, 3, 60000
+    np.random.seed(3)
+    comps = tl.rand_compositions_batch(q, n, sample_size, method = 'uniform')
+    counts = dict((comp, 0) for comp in weak_compositions(q, n))
+    for comp in map(tuple, comps):
+        counts[comp] += 1
+    expected = sample_size / len(counts) # 15 compositions, each with probability 1 / 15
+    assert len(counts) == 15
+    assert all(abs(count - expected) < 5 * expected ** 0.5 for count in counts.values())
+
+def test_var_compositions_batch():
+    np.random.seed(4)
+    comps = tl.rand_compositions_batch(25, 7, 100)
+    np.random.seed(4)
+    assert np.allclose(tl.var_compositions_batch(25, 7, 100), np.var(comps, axis = 1, ddof = 1))
+
+def test_rand_compositions_batch_unknown_method():
+    try:
+        tl.rand_compositions_batch(5, 2, 1, method = 'other')
+    except ValueError: pass
+    else: assert False
+
+def brute_force_var_dist(q, n, analysis):
+    """Distinct variances of the feasible set of (q, n) and their probabilities, by enumeration."""
+    feasible_set = weak_compositions(q, n)
+    if analysis == 'partition':
+        feasible_set = set(tuple(sorted(comp)) for comp in feasible_set)
+    variances = np.round([np.var(x, ddof = 1) for x in feasible_set], 9)
+    values, counts = np.unique(variances, return_counts = True)
+    return values, counts / counts.sum()
+
+def test_exact_var_dist_brute_force():
+    for analysis in ['partition', 'composition']:
+        for q, n in [(5, 2), (8, 3), (12, 4), (9, 6), (3, 5)]:
+            values, probs = tl.exact_var_dist(q, n, analysis = analysis)
+            values_bf, probs_bf = brute_force_var_dist(q, n, analysis)
+            assert np.allclose(values, values_bf)
+            assert np.allclose(probs, probs_bf)
+
+def test_exact_var_dist_unavailable():
+    assert tl.exact_var_dist(10, 1) is None
+    assert tl.exact_var_dist(10, 3, analysis = 'composition', comp_method = 'legacy') is None
+    assert tl.exact_var_dist(200, 50, max_cells = 10 ** 3) is None
+
+def test_exact_var_summary():
+    values, probs = brute_force_var_dist(12, 4, 'partition')
+    summary = tl.exact_var_summary(12, 4)
+    mean = np.sum(values * probs)
+    assert np.isclose(summary['mean'], mean)
+    assert np.isclose(summary['sd'], np.sum((values - mean) ** 2 * probs) ** 0.5)
+    cdf = np.cumsum(probs)
+    assert np.isclose(summary['lower'], values[np.searchsorted(cdf, 0.025)])
+    assert np.isclose(summary['upper'], values[np.searchsorted(cdf, 0.975)])
+
+def test_get_var_for_Q_N_exact():
+    values, probs = brute_force_var_dist(10, 4, 'partition')
+    QN_var = tl.get_var_for_Q_N(10, 4, 20000, None, 'partition', seed = 5)
+    assert len(QN_var) == 20000
+    assert set(np.round(QN_var, 9)) <= set(values)
+    assert abs(np.mean(QN_var) - np.sum(values * probs)) < 0.05 * np.sum(values * probs)
+
+def test_table_over_budget(monkeypatch):
+    model = tl.CostModel()
+    assert not model.table_over_budget(1000, 50, 1) # Not calibrated yet
+    for q, n in [(100, 5), (200, 5), (400, 10), (800, 10), (1600, 20), (100, 20), (200, 40), (400, 5), (800, 40),
+                 (1600, 10)]:
+        model.record(q, n, 'partition', 'table', 1, 10 ** -7 * q ** 2 * n)
+    assert model.table_over_budget(10000, 50, 60)
+    assert not model.table_over_budget(100, 5, 60)
+    assert not model.table_over_budget(10000, 50, None)
+    # The combo is skipped without filling its table
+    monkeypatch.setattr(tl, 'cost_model', model)
+    monkeypatch.setattr(tl, 'partition_counts', tl.PartitionCountCache())
+    assert tl.get_var_for_Q_N(10000, 50, 10, 60, 'partition', exact = False) == []
+
+def make_QN_data(rows):
+    """Records in the format of get_QN_mean_var_data() from (study, Q, N, var) rows."""
+    data = np.zeros(len(rows), dtype = [('study', 'S25'), ('Q', '<i8'), ('N', '<i8'), ('mean', '<f8'), ('var', '<f8')])
+    for i, (study, q, n, var) in enumerate(rows):
+        data[i] = (study, q, n, q / n, var)
+    return data
+
+def read_lines(path):
+    with open(path) as in_file:
+        return in_file.readlines()
+
+def test_sample_var_resume(tmpdir, monkeypatch):
+    data = make_QN_data([('S1', 30, 5, 10.0), ('S1', 50, 6, 20.0), ('S1', 80, 8, 30.0), ('S1', 50, 6, 25.0)])
+    out_file = 'taylor_QN_var_predicted_composition_100_full.txt'
+    kwargs = {'sample_size': 100, 'analysis': 'composition', 'seed': 11}
+    full_folder = str(tmpdir.mkdir('full')) + '/'
+    monkeypatch.setattr(tl, 'sample_cache', tl.SampleCache())
+    assert len(tl.sample_var(data, 'S1', out_folder = full_folder, **kwargs)) == 4
+    # A run interrupted after two combos, then resumed from their checkpoints
+    resumed_folder = str(tmpdir.mkdir('resumed')) + '/'
+    monkeypatch.setattr(tl, 'sample_cache', tl.SampleCache())
+    for record in data[:2]:
+        tl.sample_combo(record, out_folder = resumed_folder, **kwargs)
+    assert len(tl.sample_var(data, 'S1', out_folder = resumed_folder, **kwargs)) == 4
+    assert read_lines(resumed_folder + out_file) == read_lines(full_folder + out_file)
+    # Done studies are not written again
+    assert tl.sample_var(data, 'S1', out_folder = resumed_folder, **kwargs) is None
+    assert read_lines(resumed_folder + out_file) == read_lines(full_folder + out_file)
+
+def test_sample_var_checkpoint_without_seed(tmpdir):
+    data = make_QN_data([('S1', 30, 5, 10.0), ('S1', 50, 6, 20.0)])
+    out_folder = str(tmpdir) + '/'
+    first_line = tl.sample_combo(data[0], sample_size = 50, analysis = 'composition', out_folder = out_folder)
+    var_lines = tl.sample_var(data, 'S1', sample_size = 50, analysis = 'composition', out_folder = out_folder)
+    assert var_lines[0] == first_line
+
+def test_sample_var_checkpoint_keys(tmpdir, monkeypatch):
+    data = make_QN_data([('S1', 30, 5, 10.0), ('S1', 50, 6, 20.0)])
+    out_folder = str(tmpdir) + '/'
+    kwargs = {'sample_size': 50, 'analysis': 'composition', 'out_folder': out_folder}
+    monkeypatch.setattr(tl, 'sample_cache', tl.SampleCache())
+    legacy_lines = tl.sample_var(data, 'S1', comp_method = 'legacy', seed = 20, **kwargs)
+    # Reruns with another comp_method or seed are neither skipped as done nor read back from checkpoints
+    uniform_lines = tl.sample_var(data, 'S1', comp_method = 'uniform', seed = 20, **kwargs)
+    assert uniform_lines is not None and uniform_lines != legacy_lines
+    reseeded_lines = tl.sample_var(data, 'S1', comp_method = 'legacy', seed = 21, **kwargs)
+    assert reseeded_lines is not None and reseeded_lines != legacy_lines
+    assert tl.sample_var(data, 'S1', comp_method = 'uniform', seed = 20, **kwargs) is None
+    # A combo checkpointed under one comp_method is drawn again under the other
+    tl.sample_combo(data[0], comp_method = 'legacy', seed = 22, **kwargs)
+    assert tl.sample_combo(data[0], comp_method = 'uniform', seed = 22, **kwargs) == \
+           tl.sample_combo(data[0], comp_method = 'uniform', seed = 22, checkpoint = False, **kwargs)
+    assert tl.sample_combo(data[0], comp_method = 'uniform', seed = 22, **kwargs) != \
+           tl.sample_combo(data[0], comp_method = 'legacy', seed = 22, **kwargs)
+
+def test_linregress_batch():
+    from scipy import stats
+    np.random.seed(6)
+    x = np.random.uniform(1, 10, 12)
+    y = 2 * x[:, None] + np.random.normal(0, 3, (12, 50))
+    mask = np.random.uniform(size = y.shape) > 0.2
+    slope, intercept, r, p = tl.linregress_batch(x, y, mask = mask)
+    for j in xrange(y.shape[1]):
+        expected = stats.linregress(x[mask[:, j]], y[mask[:, j], j])
+        assert np.allclose([slope[j], intercept[j], r[j], p[j]], expected[:4])
+
+def test_linregress_batch_few_points():
+    x = np.array([1.0, 2.0, 3.0])
+    y = np.array([[1.0, 1.0], [2.0, 5.0], [4.0, 3.0]])
+    mask = np.array([[True, True], [False, True], [False, False]])
+    slope, intercept, r, p = tl.linregress_batch(x, y, mask = mask)
+    assert np.isnan(slope[0]) and np.isnan(p[0])
+    assert np.isclose(slope[1], 4) and p[1] == 0
+
+def test_fit_TL_samples():
+    from scipy import stats
+    np.random.seed(7)
+    mean = np.array([1.5, 2.0, 4.0, 8.0, 16.0, 30.0])
+    var_matrix = mean[:, None] ** 1.5 * np.exp(np.random.normal(0, 0.3, (6, 40)))
+    var_matrix[2, 3] = 0 # Zero variances are left out of the fit of their sample
+    b, inter, R2, p = tl.fit_TL_samples(mean, var_matrix)
+    for j in xrange(var_matrix.shape[1]):
+        keep = var_matrix[:, j] > 0
+        expected = stats.linregress(np.log(mean[keep]), np.log(var_matrix[keep, j]))
+        assert np.allclose([b[j], inter[j], R2[j], p[j]], [expected[0], expected[1], expected[2] ** 2, expected[3]])
+
+def test_quadratic_term_samples():
+    from scipy import stats
+    np.random.seed(24)
+    mean = np.array([1.5, 2.0, 4.0, 8.0, 16.0, 30.0, 50.0])
+    var_matrix = mean[:, None] ** 1.5 * np.exp(np.random.normal(0, 0.4, (7, 30)))
+    var_matrix[2, 3] = var_matrix[5, 3] = 0 # Left out of the fit of their sample
+    var_matrix[:4, 4] = 0 # Three records left, too few for a quadratic fit
+    p = tl.quadratic_term_samples(mean, var_matrix)
+    for j in xrange(var_matrix.shape[1]):
+        keep = var_matrix[:, j] > 0
+        if keep.sum() < 4:
+            assert np.isnan(p[j])
+            continue
+        x = np.log(mean[keep])
+        X = np.column_stack([np.ones(len(x)), x, x ** 2])
+        y = np.log(var_matrix[keep, j])
+        coef, rss = np.linalg.lstsq(X, y, rcond = None)[:2]
+        df = len(x) - 3
+        se = np.sqrt(rss[0] / df * np.linalg.inv(X.T.dot(X))[2, 2])
+        assert np.isclose(p[j], 2 * stats.t.sf(abs(coef[2] / se), df))
+
+def test_running_stats():
+    np.random.seed(8)
+    values = np.random.lognormal(0, 2, 10000)
+    stats_all, stats_a, stats_b = tl.RunningStats(), tl.RunningStats(), tl.RunningStats()
+    for chunk in np.array_split(values, 7):
+        stats_all.add(chunk)
+    stats_a.add(values[:3000])
+    stats_b.add(values[3000:])
+    stats_a.merge(stats_b)
+    for running in [stats_all, stats_a]:
+        assert running.n == len(values)
+        assert np.isclose(running.mean, np.mean(values))
+        assert np.isclose(running.var(), np.var(values, ddof = 1))
+        assert running.min == values.min() and running.max == values.max()
+        assert np.isclose(running.z_score(3.0), tl.get_z_score(3.0, values))
+
+def test_quantile_sketch():
+    np.random.seed(9)
+    values = np.concatenate([np.random.normal(0, 5, 20000), np.zeros(100), [np.nan]])
+    sketch, sketch_a, sketch_b = tl.QuantileSketch(), tl.QuantileSketch(), tl.QuantileSketch()
+    sketch.add(values)
+    sketch_a.add(values[:5000])
+    sketch_b.add(values[5000:])
+    sketch_a.merge(sketch_b)
+    finite = np.sort(values[~np.isnan(values)])
+    for q in [0, 0.025, 0.3, 0.5, 0.975, 1]:
+        expected = finite[int(q * (len(finite) - 1))]
+        for estimate in [sketch.quantile(q), sketch_a.quantile(q)]:
+            assert abs(estimate - expected) <= sketch.relative_accuracy * abs(expected) + 1e-12
+    assert np.isnan(tl.QuantileSketch().quantile(0.5))
+
+def make_var_sample(sample_size, seed = 10):
+    """Records in the format of get_var_sample_file() for two studies, with random sample variances."""
+    data = make_QN_data([(study, q, n, q ** 1.5 / n) for study in ['S1', 'S2'] for q, n in
+                         [(20, 4), (40, 5), (80, 6), (160, 8), (320, 10), (640, 12)]])
+    records = np.zeros(len(data), dtype = tl.var_sample_dtype(sample_size))
+    for name in data.dtype.names:
+        records[name] = data[name]
+    np.random.seed(seed)
+    tl.get_sample_matrix(records)[:] = data['var'][:, None] * np.exp(np.random.normal(0, 0.5, (len(data), sample_size)))
+    return records
+
+def test_write_binary(tmpdir):
+    path = str(tmpdir.join('taylor_QN_var_predicted_partition_40_full.txt'))
+    records = make_var_sample(40)
+    umask = os.umask(022)
+    try:
+        tl.write_binary(path, records)
+    finally:
+        os.umask(umask)
+    assert file_mode(tl.binary_path(path)) == 0644
+    assert np.array_equal(tl.get_var_sample_file(path, sample_size = 40), records)
+
+def test_get_var_sample_file_text(tmpdir):
+    records = make_var_sample(40)
+    path = tmpdir.join('taylor_QN_var_predicted_partition_40_full.txt')
+    path.write(''.join('\t'.join([record[0]] + map(repr, record[1:])) + '\n' for record in records.tolist()))
+    data = tl.get_var_sample_file(str(path), sample_size = 40)
+    assert data.dtype == tl.var_sample_dtype(40) and np.array_equal(data, records)
+
+def test_post_processed_file_names(tmpdir):
+    out_folder = str(tmpdir) + '/'
+    for sample_size in [1000, 40]:
+        tl.TL_from_sample(make_var_sample(sample_size), out_folder = out_folder)
+    for prefix in ['TL_form', 'TL_sample_metrics']:
+        assert tmpdir.join(prefix + '_partition.txt').check()
+        assert tmpdir.join(prefix + '_partition_40.txt').check()
+    assert len(read_lines(out_folder + 'TL_form_partition_40.txt')) == 2
+    assert len(tl.get_sample_metrics_file(out_folder + 'TL_sample_metrics_partition.txt')) == 2 * 1000
+    assert len(tl.get_sample_metrics_file(out_folder + 'TL_sample_metrics_partition_40.txt')) == 2 * 40
+
+def test_quadratic_sig_file_names(tmpdir):
+    pytest.importorskip('scikits.statsmodels.api')
+    out_folder = str(tmpdir) + '/'
+    for sample_size in [1000, 40]:
+        tl.get_quadratic_sig_data(make_var_sample(sample_size), out_folder = out_folder)
+    assert len(tl.get_val_ind_sample_file(out_folder + 'TL_quad_p_partition.txt')) == 2
+    assert len(tl.get_val_ind_sample_file(out_folder + 'TL_quad_p_partition_40.txt', sample_size = 40)) == 2
+
+def test_cost_model_torn_lines(tmpdir):
+    path = str(tmpdir.join('cost_timings.txt'))
+    model = tl.CostModel(path)
+    model.record(100, 5, 'partition', 'sample', 1000, 2.5)
+    model.record(200, 8, 'composition', 'sample', 1000, 0.5)
+    with open(path, 'a') as timing_file:
+        timing_file.write('partition sample 300 1') # Torn last line
+    model = tl.CostModel(path)
+    assert model.timings == {('partition', 'sample'): [(100, 5, 1000, 2.5)],
+                             ('composition_legacy', 'sample'): [(200, 8, 1000, 0.5)]}
+
+def test_seeded_draws_reproducible():
+    for analysis, q, n in [('composition', 200, 12), ('partition', 10, 4)]:
+        QN_var = tl.get_var_for_Q_N(q, n, 300, None, analysis, cache = False, seed = 12)
+        assert QN_var == tl.get_var_for_Q_N(q, n, 300, None, analysis, cache = False, seed = 12)
+        assert QN_var != tl.get_var_for_Q_N(q, n, 300, None, analysis, cache = False, seed = 13)
+
+def test_seeded_top_up():
+    # Batches of 10 ** 6 // 20000 = 50 compositions, so a run timing out stops after a multiple of 50
+    QN_var = tl.get_var_for_Q_N(100, 20000, 200, None, 'composition', cache = False, seed = 14)
+    assert QN_var == tl.get_var_for_Q_N(100, 20000, 200, None, 'composition', cache = False, seed = 14,
+                                        prior = QN_var[:100])
+
+def test_seeded_draws_keep_random_state():
+    np.random.seed(15)
+    expected = np.random.uniform(size = 5)
+    np.random.seed(15)
+    tl.get_var_for_Q_N(200, 12, 100, None, 'composition', cache = False, seed = 16)
+    assert np.array_equal(np.random.uniform(size = 5), expected)
+
+def test_spawn_seed():
+    assert tl.spawn_seed(None, 1) is None
+    assert tl.spawn_seed(17, 'S1', 2) == tl.spawn_seed(17, 'S1', 2)
+    assert len(set([tl.spawn_seed(17, 'S1', 2), tl.spawn_seed(17, 'S1', 3), tl.spawn_seed(18, 'S1', 2)])) == 3
+
+def test_write_output(tmpdir):
+    path = str(tmpdir.join('out.txt'))
+    tl.write_output(path, 'S2', ['S2 a', 'S2 b'])
+    tl.write_output(path, 'S1', ['S1 a'])
+    assert read_lines(path) == ['S2 a\n', 'S2 b\n', 'S1 a\n'] # New studies are appended
+    tl.write_output(path, 'S2', ['S2 c']) # Rows of a study already in the file replace them
+    assert read_lines(path) == ['S1 a\n', 'S2 c\n']
+    with tl.batch_output():
+        tl.write_output(path, 'S3', ['S3 a'])
+        tl.write_output(path, 'S0', ['S0 a'], flush = True)
+        assert tmpdir.join('out.txt.shards').check(dir = True)
+    assert read_lines(path) == ['S0 a\n', 'S1 a\n', 'S2 c\n', 'S3 a\n']
+    assert tmpdir.listdir() == [tmpdir.join('out.txt')] # No shard folder or lock file is left behind
+
+def file_mode(path):
+    return os.stat(str(path)).st_mode & 0777
+
+def test_write_output_mode(tmpdir):
+    umask = os.umask(022)
+    try:
+        path = str(tmpdir.join('out.txt'))
+        with tl.batch_output(): # Merged into a new file through a temporary file
+            tl.write_output(path, 'S1', ['S1 a'])
+        assert file_mode(path) == 0644
+        os.chmod(path, 0640)
+        tl.write_output(path, 'S1', ['S1 b'])
+        assert file_mode(path) == 0640 # The mode of the replaced file is kept
+    finally:
+        os.umask(umask)
+
+def test_sample_cache_mode(tmpdir):
+    cache = tl.SampleCache(cache_dir = str(tmpdir))
+    key = cache.key(30, 5, 'composition', 10, seed = 1)
+    umask = os.umask(022)
+    try:
+        cache.put(key, np.arange(10))
+    finally:
+        os.umask(umask)
+    assert file_mode(tmpdir.join(key + '.npy')) == 0644
+    assert np.array_equal(tl.SampleCache(cache_dir = str(tmpdir)).get(key), np.arange(10))
+
+def test_merge_outputs(tmpdir):
+    path = str(tmpdir.join('out.txt'))
+    tl.write_output(path, 'S1', ['S1 a'])
+    sink = tl.OutputSink(path)
+    sink.write('S0', ['S0 a'])
+    sink.flush() # As left by an interrupted run
+    tl.merge_outputs(str(tmpdir))
+    assert read_lines(path) == ['S0 a\n', 'S1 a\n']
+    assert tmpdir.listdir() == [tmpdir.join('out.txt')]
+
+def test_aicc_file_names(tmpdir):
+    out_folder = str(tmpdir) + '/'
+    for sample_size in [1000, 40]:
+        tl.aicc.get_aicc_data(make_var_sample(sample_size), out_folder = out_folder)
+    assert len(tl.get_val_ind_sample_file(out_folder + 'TL_AICc_partition.txt')) == 2
+    assert len(tl.get_val_ind_sample_file(out_folder + 'TL_AICc_partition_40.txt', sample_size = 40)) == 2
+
+def test_get_tl_par_file_empty(tmpdir):
+    for content in ['', '\n', 'study b_obs inter_obs\n']:
+        tmpdir.join('TL_form_partition.txt').write(content)
+        data = tl.get_tl_par_file(str(tmpdir.join('TL_form_partition.txt')))
+        assert len(data) == 0 and 'b_obs_upper' in data.dtype.names
+
+def test_get_tl_par_file_mixed_widths(tmpdir):
+    old_row = ['S1'] + [str(i) for i in xrange(1, 15)]
+    new_row = ['S2'] + [str(i) for i in xrange(1, 19)]
+    tmpdir.join('TL_form_partition.txt').write('\n'.join(' '.join(row) for row in [old_row, new_row]) + '\n')
+    data = tl.get_tl_par_file(str(tmpdir.join('TL_form_partition.txt')))
+    assert data['study'].tolist() == ['S1', 'S2']
+    assert data['b_obs'].tolist() == [1, 1] and data['inter_upper'].tolist() == [14, 14]
+    for name in ['b_obs_lower', 'b_obs_upper', 'inter_obs_lower', 'inter_obs_upper']:
+        assert np.isnan(data[name][0])
+    assert data[['b_obs_lower', 'b_obs_upper', 'inter_obs_lower', 'inter_obs_upper']][1].tolist() == (15, 16, 17, 18)
+    # Files with only the old rows are read without the CI columns
+    tmpdir.join('TL_form_partition.txt').write(' '.join(old_row) + '\n' + ' '.join(old_row) + '\n')
+    data = tl.get_tl_par_file(str(tmpdir.join('TL_form_partition.txt')))
+    assert data.dtype.names[-1] == 'inter_upper' and data['p_obs'].tolist() == [4, 4]
+
+def test_bootstrap_TL():
+    np.random.seed(23)
+    mean = np.array([1.5, 2.0, 4.0, 8.0, 16.0, 30.0, 50.0])
+    var = mean ** 1.5 * np.exp(np.random.normal(0, 0.2, len(mean)))
+    b_lower, b_upper, inter_lower, inter_upper = tl.bootstrap_TL(mean, var, n_boot = 500, seed = 1)
+    b = tl.stats.linregress(np.log(mean), np.log(var))[0]
+    assert b_lower < b < b_upper and inter_lower < inter_upper
+    # No resample of a study with equal means has a fit
+    assert np.all(np.isnan(tl.bootstrap_TL([2.0] * 6, [1.0, 2.0, 3.0, 4.0, 5.0, 6.0], n_boot = 100, seed = 1)))
+
+def test_binned_kde():
+    from scipy import stats
+    np.random.seed(18)
+    values = np.concatenate([np.random.normal(0, 1, 3000), np.random.normal(4, 0.5, 1000)])
+    points = np.linspace(-4, 7, 200)
+    for cov_factor in [0.1, 0.4]:
+        expected = stats.gaussian_kde(values, bw_method = cov_factor)(points)
+        density = tl.BinnedKDE(values, cov_factor)(points)
+        assert np.max(np.abs(density - expected)) < 1e-3 * np.max(expected)
+    assert tl.BinnedKDE(values, 0.1)(np.array([-100, 100])).tolist() == [0, 0]
+
+def test_comp_dens():
+    np.random.seed(19)
+    small, large = np.random.normal(size = 100), np.random.normal(size = tl.KDE_BINNED_MIN)
+    assert not isinstance(tl.comp_dens(small, 0.2), tl.BinnedKDE)
+    assert isinstance(tl.comp_dens(large, 0.2), tl.BinnedKDE)
+    try:
+        tl.BinnedKDE(np.ones(10), 0.2)
+    except np.linalg.LinAlgError: pass
+    else: assert False
+
+def test_lazy_imports():
+    import TL_import_time
+    import_time, heavy = TL_import_time.measure_import(repeat = 1)
+    assert heavy == [] # The import time itself is checked by running TL_import_time.py
+
+def write_dataset_inputs(folder):
+    folder.join('study_taxon_type.txt').write('1_1\tfish\tspatial\n2_1\tbacteria\ttemporal\n')
+    folder.join('data_literature.txt').write('1_1\t10\t5\t2\t3.5\n1_1\t20\t4\t5\t0\n')
+    folder.join('data_Glenda.txt').write('2_1\t30\t3\t10\t40\n')
+    folder.join('data_sources.txt').write('Source\tPaper\tsp_id\tsp\tecological\ttype\tsignificance\t\n'
+                                          '1\tPaper_2013\t1\tfish\tyes\tspatial\tyes\t\n')
+
+def test_compile_dataset(tmpdir):
+    write_dataset_inputs(tmpdir)
+    data = tl.get_QN_mean_var_data(str(tmpdir.join('data_literature.txt')))
+    assert data['study'].tolist() == ['1_1', '1_1'] and data['var'].tolist() == [3.5, 0]
+    umask = os.umask(022)
+    try:
+        dataset = tl.load_dataset(str(tmpdir))
+    finally:
+        os.umask(umask)
+    assert dataset['version'] == tl.DATASET_VERSION
+    assert file_mode(tmpdir.join(tl.DATASET_NAME)) == 0644
+    obs = dataset['obs']
+    assert np.allclose(obs['log_mean'], np.log(obs['mean']))
+    assert np.array_equal(obs['log_var'], np.log(obs['var'])) # -inf for the zero variance
+    sources = tl.get_study_sources(str(tmpdir.join('study_taxon_type.txt')))
+    assert sources['source'].tolist() == [1, -1] and sources['paper'][0] == 'Paper_2013'
+
+def test_study_sources_without_dataset(tmpdir):
+    tmpdir.join('study_taxon_type.txt').write('1_1\tfish\tspatial\n2_1\tbacteria\ttemporal\n')
+    sources = tl.get_study_sources(str(tmpdir.join('study_taxon_type.txt')))
+    assert sources['study'].tolist() == ['1_1', '2_1'] and sources['source'].tolist() == [-1, -1]
+    tmpdir.join('data_sources.txt').write('Source\tPaper\tsp_id\tsp\tecological\ttype\tsignificance\t\n'
+                                          '2\tPaper_2012\t1\tbacteria\t\t\t\t\n')
+    sources = tl.get_study_sources(str(tmpdir.join('study_taxon_type.txt')))
+    assert sources['source'].tolist() == [-1, 2]
+    assert not tmpdir.join(tl.DATASET_NAME).check()